@@ -41,6 +41,9 @@ setuptools.setup(
             'clusto-initdb = clusto.commands.initdb:main',
             'clusto-shell = clusto.commands.shell:main',
             'clusto-list-all = clusto.commands.list_all:main',
+            'clusto-rebuild-closure = clusto.commands.rebuild_closure:main',
+            'clusto-query = clusto.commands.query:main',
+            'clusto-ip-utilization = clusto.commands.ip_utilization:main',
         ],
     },
     zip_safe = False,
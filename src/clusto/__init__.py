@@ -1,16 +1,24 @@
 from clusto.schema import *
+from clusto.schema import COUNTER_TABLE, audit_log
 from clusto.exceptions import *
 
 from clusto.drivers import DRIVERLIST, TYPELIST, Driver, ClustoMeta, IPManager
-from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.exc import InvalidRequestError, DisconnectionError
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy import create_engine
 from sqlalchemy import select, and_
-from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.sql import exists
+from sqlalchemy.pool import SingletonThreadPool, QueuePool, NullPool
+from sqlalchemy import event
 
 from clusto import drivers
+from clusto import util
+from clusto import containment
+from clusto import cache
+from clusto import querylang
 
 import collections
+import contextlib
 import threading
 import logging.config
 import logging
@@ -20,6 +28,57 @@ import re
 driverlist = DRIVERLIST
 typelist = TYPELIST
 
+POOLS = {'singleton': SingletonThreadPool,
+         'queue': QueuePool,
+         'null': NullPool}
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Make the pool replace connections the server has closed."""
+
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise DisconnectionError()
+    finally:
+        cursor.close()
+
+def _create_engine(config, option, echo=False):
+    """Create the engine for the DSN in the given option of the [clusto] section.
+
+    The pool is set up from these options of the same section:
+      pool - singleton (one connection per thread, the default), queue or null
+      pool_size, max_overflow, pool_timeout - sizing of the queue pool
+      pool_recycle - seconds after which connections are replaced
+      pool_pre_ping - test connections before handing them out
+    """
+
+    pool = 'singleton'
+    if config.has_option('clusto', 'pool'):
+        pool = config.get('clusto', 'pool')
+    if pool not in POOLS:
+        raise ValueError("pool must be one of %s" % ', '.join(sorted(POOLS)))
+
+    kwargs = {'echo': echo,
+              'poolclass': POOLS[pool],
+              'pool_recycle': 600}
+
+    if config.has_option('clusto', 'pool_recycle'):
+        kwargs['pool_recycle'] = config.getint('clusto', 'pool_recycle')
+
+    if pool == 'queue':
+        for name in ('pool_size', 'max_overflow', 'pool_timeout'):
+            if config.has_option('clusto', name):
+                kwargs[name] = config.getint('clusto', name)
+
+    engine = create_engine(config.get('clusto', option), **kwargs)
+
+    if config.has_option('clusto', 'pool_pre_ping') \
+            and config.getboolean('clusto', 'pool_pre_ping'):
+        event.listen(engine, 'checkout', _ping_connection)
+
+    return engine
+
 def connect(config, echo=False):
     """Connect to a given Clusto datastore.
 
@@ -31,11 +90,20 @@ def connect(config, echo=False):
     @param config: the config object
     """
 
-    SESSION.configure(bind=create_engine(config.get('clusto', 'dsn'),
-                                         echo=echo,
-                                         poolclass=SingletonThreadPool,
-                                         pool_recycle=600
-                                         ))
+    # sessions already open in this thread would keep the old engine
+    SESSION.remove()
+    SESSION.configure(bind=_create_engine(config, 'dsn', echo))
+
+    if config.has_option('clusto', 'replica_dsn'):
+        SESSION.clusto_replica = _create_engine(config, 'replica_dsn', echo)
+    else:
+        SESSION.clusto_replica = None
+
+    if config.has_option('clusto', 'replica_delay'):
+        SESSION.clusto_replica_delay = config.getfloat('clusto', 'replica_delay')
+    else:
+        SESSION.clusto_replica_delay = 5
+    SESSION.clusto_primary_until = 0
 
     SESSION.clusto_version = None
 
@@ -44,6 +112,24 @@ def connect(config, echo=False):
     else:
         SESSION.clusto_versioning_enabled = False
 
+    if config.has_option('clusto', 'closure'):
+        SESSION.clusto_closure_enabled = config.getboolean('clusto', 'closure')
+    else:
+        SESSION.clusto_closure_enabled = False
+
+    if config.has_option('clusto', 'attr_cache'):
+        SESSION.clusto_attr_cache_enabled = config.getboolean('clusto', 'attr_cache')
+    else:
+        SESSION.clusto_attr_cache_enabled = False
+
+    # inherited attributes are maintained on top of the closure table
+    if SESSION.clusto_closure_enabled and \
+            config.has_option('clusto', 'effective_attrs'):
+        SESSION.clusto_effective_attrs_enabled = \
+            config.getboolean('clusto', 'effective_attrs')
+    else:
+        SESSION.clusto_effective_attrs_enabled = False
+
     # Set the log level from config, default is WARNING
     if config.has_option('clusto', 'loglevel'):
         rootlog = logging.getLogger()
@@ -63,14 +149,7 @@ def connect(config, echo=False):
         ))
         auditlog.addHandler(handler)
 
-    try:
-        memcache_servers = config.get('clusto', 'memcached').split(',')
-#       Memcache should only be imported if we're actually using it, yes?
-        import memcache
-        logging.info('Memcache server list: %s' % config.get('clusto', 'memcached'))
-        SESSION.memcache = memcache.Client(memcache_servers, debug=0)
-    except:
-        SESSION.memcache = None
+    SESSION.cache = cache.from_config(config)
 
 
 def checkDBcompatibility(dbver):
@@ -95,15 +174,59 @@ def init_clusto():
 
 
 def flush():
-    """Flush changes made to clusto objects to the database."""
+    """Flush changes made to clusto objects to the database.
 
-    SESSION.flush()
+    Inside clusto.batch() this is deferred until the batch exits.
+    """
+
+    maybe_flush()
+
+
+@contextlib.contextmanager
+def batch():
+    """Defer flushes for the duration of a with block.
+
+    Everything done inside the block is written in a single
+    begin_transaction()/commit() when it exits, or rolled back if it raises.
+    Until then entity lookups by name, Driver.attrs() and attribute queries
+    are answered from the pending state of the session as well as the
+    database.  Counters (number=True attributes) still flush when they are
+    used, as do queries that can't be answered that way (counts, globs and
+    timestamp ranges).
+
+        with clusto.batch():
+            for port in range(1, 49):
+                if switch.port_free('nic-eth', port):
+                    switch.set_port_attr('nic-eth', port, 'vlan', 10)
+    """
+
+    tl = SESSION()
+
+    try:
+        begin_transaction()
+        if not batching():
+            tl.BATCHAUTOFLUSH = tl.autoflush
+            tl.autoflush = False
+        tl.BATCHCOUNTER = getattr(tl, 'BATCHCOUNTER', 0) + 1
+
+        try:
+            yield
+        finally:
+            tl.BATCHCOUNTER -= 1
+            if not batching():
+                tl.autoflush = tl.BATCHAUTOFLUSH
+
+        commit()
+    except Exception, x:
+        rollback_transaction()
+        raise x
 
 
 def clear():
     """Clear the changes made to objects in the current session. """
 
     SESSION.expunge_all()
+    drop_attr_cache()
     if hasattr(SESSION(), "TRANSACTIONCOUNTER"):
       del SESSION().TRANSACTIONCOUNTER
 
@@ -148,42 +271,144 @@ def get_driver(entity):
 
     return Driver
 
-def get_entities(names=(), clusto_types=(), clusto_drivers=(), attrs=()):
-    """Get entities matching the given criteria
+def _entity_args(names=(), clusto_types=(), clusto_drivers=(), attrs=(),
+                 match='any'):
+    """Return the where clauses selecting the entities get_entities() matches."""
 
-    parameters:
-      names - list of strings; names to match
-      clustotypes - list of strings or Drivers; clustotypes to match
-      clustodrivers - list of strings or Drivers; clustodrivers to get
-      attrs - list of dicts with the following valid keys: key, number, subkey,
-              value ; attribute parameters
-    """
-
-    query = Entity.query()
+    args = Entity._version_args()
 
     if names:
         names = [ u'%s' % _ for _ in names ]
-        query = query.filter(Entity.name.in_(names))
+        args.append(Entity.name.in_(names))
 
     if clusto_types:
         ctl = [get_type_name(n) for n in clusto_types]
-        query = query.filter(Entity.type.in_(ctl))
+        args.append(Entity.type.in_(ctl))
 
     if clusto_drivers:
         cdl = [get_driver_name(n) for n in clusto_drivers]
-        query = query.filter(Entity.driver.in_(cdl))
+        args.append(Entity.driver.in_(cdl))
 
     if attrs:
         for k,v in attrs[0].items():
             if not isinstance(v, basestring):
                 continue
             attrs[0][k] = u'%s' % v
-        query = query.filter(Attribute.entity_id==Entity.entity_id)
-        query = query.filter(or_(*[Attribute.queryarg(**args)
-                                   for args in attrs]))
+        # EXISTS instead of a join, so every entity is only returned once
+        if match == 'any':
+            args.append(exists([Attribute.attr_id],
+                               and_(Attribute.entity_id==Entity.entity_id,
+                                    or_(*[Attribute.queryarg(**attr_args)
+                                          for attr_args in attrs]))))
+        elif match == 'all':
+            args.extend(exists([Attribute.attr_id],
+                               and_(Attribute.entity_id==Entity.entity_id,
+                                    Attribute.queryarg(**attr_args)))
+                        for attr_args in attrs)
+        else:
+            raise ValueError("match must be 'any' or 'all'")
+
+    return args
+
+def get_entities(names=(), clusto_types=(), clusto_drivers=(), attrs=(),
+                 match='any', raw=False):
+    """Get entities matching the given criteria
+
+    parameters:
+      names - list of strings; names to match
+      clustotypes - list of strings or Drivers; clustotypes to match
+      clustodrivers - list of strings or Drivers; clustodrivers to get
+      attrs - list of dicts with the following valid keys: key, number, subkey,
+              value ; attribute parameters
+      match - 'any' to get entities with an attribute matching any of attrs,
+              'all' for entities with attributes matching each one of them
+      raw - if True return read-only EntityRecords read with a plain select
+            instead of Drivers
+    """
+
+    args = _entity_args(names, clusto_types, clusto_drivers, attrs, match)
+
+    if raw:
+        # the select doesn't go through the session, so it can't autoflush
+        SESSION.flush()
+        return entity_records(select(ENTITY_RECORD_COLUMNS, and_(*args)))
+
+    query = SESSION.query(Entity).filter(and_(*args))
 
     return [Driver(entity) for entity in query.all()]
 
+def iter_entities(names=(), clusto_types=(), clusto_drivers=(), attrs=(),
+                  match='any', raw=False, after_entity_id=None, limit=None,
+                  page_size=1000):
+    """Iterate over the entities get_entities() would return, in entity_id order.
+
+    The entities are read page_size at a time, each page starting after the
+    last entity_id of the previous one, so walking the whole database only
+    ever holds one page in memory.
+
+    parameters:
+      after_entity_id - only return entities with a greater entity_id; the
+                        entity_id of the last entity of a previous call
+                        continues from there
+      limit - return at most this many entities
+      page_size - number of entities read with each query
+
+    The other parameters are the same as for get_entities().
+    """
+
+    args = _entity_args(names, clusto_types, clusto_drivers, attrs, match)
+    SESSION.flush()
+
+    while limit is None or limit > 0:
+        count = page_size
+        if limit is not None:
+            count = min(page_size, limit)
+            limit -= count
+
+        page_args = list(args)
+        if after_entity_id is not None:
+            page_args.append(Entity.entity_id > after_entity_id)
+
+        if raw:
+            query = select(ENTITY_RECORD_COLUMNS, and_(*page_args))
+        else:
+            query = SESSION.query(Entity).filter(and_(*page_args))
+        query = query.order_by(ENTITY_TABLE.c.entity_id).limit(count)
+
+        if raw:
+            page = entity_records(query)
+        else:
+            page = query.all()
+
+        for thing in page:
+            if raw:
+                yield thing
+            else:
+                yield Driver(thing)
+
+        if len(page) < count:
+            break
+        after_entity_id = page[-1].entity_id
+
+def query(expr, raw=False):
+    """Get the entities selected by a query expression, see clusto.querylang.
+
+    e.g. clusto.query('pool:web & type:server & system.memory>=65536')
+
+    The expression is compiled into a single query.  Returns Drivers, or
+    read-only EntityRecords if raw is True, in entity_id order.
+    """
+
+    args = Entity._version_args() + [querylang.compile(expr)]
+
+    if raw:
+        SESSION.flush()
+        return entity_records(select(ENTITY_RECORD_COLUMNS, and_(*args)).order_by(
+                ENTITY_TABLE.c.entity_id))
+
+    return [Driver(entity) for entity in SESSION.query(Entity).filter(
+            and_(*args)).order_by(Entity.entity_id)]
+
 
 def get_from_pools(pools, clusto_types=(), clusto_drivers=(), search_children=True):
     return get_from_entities(
@@ -226,6 +451,25 @@ def get_from_entities(entities, clusto_types=(), clusto_drivers=(), search_child
         else:
             ets.append(get_by_name(ent_name))
 
+    if ets and not batching() \
+            and (not search_children or containment.in_database()):
+        # intersect the contents in the database, only the final result is
+        # turned into Drivers
+        query = Entity.query()
+        for e in ets:
+            query = query.filter(Entity.entity_id.in_(
+                containment.members(e.entity.entity_id, search_children)))
+
+        if clusto_types:
+            ctl = [get_type_name(n) for n in clusto_types]
+            query = query.filter(Entity.type.in_(ctl))
+
+        if clusto_drivers:
+            cdl = [get_driver_name(n) for n in clusto_drivers]
+            query = query.filter(Entity.driver.in_(cdl))
+
+        return set(Driver(entity) for entity in query)
+
     resultsets = []
     for e in ets:
         contents = set(e.contents(clusto_types=clusto_types,
@@ -247,7 +491,16 @@ def get_by_name(name, assert_driver=None):
     name = u'%s' % name
 
     try:
-        entity = Entity.query().filter_by(name=name).one()
+        entity = None
+        if batching():
+            for e in pending(Entity):
+                if e.name == name:
+                    entity = e
+
+        if entity is None:
+            entity = Entity.query().filter_by(name=name).one()
+            if batching() and is_pending_delete(entity):
+                raise NoResultFound()
 
         retval = Driver(entity)
 
@@ -287,6 +540,66 @@ def get_by_names(names):
     return retvals
 
 
+def prefetch(things, attrs=True, parents=True, contents=True, relations=True):
+    """Load what the given drivers are about to be asked for all at once.
+
+    Instead of a few queries for each driver the rows needed by all of them
+    are read with a few queries per 500 drivers, and the attrs(), parents(),
+    contents() and relation attribute values of these drivers are then
+    answered from memory until the end of the next transaction.
+
+    parameters:
+      things - list of Drivers or Entities
+      attrs - load their attributes
+      parents - load the entities containing them
+      contents - load the entities they contain
+      relations - load the entities their relation attributes refer to
+
+    Does nothing inside clusto.batch() or when reading an old version.
+    Returns things.
+    """
+
+    things = list(things)
+    entity_ids = list(set(Driver.ensure_driver(thing).entity.entity_id
+                          for thing in things) - set([None]))
+
+    attr_lists = attr_cache(seeding=True)
+    if attr_lists is None or not entity_ids:
+        return things
+
+    loaded = {}
+    if attrs or contents or relations:
+        if SESSION.cache is not None and SESSION.cache.usable():
+            loaded = SESSION.cache.many_entity_attrs(entity_ids)
+        else:
+            loaded = dict((entity_id, []) for entity_id in entity_ids)
+            for chunk in util.batch(entity_ids, 500):
+                for attr in Attribute.query().filter(
+                        Attribute.entity_id.in_(list(chunk))):
+                    loaded[attr.entity_id].append(attr)
+        attr_lists.update(loaded)
+
+    references = {}
+    if parents:
+        references = dict((entity_id, []) for entity_id in entity_ids)
+        for chunk in util.batch(entity_ids, 500):
+            for attr in Attribute.query().filter(
+                    Attribute.relation_id.in_(list(chunk))):
+                references[attr.relation_id].append(attr)
+        reference_cache(seeding=True).update(references)
+
+    related = [attr for attr_list in loaded.itervalues() for attr in attr_list
+               if attr.relation_id is not None
+               and (relations or (contents and attr.key == u'_contains'))]
+    referencing = [attr for attr_list in references.itervalues()
+                   for attr in attr_list]
+
+    # the attributes keep the entities loaded in the session
+    resolve_relations(related)
+    resolve_relations(referencing, referencing=True)
+
+    return things
+
 get_by_attr = drivers.base.Driver.get_by_attr
 
 def get_or_create(name, driver, **kwargs):
@@ -297,6 +610,117 @@ def get_or_create(name, driver, **kwargs):
         logging.info('Created %s' % obj)
     return obj
 
+def bulk_create(driver_cls, names, attrs=(), **kwargs):
+    """Create many entities with the same driver in a single transaction.
+
+    This is a much cheaper alternative to calling driver_cls(name) for each
+    name.  Name uniqueness is checked with one query per 500 names, then the
+    entities, their _properties defaults and the given attributes are written
+    with executemany inserts all stamped with the same version.
+
+    parameters:
+      driver_cls - Driver class; the driver of the new entities
+      names - list of strings; names of the entities to create
+      attrs - list of dicts with the following valid keys: key, value,
+              subkey, number ; attributes added to every new entity.  number
+              may be True to number the attribute the way add_attr does.
+      kwargs - values overriding the driver's _properties defaults
+
+    Returns a list of Drivers in the same order as names.
+    """
+
+    if not isinstance(driver_cls, type) or not issubclass(driver_cls, Driver):
+        raise DriverException("%s is not a driver" % str(driver_cls))
+
+    names = [u'%s' % n for n in names]
+    if len(set(names)) != len(names):
+        raise NameException("The same name was given more than once.")
+
+    attr_rows = []
+    for key, val in driver_cls._properties.iteritems():
+        if key in kwargs:
+            val = kwargs[key]
+        if val is None:
+            continue
+        attr_rows.append((key, u'property', None, val))
+
+    for args in attrs:
+        key = args['key']
+        subkey = args.get('subkey', None)
+        number = args.get('number', None)
+        driver_cls._check_attr_name(key)
+        if subkey:
+            driver_cls._check_attr_name(subkey)
+            subkey = unicode(subkey)
+        if number is False:
+            number = None
+        attr_rows.append((key, subkey, number, args.get('value', None)))
+
+    if not names:
+        return []
+
+    try:
+        begin_transaction()
+
+        existing = []
+        for chunk in util.batch(names, 500):
+            query = SESSION.query(Entity.name).filter(
+                Entity.name.in_(list(chunk))).filter(
+                and_(*Entity._version_args()))
+            existing.extend(name for (name,) in query)
+
+        if existing:
+            raise NameException("Driver with the name(s) %s already exists."
+                                % ', '.join(sorted(existing)))
+
+        version = working_version_number()
+
+        execute_bulk(ENTITY_TABLE.insert(),
+                     [dict(name=name,
+                           driver=driver_cls._driver_name,
+                           type=driver_cls._clusto_type,
+                           version=version)
+                      for name in names])
+
+        entities = {}
+        for chunk in util.batch(names, 500):
+            for entity in Entity.query().filter(Entity.name.in_(list(chunk))):
+                entities[entity.name] = entity
+
+        rows = []
+        counters = []
+        for name in names:
+            entity_id = entities[name].entity_id
+            numbers = {}
+            for key, subkey, number, value in attr_rows:
+                if number is True:
+                    number = numbers[key] = numbers.get(key, -1) + 1
+                row = Attribute.value_columns(value)
+                row.update(entity_id=entity_id, key=unicode(key),
+                           subkey=subkey, number=number, version=version)
+                rows.append(row)
+            counters.extend(dict(entity_id=entity_id, attr_key=unicode(key),
+                                 value=value)
+                            for key, value in numbers.iteritems())
+
+        if rows:
+            execute_bulk(ATTR_TABLE.insert(), rows)
+            for row in rows:
+                if row['key'] == containment.CONTAINS_KEY and row['relation_id']:
+                    containment.link(row['entity_id'], row['relation_id'])
+        if counters:
+            execute_bulk(COUNTER_TABLE.insert(), counters)
+
+        audit_log.info('bulk create entities count=%d driver=%s type=%s attrs=%d',
+                       len(names), driver_cls._driver_name,
+                       driver_cls._clusto_type, len(rows))
+        commit()
+    except Exception, x:
+        rollback_transaction()
+        raise x
+
+    return [Driver(entities[name]) for name in names]
+
 def get_by_mac(mac):
     return get_entities(attrs=[{
         'subkey': 'mac',
@@ -317,6 +741,15 @@ def get_by_ip(ip):
         'value': ip,
     }])
 
+def ip_utilization(over=None):
+    """Report how full every IPManager is, see IPManager.utilization().
+
+    e.g. clusto.ip_utilization(over=0.9) lists the subnets that are at least
+    90% used.
+    """
+
+    return IPManager.utilization_report(over)
+
 def get(term):
     if not isinstance(term, basestring):
         raise ValueError('get(term) must be a string')
@@ -341,15 +774,30 @@ def get(term):
                 pass
     return None
 
-def rename(oldname, newname):
+def rename(oldname, newname, in_place=False):
     """Rename an Entity from oldname to newname.
 
+    By default a new entity is created, every attribute and reference is
+    copied over to it and the old entity is deleted, so history keeps the old
+    name.  If in_place is True only the name of the existing entity is
+    updated, which is a single write no matter how many attributes and
+    references it has.
+
     THIS CAN CAUSE PROBLEMS IF NOT USED CAREFULLY AND IN ISOLATION FROM OTHER
     ACTIONS.
     """
 
     old = get_by_name(oldname)
 
+    if in_place:
+        try:
+            get_by_name(newname)
+        except LookupError:
+            old.entity._set_name(newname)
+            return
+        raise NameException("Driver with the name %s already exists."
+                            % newname)
+
     try:
         begin_transaction()
 
@@ -527,21 +975,18 @@ def delete_entity(entity):
 Adjacency = collections.namedtuple('Adjacency', ['parent_id', 'parent_name', 'parent_type', 'child_id', 'child_name', 'child_type'])
 
 
-def adjacency_map():
-    """Return the entire adjacency map of clusto in one pass (all parent/child relationships)
-
-    Returns a list of namedtuples
-    """
+def _adjacency_query():
     parent_entities = ENTITY_TABLE.alias()
     child_entities = ENTITY_TABLE.alias()
     entity_attrs = ATTR_TABLE
-    query = select([
+    return select([
         parent_entities.c.entity_id,
         parent_entities.c.name,
         parent_entities.c.type,
         child_entities.c.entity_id,
         child_entities.c.name,
-        child_entities.c.type
+        child_entities.c.type,
+        entity_attrs.c.attr_id,
     ]).select_from(
         entity_attrs.
         join(parent_entities,
@@ -557,7 +1002,37 @@ def adjacency_map():
         )
     )
 
+
+def adjacency_map():
+    """Return the entire adjacency map of clusto in one pass (all parent/child relationships)
+
+    Returns a list of namedtuples
+    """
+
     res = []
-    for row in SESSION.execute(query):
-        res.append(Adjacency(*row))
+    for row in SESSION.execute(_adjacency_query()):
+        res.append(Adjacency(*row[:6]))
     return res
+
+
+def iter_adjacency(page_size=1000):
+    """Iterate over the adjacency map of clusto without loading all of it.
+
+    Yields the same namedtuples as adjacency_map(), reading page_size of
+    them at a time.
+    """
+
+    query = _adjacency_query().order_by(ATTR_TABLE.c.attr_id).limit(page_size)
+    after = None
+    while True:
+        page_query = query
+        if after is not None:
+            page_query = query.where(ATTR_TABLE.c.attr_id > after)
+
+        rows = SESSION.execute(page_query).fetchall()
+        for row in rows:
+            yield Adjacency(*row[:6])
+
+        if len(rows) < page_size:
+            break
+        after = rows[-1][6]
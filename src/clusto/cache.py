@@ -0,0 +1,433 @@
+"""
+Attribute cache
+
+Keeps the attribute list of every entity read outside a transaction in an
+in-process LRU and, optionally, in memcached, so reading a Driver's
+attributes doesn't have to go to the database.
+
+Every entity has a generation counter.  Cached attribute lists are stored
+under the generation that was current when they were read from the
+database, and writing any attribute of an entity increments its generation
+once the transaction commits, so expiring an entity never has to find out
+what was cached for it.  When memcached is used the generations live there
+and only the attribute lists are kept in the local LRU, which makes
+invalidations visible to every process at once.
+
+Attribute lists are stored as JSON rows of their column values, never as
+pickled objects.
+"""
+
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.attributes import instance_state, set_committed_value
+
+from clusto.schema import Attribute, SESSION, attr_cache, batching
+from clusto.util import batch
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import collections
+import datetime
+import logging
+import threading
+import time
+
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# the columns an attribute is stored as, in order
+COLUMNS = ('attr_id', 'entity_id', 'key', 'subkey', 'number', 'datatype',
+           'int_value', 'string_value', 'datetime_value', 'relation_id',
+           'version')
+
+
+class CacheBackend(object):
+    """A key/value store the attribute cache can keep its data in.
+
+    Keys are strings, values are strings or, for incr(), integers.
+    """
+
+    def get(self, key):
+        """Return the value stored under key or None."""
+        raise NotImplementedError()
+
+    def get_multi(self, keys):
+        """Return a dict of the keys found and their values."""
+
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value):
+        raise NotImplementedError()
+
+    def set_multi(self, mapping):
+        for key, value in mapping.iteritems():
+            self.set(key, value)
+
+    def add(self, key, value):
+        """Store value under key unless there is one already.
+
+        Returns True if it was stored.
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def incr(self, key):
+        """Increment the integer stored under key.
+
+        Returns the new value, or None if there was nothing stored under key.
+        """
+        raise NotImplementedError()
+
+
+class LRUBackend(CacheBackend):
+    """An in-process cache holding at most size values for ttl seconds each."""
+
+    def __init__(self, size=10000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires is not None and expires < time.time():
+                return None
+
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl:
+            expires = time.time() + self.ttl
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def add(self, key, value):
+        if self.get(key) is not None:
+            return False
+        self.set(key, value)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key):
+        value = self.get(key)
+        if value is None:
+            return None
+
+        with self._lock:
+            expires, value = self._data[key]
+            self._data[key] = (expires, int(value) + 1)
+            return int(value) + 1
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemcacheBackend(CacheBackend):
+    """A memcached client (from the memcache module) used as a backend."""
+
+    def __init__(self, client, ttl=0):
+        self.client = client
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def get_multi(self, keys):
+        return self.client.get_multi(list(keys))
+
+    def set(self, key, value):
+        self.client.set(key, value, time=self.ttl)
+
+    def set_multi(self, mapping):
+        self.client.set_multi(mapping, time=self.ttl)
+
+    def add(self, key, value):
+        return bool(self.client.add(key, value, time=self.ttl))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def incr(self, key):
+        value = self.client.incr(key)
+        if value is not None:
+            value = int(value)
+        return value
+
+
+def dump_attrs(attrs):
+    """Serialize a list of attributes."""
+
+    rows = []
+    for attr in attrs:
+        row = [getattr(attr, name) for name in COLUMNS]
+        if row[8] is not None:
+            row[8] = row[8].strftime(DATETIME_FORMAT)
+        rows.append(row)
+
+    return json.dumps(rows, separators=(',', ':'))
+
+
+def load_attrs(data):
+    """Return the attributes serialized by dump_attrs().
+
+    They are merged into the session without being loaded from the database.
+    """
+
+    mapper = class_mapper(Attribute)
+    attrs = []
+    for row in json.loads(data):
+        if row[8] is not None:
+            row[8] = datetime.datetime.strptime(row[8], DATETIME_FORMAT)
+
+        attr = mapper.class_manager.new_instance()
+        for name, value in zip(COLUMNS, row):
+            set_committed_value(attr, name, value)
+        set_committed_value(attr, 'deleted_at_version', None)
+        instance_state(attr).key = mapper.identity_key_from_primary_key([row[0]])
+
+        attrs.append(SESSION.merge(attr, load=False))
+
+    return attrs
+
+
+class AttrCache(object):
+    """The attribute lists of entities, keyed by entity_id and generation.
+
+    local is a backend in this process, remote an optional shared one.
+    """
+
+    def __init__(self, local, remote=None, prefix='clusto'):
+        self.local = local
+        self.remote = remote
+        self.prefix = prefix
+        self.stats = {'hits': 0, 'misses': 0, 'expires': 0}
+
+    def _generation_key(self, entity_id):
+        return '%s:gen:%d' % (self.prefix, entity_id)
+
+    def _attrs_key(self, entity_id, generation):
+        return '%s:attrs:%d:%d' % (self.prefix, entity_id, generation)
+
+    @property
+    def _generations(self):
+        return self.remote or self.local
+
+    def _new_generation(self, key):
+        """Start the generation of an entity that has none stored.
+
+        Generations can be evicted like anything else.  Starting them from
+        the current time in milliseconds instead of 0 keeps a restarted
+        generation from finding what was cached under an earlier one.
+        """
+
+        generation = int(time.time() * 1000)
+        if self._generations.add(key, generation):
+            return generation
+
+        generation = self._generations.get(key)
+        if generation is None:
+            return self._new_generation(key)
+        return int(generation)
+
+    def usable(self):
+        """Return True if reads may be answered from the cache.
+
+        Inside a transaction the session may hold changes the cache doesn't
+        know about yet, so only reads of the current version outside of
+        transactions use it.
+        """
+
+        return SESSION.clusto_version is None and not SESSION().is_active \
+            and not batching()
+
+    def _get_multi(self, keys):
+        found = self.local.get_multi(keys)
+        missing = [key for key in keys if key not in found]
+        if missing and self.remote:
+            shared = self.remote.get_multi(missing)
+            if shared:
+                self.local.set_multi(shared)
+            found.update(shared)
+        return found
+
+    def _set_multi(self, mapping):
+        self.local.set_multi(mapping)
+        if self.remote:
+            self.remote.set_multi(mapping)
+
+    def entity_attrs(self, entity):
+        """Return the attributes of an Entity."""
+
+        if not self.usable() or entity.entity_id is None:
+            return entity.attrs
+
+        return self.many_entity_attrs([entity.entity_id])[entity.entity_id]
+
+    def many_entity_attrs(self, entity_ids):
+        """Return a dict of entity_id to the attributes of that entity.
+
+        Cache lookups for all the entities are done at once and the ones
+        that weren't cached are loaded with a single query.
+        """
+
+        entity_ids = list(set(entity_ids))
+        local = attr_cache()
+        result = {}
+
+        if local is not None:
+            for entity_id in entity_ids:
+                if entity_id in local:
+                    result[entity_id] = list(local[entity_id])
+            entity_ids = [e for e in entity_ids if e not in result]
+
+        if not entity_ids:
+            return result
+
+        if not self.usable():
+            for entity_id, attrs in self._query(entity_ids).iteritems():
+                result[entity_id] = attrs
+            return result
+
+        generations = self._generations.get_multi(
+            [self._generation_key(e) for e in entity_ids])
+        keys = {}
+        for entity_id in entity_ids:
+            key = self._generation_key(entity_id)
+            if key in generations:
+                generation = int(generations[key])
+            else:
+                generation = self._new_generation(key)
+            keys[entity_id] = self._attrs_key(entity_id, generation)
+
+        found = self._get_multi(keys.values())
+        missing = []
+        for entity_id, key in keys.iteritems():
+            if key in found:
+                result[entity_id] = load_attrs(found[key])
+            else:
+                missing.append(entity_id)
+
+        self.stats['hits'] += len(entity_ids) - len(missing)
+        self.stats['misses'] += len(missing)
+
+        if missing:
+            loaded = self._query(missing)
+            self._set_multi(dict((keys[entity_id], dump_attrs(attrs))
+                                 for entity_id, attrs in loaded.iteritems()))
+            result.update(loaded)
+
+        if local is not None and SESSION.clusto_attr_cache_enabled:
+            for entity_id in entity_ids:
+                local[entity_id] = list(result[entity_id])
+
+        return result
+
+    def _query(self, entity_ids):
+        loaded = dict((entity_id, []) for entity_id in entity_ids)
+        for chunk in batch(entity_ids, 500):
+            for attr in Attribute.query().filter(
+                    Attribute.entity_id.in_(list(chunk))):
+                loaded[attr.entity_id].append(attr)
+        return loaded
+
+    def expire(self, entity_ids):
+        """Drop whatever is cached for the given entities."""
+
+        for entity_id in set(entity_ids):
+            key = self._generation_key(entity_id)
+            if self._generations.incr(key) is None:
+                self._new_generation(key)
+            self.stats['expires'] += 1
+
+
+def invalidate(entity_ids):
+    """Expire the cached attributes of the given entities.
+
+    Inside a transaction this is deferred until it commits, so other
+    processes can't cache what was there before the commit under the new
+    generation.  Rolling back forgets it.
+    """
+
+    if SESSION.cache is None:
+        return
+
+    # entities that weren't flushed yet have nothing cached
+    entity_ids = [e for e in entity_ids if e is not None]
+
+    tl = SESSION()
+    if tl.is_active:
+        if getattr(tl, 'CACHEEXPIRE', None) is None:
+            tl.CACHEEXPIRE = set()
+        tl.CACHEEXPIRE.update(entity_ids)
+    else:
+        SESSION.cache.expire(entity_ids)
+
+
+def after_commit(session):
+    expired = getattr(session, 'CACHEEXPIRE', None)
+    session.CACHEEXPIRE = None
+    if expired and SESSION.cache is not None:
+        SESSION.cache.expire(expired)
+
+
+def after_rollback(session):
+    session.CACHEEXPIRE = None
+
+
+def from_config(config):
+    """Return the AttrCache configured in the [clusto] section of config or None.
+
+    cache_size and cache_ttl set up the in-process cache, memcached a comma
+    separated list of memcached servers to share it through.
+    """
+
+    memcached = None
+    if config.has_option('clusto', 'memcached'):
+        memcached = config.get('clusto', 'memcached').split(',')
+
+    if not memcached and not config.has_option('clusto', 'cache_size'):
+        return None
+
+    size = 10000
+    if config.has_option('clusto', 'cache_size'):
+        size = config.getint('clusto', 'cache_size')
+
+    ttl = 60
+    if config.has_option('clusto', 'cache_ttl'):
+        ttl = config.getint('clusto', 'cache_ttl')
+
+    remote = None
+    if memcached:
+        try:
+            # memcache should only be imported if we're actually using it
+            import memcache
+            logging.info('Memcache server list: %s' % ','.join(memcached))
+            remote = MemcacheBackend(memcache.Client(memcached, debug=0), ttl)
+        except ImportError:
+            logging.warning('memcached is configured but the memcache module '
+                            'is not installed, caching in process only')
+
+    return AttrCache(LRUBackend(size, ttl), remote)
@@ -94,6 +94,7 @@ class Info(script_helper.Script):
             return 0
         item_list = []
         self.debug('Fetching the list of items: %s' % ','.join(args.items))
+        objs = []
         for item in args.items:
             obj = clusto.get(item)
             if not obj:
@@ -101,6 +102,9 @@ class Info(script_helper.Script):
                 continue
             obj = obj[0]
             self.debug('Object found! %s' % obj)
+            objs.append(obj)
+        clusto.prefetch(objs)
+        for obj in objs:
             item_attrs = {
                 'name': obj.name,
                 'type': obj.type,
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- mode: python; sh-basic-offset: 4; indent-tabs-mode: nil; coding: utf-8 -*-
+# vim: tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8
+
+import argparse
+import sys
+
+import clusto
+from clusto import script_helper
+from clusto.drivers import IPManager
+
+
+class IPUtilization(script_helper.Script):
+    '''
+    Shows how full each IP manager is: the used and free ips, the percentage
+    of the subnet that is used and the largest free range.
+    '''
+
+    def __init__(self):
+        script_helper.Script.__init__(self)
+
+    def _add_arguments(self, parser):
+        parser.add_argument('--over', type=float, default=None, metavar='FRACTION',
+            help='Only show the IP managers with at least this fraction of '
+                 'their ips used, e.g. 0.9')
+        parser.add_argument('--ranges', default=False, action='store_true',
+            help='Print the free ranges of each IP manager')
+        parser.add_argument('name', nargs='*', metavar='name',
+            help='IP managers to show, all of them if none are given')
+
+    def run(self, args):
+        over = args.over
+
+        if args.name:
+            report = []
+            for name in args.name:
+                try:
+                    ipman = clusto.get_by_name(name)
+                except LookupError:
+                    self.error('The IP manager "%s" does not exist' % name)
+                    return -1
+                if not isinstance(ipman, IPManager):
+                    self.error('"%s" is not an IP manager' % name)
+                    return -1
+                try:
+                    result = ipman.utilization()
+                except clusto.ResourceTypeException, e:
+                    self.error(str(e))
+                    return -1
+                if over is None or result['utilization'] >= over:
+                    report.append(result)
+        else:
+            report = clusto.ip_utilization(over)
+
+        for result in report:
+            print '%s\t%s\t%d used\t%d free\t%.1f%%\tlargest free %d' % (
+                result['name'], result['subnet'], result['used'],
+                result['free'], result['utilization'] * 100,
+                result['largest_free'])
+            if args.ranges:
+                for first, last in result['free_ranges']:
+                    print '\t%s-%s' % (first, last)
+
+
+def main():
+    utilization, args = script_helper.init_arguments(IPUtilization)
+    return(utilization.run(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -43,6 +43,10 @@ class ListPool(script_helper.Script):
             else:
                 serverset = serverset.intersection(pool)
 
+        if not args.names:
+            clusto.prefetch(serverset, parents=False, contents=False,
+                            relations=False)
+
         for server in serverset:
             if args.names:
                 print server.name
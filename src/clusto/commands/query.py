@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- mode: python; sh-basic-offset: 4; indent-tabs-mode: nil; coding: utf-8 -*-
+# vim: tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8
+
+import argparse
+import sys
+
+import clusto
+from clusto import script_helper
+
+
+class Query(script_helper.Script):
+    '''
+    Lists the entities matching a query expression, e.g.
+
+    pool:web & type:server & system.memory>=65536 & !attr:decommissioned
+
+    Terms are pool:NAME, type:NAME, driver:NAME, name:PATTERN,
+    attr:KEY[.SUBKEY] and KEY[.SUBKEY] followed by one of = != < <= > >= and
+    a value, combined with &, |, ! and parentheses.
+    '''
+
+    def __init__(self):
+        script_helper.Script.__init__(self)
+
+    def _add_arguments(self, parser):
+        parser.add_argument('--type', default=False, action='store_true',
+            help='Print the type of each entity with its name')
+        parser.add_argument('expr', nargs='+', metavar='expr',
+            help='Query expression')
+
+    def run(self, args):
+        try:
+            entities = clusto.query(' '.join(args.expr), raw=True)
+        except (clusto.QueryException, LookupError), e:
+            self.error(str(e))
+            return -1
+
+        for entity in entities:
+            if args.type:
+                print '%s\t%s' % (entity.name, entity.type)
+            else:
+                print entity.name
+
+
+def main():
+    query, args = script_helper.init_arguments(Query)
+    return(query.run(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- mode: python; sh-basic-offset: 4; indent-tabs-mode: nil; coding: utf-8 -*-
+# vim: tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8
+
+import argparse
+import sys
+
+import clusto
+from clusto import containment
+from clusto import script_helper
+
+
+class RebuildClosure(script_helper.Script):
+    '''
+    Rebuild the containment closure table from the current contents of
+    every entity, and the inherited attributes table when the
+    effective_attrs option is on. Run this once before enabling either
+    option on an existing database.
+    '''
+
+    def __init__(self):
+        script_helper.Script.__init__(self)
+
+    def run(self, args):
+        try:
+            rows = containment.rebuild_closure()
+        except Exception, e:
+            self.error('Error rebuilding the closure table: %s' % str(e))
+            return -1
+        self.info('Wrote %d closure rows' % rows)
+
+
+def main():
+    rebuild, args = script_helper.init_arguments(RebuildClosure)
+    return(rebuild.run(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -21,6 +21,9 @@ class Rename(script_helper.Script):
             help='Name of an entity')
         parser.add_argument('newname', nargs=1,
             help='New name for the given entity')
+        parser.add_argument('--in-place', default=False, action='store_true',
+            help='Update the name of the entity instead of copying it to a '
+            'new one')
 
     def run(self, args):
         try:
@@ -35,10 +38,11 @@ class Rename(script_helper.Script):
             if obj:
                 self.error('There is already an object named "%s"' %
                     args.newname[0])
+                return -1
         except LookupError, e:
             pass
 
-        clusto.rename(obj.name, args.newname[0])
+        clusto.rename(obj.name, args.newname[0], in_place=args.in_place)
         return
 
 
@@ -0,0 +1,528 @@
+"""
+Containment queries
+
+Entities contain other entities through '_contains' relation attributes.
+These helpers resolve whole parts of that tree in the database instead of
+walking it one level at a time.
+"""
+
+from sqlalchemy import and_, or_, not_, exists, select, text, literal_column
+from sqlalchemy import func, bindparam
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from clusto.schema import ATTR_TABLE, ENTITY_TABLE, CLOSURE_TABLE, SESSION
+from clusto.schema import EFFECTIVE_ATTRS_TABLE
+from clusto.schema import Attribute, Entity, batching, execute_bulk
+from clusto.util import batch
+
+import clusto
+
+
+CONTAINS_KEY = u'_contains'
+
+# guards the ancestor query against containment cycles, which would otherwise
+# recurse forever since each row carries a different depth
+MAX_DEPTH = 64
+
+
+def _literal(value):
+    """Return an integer or a constant string as an inline SQL literal."""
+
+    if isinstance(value, basestring):
+        return literal_column("'%s'" % value.replace("'", "''"))
+    return literal_column(str(int(value)))
+
+
+def _inline(statement):
+    """Return a select without bind parameters as a text clause.
+
+    SQLAlchemy renders every CTE at the front of the outermost statement, but
+    the sqlite3 module of python 2 commits the current transaction before
+    running a statement that starts with anything other than SELECT, INSERT,
+    UPDATE or DELETE.  Compiling the recursive query on its own keeps its
+    WITH clause inside the subquery it is used in.
+    """
+
+    return text(unicode(statement.compile(dialect=SESSION.bind.dialect)))
+
+
+def versioned(table, inline=False):
+    """Return the versioning predicates for the rows of the given table.
+
+    This is the equivalent of Entity._version_args()/Attribute._version_args()
+    for core queries and aliased tables.  If inline is True the version is
+    rendered as a literal instead of a bind parameter.
+    """
+
+    args = []
+    del_version_args = [table.c.deleted_at_version == None]
+    if SESSION.clusto_version is not None:
+        version = SESSION.clusto_version
+        if inline:
+            version = _literal(version)
+        del_version_args.append(table.c.deleted_at_version > version)
+        args.append(table.c.version <= version)
+
+    args.append(or_(*del_version_args))
+    return args
+
+
+def cte_supported(bind=None):
+    """Return True if the database supports recursive common table expressions.
+
+    SQLite supports them since 3.8.3, MySQL since 8.0 and PostgreSQL since
+    long before clusto existed.
+    """
+
+    if bind is None:
+        bind = SESSION.bind
+    if bind is None:
+        return False
+
+    dialect = bind.dialect
+    if dialect.name == 'postgresql':
+        return True
+
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 8, 3)
+
+    if dialect.name == 'mysql':
+        version = getattr(dialect, 'server_version_info', None)
+        return bool(version) and version >= (8,)
+
+    return False
+
+
+def use_closure():
+    """Return True if containment should be read from the closure table.
+
+    The closure table only reflects the current version and doesn't see
+    pending objects inside clusto.batch().
+    """
+
+    return SESSION.clusto_closure_enabled and SESSION.clusto_version is None \
+        and not batching()
+
+
+def use_cte():
+    """Return True if containment should be resolved with a recursive query.
+
+    Pending objects inside clusto.batch() aren't visible to the database so
+    those reads keep walking the tree in python.
+    """
+
+    return not batching() and cte_supported()
+
+
+def in_database():
+    """Return True if containment can be resolved by a single query."""
+
+    return use_closure() or use_cte()
+
+
+def descendants(entity_id):
+    """Return a subquery of the ids of every entity under entity_id.
+
+    The tree is resolved with a single recursive query over '_contains'
+    attributes, only following rows visible at the current version.  UNION
+    removes duplicates so cycles terminate.  The result can be used with
+    in_().  The closure table is used instead when it is enabled.
+    """
+
+    if use_closure():
+        return select([CLOSURE_TABLE.c.descendant_id],
+                      CLOSURE_TABLE.c.ancestor_id == entity_id,
+                      distinct=True)
+
+    attrs = ATTR_TABLE.alias('contains_root')
+    tree = select([attrs.c.relation_id.label('entity_id')]).where(
+        and_(attrs.c.entity_id == _literal(entity_id),
+             attrs.c.key == _literal(CONTAINS_KEY),
+             *versioned(attrs, inline=True))).cte('descendants', recursive=True)
+
+    attrs = ATTR_TABLE.alias('contains_child')
+    tree = tree.union(
+        select([attrs.c.relation_id]).where(
+            and_(attrs.c.entity_id == tree.c.entity_id,
+                 attrs.c.key == _literal(CONTAINS_KEY),
+                 *versioned(attrs, inline=True))))
+
+    return _inline(select([tree.c.entity_id]))
+
+
+def members(entity_id, search_children=False):
+    """Return a subquery of the ids of the entities contained in entity_id.
+
+    Only direct contents are returned unless search_children is True, in
+    which case this is the same as descendants().
+    """
+
+    if search_children:
+        return descendants(entity_id)
+
+    return select([ATTR_TABLE.c.relation_id],
+                  and_(ATTR_TABLE.c.entity_id == entity_id,
+                       ATTR_TABLE.c.key == CONTAINS_KEY,
+                       *versioned(ATTR_TABLE)))
+
+
+def ancestors(entity_id, through_drivers=None, name='ancestry'):
+    """Return a from clause of (entity_id, depth) rows for everything above entity_id.
+
+    Direct parents have depth 1, their parents depth 2 and so on; an entity
+    reachable through several paths gets its smallest depth.  If
+    through_drivers is given the search only continues upwards from
+    entities with one of those driver names.  The closure table is used
+    when it is enabled, unless through_drivers is given.
+    """
+
+    if use_closure() and through_drivers is None:
+        return select([CLOSURE_TABLE.c.ancestor_id.label('entity_id'),
+                       func.min(CLOSURE_TABLE.c.depth).label('depth')],
+                      CLOSURE_TABLE.c.descendant_id == entity_id).group_by(
+            CLOSURE_TABLE.c.ancestor_id).alias(name)
+
+    attrs = ATTR_TABLE.alias('contains_root')
+    tree = select([attrs.c.entity_id.label('entity_id'),
+                   _literal(1).label('depth')]).where(
+        and_(attrs.c.relation_id == _literal(entity_id),
+             attrs.c.key == _literal(CONTAINS_KEY),
+             *versioned(attrs, inline=True))).cte('ancestors', recursive=True)
+
+    attrs = ATTR_TABLE.alias('contains_parent')
+    args = [attrs.c.relation_id == tree.c.entity_id,
+            attrs.c.key == _literal(CONTAINS_KEY),
+            tree.c.depth < _literal(MAX_DEPTH)]
+    args.extend(versioned(attrs, inline=True))
+
+    if through_drivers is not None:
+        entities = ENTITY_TABLE.alias('contains_through')
+        args.append(entities.c.entity_id == tree.c.entity_id)
+        args.append(entities.c.driver.in_([_literal(d) for d in through_drivers]))
+
+    tree = tree.union(select([attrs.c.entity_id, tree.c.depth + _literal(1)]).where(and_(*args)))
+
+    query = _inline(select([tree.c.entity_id,
+                            func.min(tree.c.depth).label('depth')]).group_by(tree.c.entity_id))
+    return text('(%s) AS %s' % (query.text, name))
+
+
+def ancestor_entities(entity_id, clusto_types=None, clusto_drivers=None,
+                      through_drivers=None):
+    """Return (Entity, depth) tuples for the ancestors of entity_id, nearest first.
+
+    clusto_types and clusto_drivers are lists of type and driver names the
+    returned entities must match, through_drivers is passed to ancestors().
+    Everything is resolved in a single query.
+    """
+
+    ancestry = ancestors(entity_id, through_drivers, name='ancestry')
+    depth = literal_column('ancestry.depth')
+
+    args = [ENTITY_TABLE.c.entity_id == literal_column('ancestry.entity_id')]
+    args.extend(versioned(ENTITY_TABLE))
+
+    if clusto_types:
+        args.append(ENTITY_TABLE.c.type.in_(clusto_types))
+    if clusto_drivers:
+        args.append(ENTITY_TABLE.c.driver.in_(clusto_drivers))
+
+    query = select([ENTITY_TABLE, depth.label('depth')],
+                   and_(*args),
+                   from_obj=[ENTITY_TABLE, ancestry]).order_by(
+        depth, ENTITY_TABLE.c.name)
+
+    return SESSION.query(Entity, literal_column('depth')).from_statement(query).all()
+
+
+def _change_link(parent_id, child_id, sign):
+    """Add (sign=1) or remove (sign=-1) a parent/child link in the closure.
+
+    Every ancestor of the parent (and the parent itself) gains or loses paths
+    to every descendant of the child (and the child itself).
+    """
+
+    closure = CLOSURE_TABLE.c
+
+    ups = {(parent_id, 0): 1}
+    for ancestor_id, depth, paths in SESSION.execute(
+        select([closure.ancestor_id, closure.depth, closure.paths],
+               closure.descendant_id == parent_id)):
+        ups[(ancestor_id, depth)] = paths
+
+    downs = {(child_id, 0): 1}
+    for descendant_id, depth, paths in SESSION.execute(
+        select([closure.descendant_id, closure.depth, closure.paths],
+               closure.ancestor_id == child_id)):
+        downs[(descendant_id, depth)] = paths
+
+    deltas = {}
+    for (ancestor_id, updepth), uppaths in ups.iteritems():
+        for (descendant_id, downdepth), downpaths in downs.iteritems():
+            key = (ancestor_id, descendant_id, updepth + downdepth + 1)
+            deltas[key] = deltas.get(key, 0) + sign * uppaths * downpaths
+
+    ancestor_ids = list(set(a for a, depth in ups))
+    existing = set()
+    for chunk in batch(list(set(d for d, depth in downs)), 500):
+        existing.update(tuple(row) for row in SESSION.execute(
+            select([closure.ancestor_id, closure.descendant_id, closure.depth],
+                   and_(closure.ancestor_id.in_(ancestor_ids),
+                        closure.descendant_id.in_(list(chunk))))))
+
+    updates = [dict(a=a, d=d, dep=depth, delta=delta)
+               for (a, d, depth), delta in deltas.iteritems()
+               if (a, d, depth) in existing]
+    inserts = [dict(ancestor_id=a, descendant_id=d, depth=depth, paths=delta)
+               for (a, d, depth), delta in deltas.iteritems()
+               if (a, d, depth) not in existing and delta > 0]
+
+    if updates:
+        SESSION.execute(CLOSURE_TABLE.update().where(
+            and_(closure.ancestor_id == bindparam('a'),
+                 closure.descendant_id == bindparam('d'),
+                 closure.depth == bindparam('dep'))).values(
+            paths=closure.paths + bindparam('delta')), updates)
+    if inserts:
+        SESSION.execute(CLOSURE_TABLE.insert(), inserts)
+    if sign < 0:
+        SESSION.execute(CLOSURE_TABLE.delete().where(
+            and_(closure.ancestor_id.in_(ancestor_ids), closure.paths <= 0)))
+
+
+def link(parent_id, child_id):
+    """Record in the closure table that parent_id now contains child_id."""
+
+    if SESSION.clusto_closure_enabled:
+        _change_link(parent_id, child_id, 1)
+        _refresh_effective_attrs(child_id)
+
+
+def unlink(parent_id, child_id):
+    """Record in the closure table that parent_id no longer contains child_id."""
+
+    if SESSION.clusto_closure_enabled:
+        _change_link(parent_id, child_id, -1)
+        _refresh_effective_attrs(child_id)
+
+
+def _is_link(obj):
+    return isinstance(obj, Attribute) and obj.key == CONTAINS_KEY \
+        and obj.relation_id is not None
+
+
+def update_closure(session):
+    """Apply the '_contains' attributes written by a flush to the closure table.
+
+    Called from the session's after_flush hook, while new, dirty and deleted
+    still describe what was flushed.
+    """
+
+    for obj in session.new:
+        if _is_link(obj) and obj.deleted_at_version is None:
+            link(obj.entity_id, obj.relation_id)
+
+    for obj in session.dirty:
+        if _is_link(obj) and \
+                [v for v in get_history(obj, 'deleted_at_version').added
+                 if v is not None]:
+            unlink(obj.entity_id, obj.relation_id)
+
+    for obj in session.deleted:
+        if _is_link(obj) and obj.deleted_at_version is None:
+            unlink(obj.entity_id, obj.relation_id)
+
+
+class _InsertFromSelect(Executable, ClauseElement):
+    """INSERT INTO table (columns) SELECT ..."""
+
+    def __init__(self, table, columns, select):
+        self.table = table
+        self.columns = columns
+        self.select = select
+
+
+@compiles(_InsertFromSelect)
+def _visit_insert_from_select(element, compiler, **kw):
+    return 'INSERT INTO %s (%s) %s' % (
+        compiler.process(element.table, asfrom=True),
+        ', '.join(element.columns),
+        compiler.process(element.select))
+
+
+def use_effective_attrs():
+    """Return True if inherited attributes should be read from the
+    entity_effective_attrs table.
+
+    Like the closure table it only reflects the current version and doesn't
+    see pending objects inside clusto.batch().
+    """
+
+    return SESSION.clusto_effective_attrs_enabled and use_closure()
+
+
+def inherited_attrs(entity_id, key=(), subkey=()):
+    """Return the attributes entity_id inherits from the entities containing it.
+
+    Attributes of nearer containers come first.  Each attribute is returned
+    once, even when its entity is reachable through several paths.  key and
+    subkey narrow the query the same way they do for Attribute.queryarg().
+    """
+
+    effective = EFFECTIVE_ATTRS_TABLE.c
+    query = Attribute.query().filter(and_(
+        Attribute.attr_id == effective.attr_id,
+        effective.entity_id == entity_id))
+
+    if key is not ():
+        query = query.filter(Attribute.key == key)
+    if subkey is not ():
+        query = query.filter(Attribute.subkey == subkey)
+
+    return query.order_by(effective.depth, Attribute.attr_id).all()
+
+
+def _inherited(*args):
+    """Return the select of (entity_id, attr_id, source_id, depth) rows
+    matching the given closure and attribute predicates."""
+
+    closure = CLOSURE_TABLE.c
+    attrs = ATTR_TABLE.c
+    return select([closure.descendant_id, attrs.attr_id, closure.ancestor_id,
+                   func.min(closure.depth)],
+                  and_(attrs.entity_id == closure.ancestor_id,
+                       attrs.deleted_at_version == None,
+                       *args)).group_by(closure.descendant_id, attrs.attr_id,
+                                        closure.ancestor_id)
+
+
+def _insert_effective(*args):
+    SESSION.execute(_InsertFromSelect(EFFECTIVE_ATTRS_TABLE,
+                                      ['entity_id', 'attr_id', 'source_id', 'depth'],
+                                      _inherited(*args)))
+
+
+def _refresh_effective_attrs(entity_id):
+    """Recompute the inherited attributes of entity_id and everything under it.
+
+    Called after the closure table changed above entity_id.
+    """
+
+    if not SESSION.clusto_effective_attrs_enabled:
+        return
+
+    below = select([CLOSURE_TABLE.c.descendant_id],
+                   CLOSURE_TABLE.c.ancestor_id == entity_id)
+    effective = EFFECTIVE_ATTRS_TABLE.c
+    SESSION.execute(EFFECTIVE_ATTRS_TABLE.delete().where(
+        or_(effective.entity_id == entity_id, effective.entity_id.in_(below))))
+
+    descendant_id = CLOSURE_TABLE.c.descendant_id
+    _insert_effective(or_(descendant_id == entity_id, descendant_id.in_(below)))
+
+
+def attrs_changed(entity_ids):
+    """Bring the inherited attributes from the given entities up to date.
+
+    Attributes of these entities that were deleted are removed from the
+    entities under them and new ones are added, the rest is left alone.
+    """
+
+    entity_ids = list(set(entity_ids))
+    if not SESSION.clusto_effective_attrs_enabled or not entity_ids:
+        return
+
+    effective = EFFECTIVE_ATTRS_TABLE.c
+    attrs = ATTR_TABLE.c
+    for chunk in batch(entity_ids, 500):
+        chunk = list(chunk)
+        live = select([attrs.attr_id],
+                      and_(attrs.entity_id.in_(chunk),
+                           attrs.deleted_at_version == None))
+        SESSION.execute(EFFECTIVE_ATTRS_TABLE.delete().where(
+            and_(effective.source_id.in_(chunk),
+                 not_(effective.attr_id.in_(live)))))
+
+        _insert_effective(
+            CLOSURE_TABLE.c.ancestor_id.in_(chunk),
+            not_(exists([effective.attr_id],
+                        and_(effective.entity_id == CLOSURE_TABLE.c.descendant_id,
+                             effective.attr_id == attrs.attr_id))))
+
+
+def update_effective_attrs(session):
+    """Apply the attributes written by a flush to the inherited attributes.
+
+    Called from the session's after_flush hook after update_closure().
+    """
+
+    attrs_changed(obj.entity_id
+                  for objs in (session.new, session.dirty, session.deleted)
+                  for obj in objs if isinstance(obj, Attribute))
+
+
+def rebuild_closure():
+    """Recompute the whole closure table from the current '_contains' attributes.
+
+    The table is created if it doesn't exist yet.  The inherited attributes
+    are rebuilt as well when the 'effective_attrs' option is on.  Returns the
+    number of closure rows written.
+    """
+
+    CLOSURE_TABLE.create(bind=SESSION.bind, checkfirst=True)
+    if SESSION.clusto_effective_attrs_enabled:
+        EFFECTIVE_ATTRS_TABLE.create(bind=SESSION.bind, checkfirst=True)
+
+    try:
+        clusto.begin_transaction()
+
+        attrs = ATTR_TABLE.c
+        children = {}
+        for parent_id, child_id in SESSION.execute(
+            select([attrs.entity_id, attrs.relation_id],
+                   and_(attrs.key == CONTAINS_KEY,
+                        attrs.relation_id != None,
+                        attrs.deleted_at_version == None))):
+            children.setdefault(parent_id, []).append(child_id)
+
+        found = {}
+        def below(entity_id, visiting):
+            if entity_id in found:
+                return found[entity_id]
+
+            paths = {}
+            visiting.add(entity_id)
+            for child_id in children.get(entity_id, ()):
+                if child_id in visiting:
+                    continue
+                paths[(child_id, 1)] = paths.get((child_id, 1), 0) + 1
+                for (descendant_id, depth), count in below(child_id, visiting).iteritems():
+                    key = (descendant_id, depth + 1)
+                    paths[key] = paths.get(key, 0) + count
+            visiting.discard(entity_id)
+
+            found[entity_id] = paths
+            return paths
+
+        rows = []
+        for entity_id in children:
+            for (descendant_id, depth), count in below(entity_id, set()).iteritems():
+                rows.append(dict(ancestor_id=entity_id,
+                                 descendant_id=descendant_id,
+                                 depth=depth, paths=count))
+
+        execute_bulk(CLOSURE_TABLE.delete())
+        if rows:
+            execute_bulk(CLOSURE_TABLE.insert(), rows)
+        if SESSION.clusto_effective_attrs_enabled:
+            execute_bulk(EFFECTIVE_ATTRS_TABLE.delete())
+            _insert_effective()
+
+        clusto.commit()
+    except Exception, x:
+        clusto.rollback_transaction()
+        raise x
+
+    return len(rows)
@@ -2,7 +2,9 @@
 
 import clusto
 from clusto.drivers.base import Driver
-from clusto.schema import VERSION
+from clusto.schema import VERSION, SESSION, entities_by_id
+
+import weakref
 
 # incrementing the first number means a major schema change
 # incrementing the second number means a change in a driver's storage details
@@ -19,12 +21,25 @@ class ClustoMeta(Driver):
     _driver_name = "clustometa"
 
 
+    # the entity_id of the clustometa entity in each database (engine), so
+    # getting it again is an identity map lookup instead of a query by name
+    _entity_ids = weakref.WeakKeyDictionary()
+
     def __new__(cls):
 
-        try:
-            cls.__singleton = clusto.get_by_name(cls._driver_name)
-        except LookupError:
-            cls.__singleton = Driver.__new__(cls, cls._driver_name)
+        entity_id = cls._entity_ids.get(SESSION.bind)
+        entity = None
+        if entity_id is not None:
+            entity = entities_by_id([entity_id]).get(entity_id)
+
+        if entity is not None:
+            cls.__singleton = Driver(entity)
+        else:
+            try:
+                cls.__singleton = clusto.get_by_name(cls._driver_name)
+                cls._entity_ids[SESSION.bind] = cls.__singleton.entity.entity_id
+            except LookupError:
+                cls.__singleton = Driver.__new__(cls, cls._driver_name)
 
 
         return cls.__singleton
@@ -4,12 +4,16 @@ A Driver provides an interface to an Entity and its Attributes.
 """
 
 import re
-import logging
 
 import clusto
-from clusto.schema import Entity, Attribute
+from clusto.schema import Entity, Attribute, Counter, ATTR_TABLE
+from clusto.schema import audit_log, execute_bulk, working_version_number
+from clusto.schema import SESSION, batching, is_pending_delete, pending
+from clusto.schema import attr_cache, drop_attr_cache, entities_by_id
+from clusto.schema import resolve_relations, raw_attrs, attr_records
+from clusto.schema import ATTR_RECORD_COLUMNS
 from clusto.exceptions import DriverException, NameException
-from clusto.util import batch
+from clusto import containment
 
 from clusto.drivers.base.clustodriver import ClustoDriver, DRIVERLIST
 from sqlalchemy import and_, not_
@@ -20,6 +24,30 @@ except:
     import json
 
 
+
+def _filter_related(attrs, column, names):
+    """Return the relation attrs whose related entity's column is in names.
+
+    Attributes that aren't flushed yet (inside clusto.batch()) have no
+    relation_id, their related object is checked instead.
+    """
+
+    relation_attrs = [attr for attr in attrs if attr.is_relation]
+    entity_ids = [attr.relation_id for attr in relation_attrs
+                  if attr.relation_id is not None]
+
+    related_entity_ids = set()
+    if entity_ids:
+        related_entities = Entity.query().filter(
+            Entity.entity_id.in_(entity_ids)).filter(
+            getattr(Entity, column).in_(names)).all()
+        related_entity_ids = set([e.entity_id for e in related_entities])
+
+    return [attr for attr in relation_attrs
+            if attr.relation_id in related_entity_ids
+            or (attr.relation_id is None
+                and getattr(attr.relation_value, column) in names)]
+
 class Driver(object):
     """Base Driver.
 
@@ -167,7 +195,8 @@ class Driver(object):
 
     name = property(lambda x: x.entity.name)
 
-    def _check_attr_name(self, key):
+    @classmethod
+    def _check_attr_name(cls, key):
         """
         check to make sure the key does not contain invalid characters
         raise NameException if fail.
@@ -184,7 +213,12 @@ class Driver(object):
 
     def __getattr__(self, name):
         if name in self._properties:
-            attr = self.attr_query(name, subkey='property')
+            cache = attr_cache()
+            if cache is not None and (SESSION.clusto_attr_cache_enabled
+                                      or self.entity.entity_id in cache):
+                attr = self.attrs(name, subkey='property')
+            else:
+                attr = self.attr_query(name, subkey='property')
             if not attr:
                 return self._properties[name]
             else:
@@ -223,10 +257,31 @@ class Driver(object):
     def do_attr_query(cls, key=(), value=(), number=(), start_timestamp=(), end_timestamp=(),
                       subkey=(), ignore_hidden=True, sort_by_keys=False,
                       glob=False, count=False, querybase=None, return_query=False,
-                      entity=None):
-        """Does queries against all Attributes using the DB."""
+                      entity=None, raw=False):
+        """Does queries against all Attributes using the DB.
+
+        Inside clusto.batch() unflushed attributes are merged into the result,
+        unless one of count, glob, querybase, return_query, raw or the
+        timestamps is used, in which case pending changes get flushed first.
+
+        With raw=True read-only AttrRecords are returned instead of Attributes.
+        """
+
+        merge_pending = batching()
+        if merge_pending and (count or glob or querybase or return_query or raw or
+                              start_timestamp != () or end_timestamp != ()):
+            SESSION.flush()
+            merge_pending = False
+        else:
+            clusto.flush()
+
+        if merge_pending:
+            pending_attrs = cls.attr_filter(
+                [a for a in pending(Attribute)
+                 if entity is None or a.entity is entity],
+                key=key, value=value, number=number, subkey=subkey,
+                ignore_hidden=ignore_hidden, sort_by_keys=False)
 
-        clusto.flush()
         if querybase:
             query = querybase
         else:
@@ -303,6 +358,16 @@ class Driver(object):
         if return_query:
             return query
 
+        if raw:
+            return attr_records(query.with_entities(*ATTR_RECORD_COLUMNS).statement)
+
+        if merge_pending:
+            result = [a for a in query if not is_pending_delete(a)]
+            result.extend(pending_attrs)
+            if sort_by_keys:
+                result.sort(key=lambda a: a.key)
+            return result
+
         return query.all()
 
     def attr_query(self, *args, **kwargs):
@@ -312,6 +377,41 @@ class Driver(object):
 
         return self.do_attr_query(*args, **kwargs)
 
+    def iter_attrs(self, *args, **kwargs):
+        """Iterate over the attributes of *this* entity in attr_id order.
+
+        Takes the same arguments as attr_query() and a page_size; the
+        attributes are read page_size at a time, so entities with a very
+        large number of attributes can be walked without loading all of them.
+        """
+
+        page_size = kwargs.pop('page_size', 1000)
+        raw = kwargs.pop('raw', False)
+        kwargs['entity'] = self.entity
+        kwargs['sort_by_keys'] = False
+        kwargs['return_query'] = True
+
+        query = self.do_attr_query(*args, **kwargs).order_by(Attribute.attr_id)
+        after = None
+        while True:
+            page_query = query
+            if after is not None:
+                page_query = query.filter(Attribute.attr_id > after)
+            page_query = page_query.limit(page_size)
+
+            if raw:
+                page = attr_records(page_query.with_entities(
+                        *ATTR_RECORD_COLUMNS).statement)
+            else:
+                page = resolve_relations(page_query.all())
+
+            for attr in page:
+                yield attr
+
+            if len(page) < page_size:
+                break
+            after = page[-1].attr_id
+
     @classmethod
     def attr_filter(cls, attrlist, key=(), value=(), number=(),
                     subkey=(), ignore_hidden=True,
@@ -393,30 +493,11 @@ class Driver(object):
 
         if clusto_drivers:
             cdl = [clusto.get_driver_name(n) for n in clusto_drivers]
-            relation_attrs = [relation_attr for relation_attr in result if
-                              relation_attr.is_relation]
-            if relation_attrs:
-                related_entities = Entity.query().filter(
-                    Entity.entity_id.in_([relation_attr.relation_id for relation_attr in
-                                          relation_attrs])).filter(Entity.driver.in_(cdl)).all()
-                related_entity_ids = set([e.entity_id for e in related_entities])
-                result = (attr for attr in relation_attrs if attr.relation_id in related_entity_ids)
-            else:
-                result = []
+            result = _filter_related(result, 'driver', cdl)
 
         if clusto_types:
             ctl = [clusto.get_type_name(n) for n in clusto_types]
-            relation_attrs = [relation_attr for relation_attr in result if
-                              relation_attr.is_relation]
-            if relation_attrs:
-                related_entities = Entity.query().filter(
-                    Entity.entity_id.in_([relation_attr.relation_id for relation_attr in
-                                          relation_attrs])).filter(
-                    Entity.type.in_(ctl)).all()
-                related_entity_ids = set([e.entity_id for e in related_entities])
-                result = (attr for attr in relation_attrs if attr.relation_id in related_entity_ids)
-            else:
-                result = []
+            result = _filter_related(result, 'type', ctl)
 
         if sort_by_keys:
             result = sorted(result)
@@ -430,56 +511,80 @@ class Driver(object):
         """Return attributes for this entity.
 
         (filters whole attribute list as opposed to querying the db directly)
+
+        With raw=True read-only AttrRecords are returned instead of Attributes.
         """
 
         merge_container_attrs = kwargs.pop('merge_container_attrs', False)
-        ignore_memcache = kwargs.pop('ignore_memcache', False)
+        if kwargs.pop('raw', False):
+            return self._raw_attrs(merge_container_attrs, *args, **kwargs)
 
-        if clusto.SESSION.memcache and not ignore_memcache:
-            logging.debug('Pulling info from memcache when possible for %s' % self.name)
-            k = None
-            if 'key' in kwargs:
-                k = kwargs['key']
-            else:
-                if len(args) > 1:
-                    k = args[0]
-            if k:
-#               This is hackish, need to find another way to know if we should cache things or not
-                if not k.startswith('_'):
-                    if 'subkey' in kwargs and kwargs['subkey'] is not None:
-                        memcache_key = str('%s.%s.%s' % (self.name, k, kwargs['subkey']))
-                    else:
-                        memcache_key = str('%s.%s' % (self.name, k))
-                    logging.debug('memcache key: %s' % memcache_key)
-                    attrs = clusto.SESSION.memcache.get(memcache_key)
-                    if not attrs:
-                        attrs = self.attr_filter(self.entity.attrs, *args, **kwargs)
-                        if attrs:
-                            clusto.SESSION.memcache.set(memcache_key, attrs)
-                else:
-                    attrs = self.attr_filter(self.entity.attrs, *args, **kwargs)
-            else:
-                logging.debug('We cannot cache attrs without a key at least')
-                attrs = self.attr_filter(self.entity.attrs, *args, **kwargs)
+        ignore_cache = kwargs.pop('ignore_cache', False)
+        ignore_cache = kwargs.pop('ignore_memcache', ignore_cache)
+        cache = None
+        if not ignore_cache:
+            cache = clusto.SESSION.cache
+
+        if cache is not None:
+            attrs = self.attr_filter(cache.entity_attrs(self.entity), *args, **kwargs)
         else:
             attrs = self.attr_filter(self.entity.attrs, *args, **kwargs)
 
-        if merge_container_attrs:
-            kwargs['merge_container_attrs'] = merge_container_attrs
-            kwargs['ignore_memcache'] = ignore_memcache
+        if merge_container_attrs and containment.use_effective_attrs():
+            if kwargs.get('regex'):
+                inherited = containment.inherited_attrs(self.entity.entity_id)
+            else:
+                inherited = containment.inherited_attrs(self.entity.entity_id,
+                                                        key=kwargs.get('key', ()),
+                                                        subkey=kwargs.get('subkey', ()))
+            attrs.extend(inherited)
+            attrs = self.attr_filter(attrs, *args, **kwargs)
+        elif merge_container_attrs:
             parent_entity_ids = [parent.entity.entity_id for parent in self.parents()]
             while parent_entity_ids:
-                parent_attrs = Attribute.query().filter(
-                    Attribute.entity_id.in_(parent_entity_ids)).all()
-                attrs.extend(parent_attrs)
+                if cache is not None:
+                    parent_attrs = cache.many_entity_attrs(parent_entity_ids)
+                    for entity_id in sorted(set(parent_entity_ids)):
+                        attrs.extend(parent_attrs[entity_id])
+                else:
+                    parent_attrs = Attribute.query().filter(
+                        Attribute.entity_id.in_(parent_entity_ids)).all()
+                    attrs.extend(parent_attrs)
                 grandparent_contains_attributes = Attribute.query().filter(
                     Attribute.relation_id.in_(parent_entity_ids)).filter(
                     Attribute.key == '_contains').all()
                 parent_entity_ids = [a.entity_id for a in grandparent_contains_attributes]
-            kwargs.pop('merge_container_attrs')
-            kwargs.pop('ignore_memcache')
             attrs = self.attr_filter(attrs, *args, **kwargs)
-        return attrs
+        return resolve_relations(attrs)
+
+    def _raw_attrs(self, merge_container_attrs, *args, **kwargs):
+        """attrs() returning AttrRecords read with plain selects."""
+
+        kwargs.pop('ignore_cache', None)
+        kwargs.pop('ignore_memcache', None)
+
+        # records hold the entity_id of related entities as their value
+        args = list(args)
+        if len(args) > 1 and isinstance(args[1], (Driver, Entity)):
+            args[1] = Driver(args[1]).entity.entity_id
+        if isinstance(kwargs.get('value'), (Driver, Entity)):
+            kwargs['value'] = Driver(kwargs['value']).entity.entity_id
+
+        SESSION.flush()
+        entity_id = self.entity.entity_id
+        attrs = raw_attrs(Attribute.entity_id == entity_id)
+
+        if merge_container_attrs:
+            parent_entity_ids = [entity_id]
+            while True:
+                parent_entity_ids = [a.entity_id for a in raw_attrs(
+                    Attribute.relation_id.in_(parent_entity_ids),
+                    Attribute.key == u'_contains')]
+                if not parent_entity_ids:
+                    break
+                attrs.extend(raw_attrs(Attribute.entity_id.in_(parent_entity_ids)))
+
+        return self.attr_filter(attrs, *args, **kwargs)
 
     def attr_values(self, *args, **kwargs):
         """Return the values of the attributes that match the given arguments"""
@@ -555,19 +660,16 @@ class Driver(object):
         argument.
         """
 
-        referencing_entity_ids = [a.entity_id for a in sorted(self.references(*args, **kwargs),
-                                                              lambda x, y: cmp(x.attr_id,
-                                                                               y.attr_id))]
-        if not referencing_entity_ids:
-            return []
+        references = sorted(self.references(*args, **kwargs),
+                            key=lambda a: a.attr_id)
+        resolve_relations(references, referencing=True)
 
-        # This kinda sucks
-        sorting_dict = dict((entity_id, idx)
-                            for idx, entity_id in enumerate(referencing_entity_ids))
-        referencing_entities = Entity.query().filter(
-            Entity.entity_id.in_(referencing_entity_ids)).all()
-        refs = sorted([Driver(e) for e in referencing_entities],
-                      key=lambda d: sorting_dict[d.entity.entity_id])
+        refs = []
+        seen = set()
+        for attr in references:
+            if attr.entity_id not in seen:
+                seen.add(attr.entity_id)
+                refs.append(Driver(attr.entity))
         return refs
 
     def attr_keys(self, *args, **kwargs):
@@ -609,14 +711,86 @@ class Driver(object):
         self.expire(key=key)
         return self.entity.add_attr(key, value, subkey=subkey, number=number)
 
+    def add_attrs(self, attrs):
+        """add many attributes with a single multi-row insert
+
+        attrs is a list of (key, value, subkey, number) tuples, subkey and
+        number may be left off and behave the same way they do in add_attr.
+        Numbers for attributes with number=True are reserved from the key's
+        counter in one step per key, and cached values are expired once.
+        """
+
+        rows = []
+        for attr in attrs:
+            key, value, subkey, number = (tuple(attr) + ((), ()))[:4]
+
+            self._check_attr_name(key)
+            if subkey is () or subkey is None:
+                subkey = None
+            else:
+                self._check_attr_name(subkey)
+                subkey = unicode(subkey)
+
+            if (number is ()) or (number is False):
+                number = None
+
+            if isinstance(value, Driver):
+                value = value.entity
+
+            rows.append((unicode(key), value, subkey, number))
+
+        if not rows:
+            return
+
+        counts = {}
+        for key, value, subkey, number in rows:
+            if number is True:
+                counts[key] = counts.get(key, 0) + 1
+
+        try:
+            clusto.begin_transaction()
+
+            numbers = {}
+            for key, count in counts.iteritems():
+                counter = Counter.get(self.entity, key, default=-1)
+                numbers[key] = iter(xrange(counter.reserve(count),
+                                           counter.value + 1))
+
+            version = working_version_number()
+            values = []
+            for key, value, subkey, number in rows:
+                if number is True:
+                    number = numbers[key].next()
+                row = Attribute.value_columns(value)
+                row.update(entity_id=self.entity.entity_id, key=key,
+                           subkey=subkey, number=number, version=version)
+                values.append(row)
+                audit_log.info('create attribute entity=%s key=%s subkey=%s value=%s number=%s datatype=%s',
+                               self.name, key, subkey, value, number, row['datatype'])
+
+            execute_bulk(ATTR_TABLE.insert(), values)
+            for row in values:
+                if row['key'] == containment.CONTAINS_KEY and row['relation_id']:
+                    containment.link(row['entity_id'], row['relation_id'])
+            containment.attrs_changed([self.entity.entity_id])
+            drop_attr_cache(self.entity.entity_id)
+            clusto.commit()
+        except Exception, x:
+            clusto.rollback_transaction()
+            raise x
+
+        self.expire()
+
     def del_attrs(self, *args, **kwargs):
         "delete attribute with the given key and value optionally value also"
 
         clusto.flush()
         try:
             clusto.begin_transaction()
-            for i in self.attr_query(*args, **kwargs):
-                i.delete()
+            query = self.attr_query(return_query=True, *args, **kwargs)
+            count = Attribute.delete_matching(query)
+            audit_log.info('delete attributes entity=%s count=%d filter=%s %s',
+                           self.name, count, args, kwargs)
             clusto.commit()
             self.expire(*args, **kwargs)
         except Exception, x:
@@ -642,32 +816,61 @@ class Driver(object):
 
         return attr
 
+    def set_attrs(self, attrs):
+        """replace many attributes at once
+
+        attrs is a dict mapping either a key or a (key, subkey) tuple to the
+        new value.  Like set_attr, unchanged values are left alone and
+        attributes are replaced otherwise, but current values are read once
+        and all the new values are written with add_attrs.
+        """
+
+        current = self.attrs(ignore_hidden=False, sort_by_keys=False)
+
+        deletes = []
+        adds = []
+        for keytuple, value in attrs.iteritems():
+            if isinstance(keytuple, tuple):
+                key, subkey = keytuple
+            else:
+                key, subkey = keytuple, None
+            self._check_attr_name(key)
+
+            matches = self.attr_filter(current, key=key, subkey=subkey,
+                                       number=False, ignore_hidden=False,
+                                       sort_by_keys=False)
+
+            if len(matches) > 1:
+                raise DriverException("cannot set an attribute when args match more than one value")
+
+            if matches:
+                if matches[0].value == value:
+                    continue
+                deletes.extend(matches)
+
+            adds.append((key, value, subkey))
+
+        if not adds:
+            return
+
+        try:
+            clusto.begin_transaction()
+            for attr in deletes:
+                attr.delete()
+            self.add_attrs(adds)
+            clusto.commit()
+        except Exception, x:
+            clusto.rollback_transaction()
+            raise x
+
     def expire(self, *args, **kwargs):
-        """Expires the memcache value (if using memcache) of this object"""
-
-        key = None
-        if 'key' in kwargs:
-            key = kwargs['key']
-        subkey = None
-        if 'subkey' in kwargs:
-            subkey = kwargs['subkey']
-        if clusto.SESSION.memcache:
-            attrs = self.attrs(key=key, subkey=subkey)
-            memcache_keys = []
-            for attr in attrs:
-                mk = self.name
-                mk += '.%s' % attr.key
-                if subkey is None:
-                    memcache_keys.append(str(mk))
-                if attr.subkey:
-                    mk += '.%s' % attr.subkey
-                memcache_keys.append(str(mk))
-            memcache_keys = set(memcache_keys)
-            for mk in memcache_keys:
-                logging.debug('Expiring %s' % mk)
-                clusto.SESSION.memcache.delete(mk)
-        else:
-            logging.debug('Not using memcache, not expiring anything.')
+        """Expires the cached attributes (if using a cache) of this object
+
+        Arguments are accepted for compatibility, everything cached for the
+        entity is expired.
+        """
+
+        clusto.cache.invalidate([self.entity.entity_id])
 
     def has_attr(self, *args, **kwargs):
         """return True if this list has an attribute with the given key"""
@@ -730,22 +933,40 @@ class Driver(object):
         return attrs
 
     def _get_contents(self, *args, **kwargs):
-        contents_entity_ids = [attr.relation_id for attr in self.content_attrs(*args, **kwargs)]
-
-        # sqlalchemy generates a bad query if you pass an empty list to an in_
-        # clause
-        contents_entities = []
-        if contents_entity_ids:
-            # Query for 500 elements at a time
-            for batch_iterator in batch(contents_entity_ids, 500):
-                contents_entities.extend(Entity.query().filter(
-                    Entity.entity_id.in_(list(batch_iterator))).all())
-        else:
-            contents_entities = []
-        contents = [Driver(e) for e in contents_entities]
+        content_attrs = self.content_attrs(*args, **kwargs)
+        contents_entities = entities_by_id([attr.relation_id for attr in content_attrs
+                                            if attr.relation_id is not None])
+
+        contents = []
+        seen = set()
+        for attr in content_attrs:
+            if attr.relation_id is None:
+                # the attribute isn't flushed yet (inside clusto.batch()), so
+                # only the related object is set
+                entity = attr.relation_value
+            else:
+                entity = contents_entities.get(attr.relation_id)
+            if entity is None or id(entity) in seen:
+                continue
+            seen.add(id(entity))
+            contents.append(Driver(entity))
 
         return contents
 
+    def _get_all_contents(self, clusto_types=None, clusto_drivers=None):
+        query = Entity.query().filter(Entity.entity_id.in_(
+            containment.descendants(self.entity.entity_id)))
+
+        if clusto_types:
+            ctl = [clusto.get_type_name(n) for n in clusto_types]
+            query = query.filter(Entity.type.in_(ctl))
+
+        if clusto_drivers:
+            cdl = [clusto.get_driver_name(n) for n in clusto_drivers]
+            query = query.filter(Entity.driver.in_(cdl))
+
+        return [Driver(e) for e in query.order_by(Entity.entity_id)]
+
     def contents(self, *args, **kwargs):
         """Return the contents of this Entity.  Such that:
 
@@ -754,6 +975,9 @@ class Driver(object):
         >>> A.contents()
         [B, C]
 
+        With search_children=True the whole subtree is returned.  When only
+        clusto_types/clusto_drivers filters are given and the database
+        supports it, that is done with a single recursive query.
         """
 
         if 'search_children' in kwargs:
@@ -761,6 +985,11 @@ class Driver(object):
         else:
             search_children = False
 
+        if search_children and not args \
+                and set(kwargs) <= set(['clusto_types', 'clusto_drivers']) \
+                and containment.in_database():
+            return self._get_all_contents(**kwargs)
+
         contents = self._get_contents(*args, **kwargs)
 
         if search_children:
@@ -793,7 +1022,10 @@ class Driver(object):
 
         search_parents = kwargs.pop('search_parents', False)
 
-        if search_parents:
+        if search_parents \
+                and set(kwargs) <= set(['clusto_types', 'clusto_drivers']):
+            parents = [d for d, depth in self.ancestors(**kwargs)]
+        elif search_parents:
             parents = self.parents(**kwargs)
             allparents = self.parents()
             for thing in allparents:
@@ -806,6 +1038,41 @@ class Driver(object):
 
         return parents
 
+    def ancestors(self, clusto_types=None, clusto_drivers=None):
+        """Return (Thing, depth) tuples for every Thing above _this_ Thing.
+
+        Direct parents have a depth of 1, their parents 2 and so on.  The
+        nearest ancestors come first and each one is only listed once.  When
+        the database supports it this is a single recursive query with the
+        filters applied in the database.
+        """
+
+        ctl = [clusto.get_type_name(n) for n in clusto_types or ()]
+        cdl = [clusto.get_driver_name(n) for n in clusto_drivers or ()]
+
+        if containment.in_database():
+            return [(Driver(e), depth) for e, depth in
+                    containment.ancestor_entities(self.entity.entity_id,
+                                                  clusto_types=ctl,
+                                                  clusto_drivers=cdl)]
+
+        depths = {}
+        level = [self]
+        depth = 0
+        while level:
+            depth += 1
+            nextlevel = []
+            for thing in level:
+                for parent in thing.parents():
+                    if parent not in depths:
+                        depths[parent] = depth
+                        nextlevel.append(parent)
+            level = nextlevel
+
+        result = [(d, depth) for d, depth in depths.iteritems()
+                  if (not ctl or d.type in ctl) and (not cdl or d.driver in cdl)]
+        return sorted(result, key=lambda x: (x[1], x[0].name))
+
     def siblings(self, parent_filter=None, parent_kwargs=None,
                  additional_pools=None, **kwargs):
         """Return a list of Things that have the same parents as me.
@@ -1,7 +1,11 @@
 
 import clusto
-from clusto.schema import select, and_, ATTR_TABLE, Attribute, func, Counter
-from clusto.drivers.base import Driver, ClustoMeta
+from clusto.schema import select, and_, ATTR_TABLE, Attribute, func, Counter, SESSION
+from clusto.schema import audit_log, execute_bulk, working_version_number
+from clusto.schema import drop_attr_cache, COUNTER_TABLE
+from clusto.util import batch
+from clusto import containment
+from clusto.drivers.base import Driver
 from clusto.exceptions import ResourceTypeException, ResourceNotAvailableException, ResourceException
 
 
@@ -114,6 +118,26 @@ class ResourceManager(Driver):
         pass
 
 
+    def additional_attr_rows(self, thing, resource, number):
+        """Return the attributes additional_attrs() adds for allocate_many().
+
+        They are (key, value, subkey, number) tuples.  None means there is
+        no such list and additional_attrs() is called for every thing.
+        """
+        return None
+
+
+    def allocator_many(self, count, things=()):
+        """return count unused resources from this resource manager.
+
+        Managers that can hand out many resources at once should override
+        this, the default calls allocator() for each one.
+        """
+
+        things = list(things) or [None] * count
+        return [self.allocator(thing) for thing in things]
+
+
     def post_automatic_allocation(self, thing, resource, number):
         pass
 
@@ -122,6 +146,69 @@ class ResourceManager(Driver):
         pass
 
     
+    def _reserve_numbers(self, counts):
+        """Reserve attribute numbers for new resources of some entities.
+
+        counts maps Entities to how many numbers each of them needs.
+        Returns a dict of entity_id to the first of that many consecutive
+        numbers.
+
+        The numbers only have to be unique among an entity's attributes
+        with this manager's key, so they come from the entity's own counter
+        for the key, the one add_attr(number=True) uses.  Allocations for
+        different entities never wait on the same counter row.  Numbers
+        always start after the highest number the entity already has for
+        the key, and counters that don't exist yet are created with one
+        insert.
+        """
+
+        key = unicode(self._attr_name)
+        counts = dict((entity.entity_id, count)
+                      for entity, count in counts.iteritems())
+
+        counters = {}
+        for chunk in batch(counts.keys(), 500):
+            for counter in Counter.query().filter(and_(
+                    Counter.entity_id.in_(list(chunk)),
+                    Counter.attr_key == key)):
+                counters[counter.entity_id] = counter
+
+        highest = {}
+        for chunk in batch(counts.keys(), 500):
+            query = select([ATTR_TABLE.c.entity_id, func.max(ATTR_TABLE.c.number)],
+                           and_(ATTR_TABLE.c.entity_id.in_(list(chunk)),
+                                ATTR_TABLE.c.key == key)
+                           ).group_by(ATTR_TABLE.c.entity_id)
+            highest.update((entity_id, number) for entity_id, number
+                           in SESSION.execute(query))
+
+        first = {}
+        for entity_id, counter in counters.iteritems():
+            start = highest.get(entity_id)
+            if start is not None and counter.value < start:
+                # numbers handed out by the old global counter or given
+                # explicitly can be ahead of the entity's counter
+                counter.value = start
+                SESSION.flush()
+            first[entity_id] = counter.reserve(counts[entity_id])
+
+        missing = [entity_id for entity_id in counts if entity_id not in counters]
+        rows = []
+        for entity_id in missing:
+            start = highest.get(entity_id)
+            if start is None:
+                start = -1
+            first[entity_id] = start + 1
+            rows.append(dict(entity_id=entity_id, attr_key=key,
+                             value=start + counts[entity_id]))
+
+        if rows:
+            execute_bulk(COUNTER_TABLE.insert(), rows)
+            audit_log.info('create counters attr_key=%s count=%d', key, len(rows))
+
+        return first
+
+
     def allocate(self, thing, resource=(), number=True, force=False):
         """allocates a resource element to the given thing.
 
@@ -152,12 +239,11 @@ class ResourceManager(Driver):
 
             if self._record_allocations:
                 if number == True:
-                    c = Counter.get(ClustoMeta().entity, self._attr_name)
+                    first = self._reserve_numbers({thing.entity: 1})
                     attr = thing.add_attr(self._attr_name,
                                           resource,
-                                          number=c.value
+                                          number=first[thing.entity.entity_id]
                                           )
-                    c.next()
                 else:
                     attr = thing.add_attr(self._attr_name, resource, number=number)
                     
@@ -187,6 +273,123 @@ class ResourceManager(Driver):
         return attr #resource
 
 
+    def allocate_many(self, things, resources=None, number=True, force=False):
+        """allocates a resource element to each of the given things.
+
+        This is what calling allocate() for every thing does, but the
+        resources are reserved at once and all the attributes are written
+        with a single multi-row insert.
+
+        resources - a list of resources for the things, in the same order.
+                    If it isn't given new resources are allocated.
+
+        returns the resource attributes in the same order as things.
+        """
+
+        things = list(things)
+        auto_allocated = resources is None
+
+        try:
+            clusto.begin_transaction()
+            for thing in things:
+                if not isinstance(thing, Driver):
+                    raise TypeError("thing is not of type Driver")
+
+            if not things:
+                clusto.commit()
+                return []
+
+            if auto_allocated:
+                allocated = self.allocator_many(len(things), things)
+            else:
+                resources = list(resources)
+                if len(resources) != len(things):
+                    raise ResourceException("%d resources given for %d things."
+                                            % (len(resources), len(things)))
+
+                allocated = [self.ensure_type(resource, number, thing)
+                             for thing, resource in zip(things, resources)]
+                if len(set(resource for resource, n in allocated)) != len(allocated):
+                    raise ResourceException("The same resource was given more than once.")
+                if not force:
+                    for (resource, n), thing in zip(allocated, things):
+                        if not self.available(resource, n, thing):
+                            raise ResourceException("Requested resource %s is not available."
+                                                    % str(resource))
+
+            if not self._record_allocations:
+                clusto.commit()
+                return [None] * len(things)
+
+            numbers = [None if n is False or n is () else n
+                       for resource, n in allocated]
+            counts = {}
+            for thing, n in zip(things, numbers):
+                if n is True:
+                    counts[thing.entity] = counts.get(thing.entity, 0) + 1
+            if counts:
+                reserved = self._reserve_numbers(counts)
+                for i, (thing, n) in enumerate(zip(things, numbers)):
+                    if n is True:
+                        numbers[i] = reserved[thing.entity.entity_id]
+                        reserved[thing.entity.entity_id] += 1
+
+            version = working_version_number()
+            rows = []
+            callbacks = []
+            for thing, (resource, n), number in zip(things, allocated, numbers):
+                attrs = [(self._attr_name, resource, None, number),
+                         (self._attr_name, self.entity, u'manager', number)]
+                additional = self.additional_attr_rows(thing, resource, number)
+                if additional is None:
+                    callbacks.append((thing, resource, number))
+                else:
+                    attrs.extend(additional)
+
+                for key, value, subkey, num in attrs:
+                    row = Attribute.value_columns(value)
+                    row.update(entity_id=thing.entity.entity_id,
+                               key=unicode(key), subkey=subkey, number=num,
+                               version=version)
+                    rows.append(row)
+
+            execute_bulk(ATTR_TABLE.insert(), rows)
+            audit_log.info('allocate resources manager=%s key=%s count=%d attrs=%d',
+                           self.name, self._attr_name, len(things), len(rows))
+
+            entity_ids = [thing.entity.entity_id for thing in things]
+            containment.attrs_changed(entity_ids)
+            for entity_id in set(entity_ids + [self.entity.entity_id]):
+                drop_attr_cache(entity_id)
+
+            for thing, resource, number in callbacks:
+                self.additional_attrs(thing, resource, number)
+
+            clusto.commit()
+        except Exception, x:
+            clusto.rollback_transaction()
+            raise
+
+        clusto.cache.invalidate(entity_ids)
+
+        found = {}
+        for chunk in batch(list(set(entity_ids)), 500):
+            query = Attribute.query().filter(and_(
+                    Attribute.entity_id.in_(list(chunk)),
+                    Attribute.key == self._attr_name,
+                    Attribute.subkey == None))
+            for attr in query:
+                found[(attr.entity_id, attr.number)] = attr
+
+        for thing, (resource, n), number in zip(things, allocated, numbers):
+            if auto_allocated:
+                self.post_automatic_allocation(thing, resource, n)
+            self.post_allocation(thing, resource, n)
+
+        return [found.get((entity_id, number))
+                for entity_id, number in zip(entity_ids, numbers)]
+
+
     def deallocate(self, thing, resource=(), number=True):
         """deallocates a resource from the given thing."""
 
@@ -264,7 +467,17 @@ class ResourceManager(Driver):
 
     @property
     def count(self):
-        """Return the number of resources used."""
+        """Return the number of resources used.
+
+        The manager back-references are counted in the database rather
+        than loaded.
+        """
 
-        return len(self.references(self._attr_name, self, subkey='manager'))
+        clusto.flush()
+        query = select([func.count(ATTR_TABLE.c.attr_id)],
+                       and_(ATTR_TABLE.c.key == self._attr_name,
+                            ATTR_TABLE.c.subkey == 'manager',
+                            ATTR_TABLE.c.relation_id == self.entity.entity_id,
+                            *Attribute._version_args()))
+        return SESSION.execute(query).scalar()
 
@@ -1,4 +1,6 @@
 from clusto.drivers.base import Driver
+from clusto.drivers.base.clustodriver import DRIVERLIST
+from clusto import containment
 from clusto.schema import *
 
 from clusto.exceptions import PoolException
@@ -56,6 +58,8 @@ class Pool(Driver):
 
         d = cls.ensure_driver(obj, "obj must be either an Entity or a Driver.")
 
+        if allPools and containment.use_cte():
+            return cls._get_all_pools(d)
 
         pools = [Driver(a.entity) for a in d.parents()
                  if isinstance(Driver(a.entity), Pool)]
@@ -66,6 +70,42 @@ class Pool(Driver):
 
         return pools
 
+    @classmethod
+    def _get_all_pools(cls, d):
+        """Same result as get_pools(d, allPools=True) using two queries.
+
+        The ancestor pools are fetched with one recursive query and the
+        '_contains' attributes between them with another, then the recursion
+        of get_pools is replayed in memory so the order (and repetition) of
+        the result doesn't change.
+        """
+
+        names = [name for name, driver in DRIVERLIST.iteritems()
+                 if issubclass(driver, Pool)]
+        pools = dict((e.entity_id, Driver(e)) for e, depth in
+                     containment.ancestor_entities(d.entity.entity_id,
+                                                   clusto_drivers=names,
+                                                   through_drivers=names))
+        if not pools:
+            return []
+
+        parents = {}
+        attrs = Attribute.query().filter(and_(
+            Attribute.key == u'_contains',
+            Attribute.entity_id.in_(pools.keys()),
+            Attribute.relation_id.in_(pools.keys() + [d.entity.entity_id]))
+            ).order_by(Attribute.attr_id)
+        for attr in attrs:
+            parents.setdefault(attr.relation_id, []).append(pools[attr.entity_id])
+
+        def walk(entity_id):
+            result = list(parents.get(entity_id, []))
+            for i in result:
+                result.extend(walk(i.entity.entity_id))
+            return result
+
+        return walk(d.entity.entity_id)
+
 class ExclusivePool(Pool):
     _driver_name = "exclusive_pool"
 
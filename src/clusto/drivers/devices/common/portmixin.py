@@ -224,10 +224,22 @@ class PortMixin:
 
         portinfo = {}
         for ptype in self.port_types:
+            # read all the port attributes at once instead of once per port
+            values = {}
+            for attr in self.attrs(key=self._port_key(ptype)):
+                if attr.subkey in ('connection', 'otherportnum'):
+                    values.setdefault((attr.number, attr.subkey), []).append(attr)
+
             portinfo[ptype]={}
             for n in range(1, self._portmeta[ptype]['numports'] + 1):
-                portinfo[ptype][n] = {'connection': self.get_port_attr(ptype, n, 'connection'),
-                                      'otherportnum': self.get_port_attr(ptype, n, 'otherportnum')}
+                portinfo[ptype][n] = {}
+                for key in ('connection', 'otherportnum'):
+                    attr = values.get((n, key), [])
+                    if len(attr) > 1:
+                        raise ConnectionException("Somehow more than one attribute named "
+                                                  "%s is associated with port %s:%d on %s"
+                                                  % (key, ptype, n, self.name))
+                    portinfo[ptype][n][key] = attr[0].value if attr else None
 
         return portinfo
 
@@ -1,10 +1,176 @@
 import clusto
-from clusto.schema import Attribute
+from clusto.schema import Attribute, ATTR_TABLE, Entity, ENTITY_TABLE, \
+    SESSION, select, and_, func, ENTITY_RECORD_COLUMNS, entity_records, \
+    raw_attrs, entities_by_id
 
 from clusto.drivers.base import ResourceManager, ResourceTypeException, Driver
+from clusto.drivers.base.clustodriver import DRIVERLIST
 from clusto.exceptions import ResourceNotAvailableException, ResourceException
 
 import IPy
+import bisect
+import threading
+
+
+class SubnetIndex(object):
+    """A longest-prefix-match index of the subnets managed by ipmanagers.
+
+    It is built from one query of the ipmanager entities and their baseip
+    and netmask properties.  Before every lookup the number and highest id
+    of those rows are compared to what the index was built from, so it is
+    rebuilt whenever an ipmanager or one of its subnet properties is added,
+    changed or deleted, by this process or any other.
+    """
+
+    KEYS = ('baseip', 'netmask')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        # (ip version, prefixlen) to network number to [(EntityRecord, IPy)]
+        self._networks = {}
+        # the keys of _networks, longest prefix first
+        self._prefixes = []
+        # managers without a baseip take any ip
+        self._anywhere = []
+
+    def _driver_names(self):
+        return [name for name, driver in DRIVERLIST.iteritems()
+                if issubclass(driver, IPManager)]
+
+    def _entity_clause(self, names):
+        return and_(ENTITY_TABLE.c.driver.in_(names), *Entity._version_args())
+
+    def _attr_clause(self, names, keys=KEYS):
+        entity_ids = select([ENTITY_TABLE.c.entity_id],
+                            self._entity_clause(names))
+        return and_(ATTR_TABLE.c.entity_id.in_(entity_ids),
+                    ATTR_TABLE.c.key.in_(keys),
+                    ATTR_TABLE.c.subkey == 'property')
+
+    def _signature(self, names):
+        managers = select([func.count(ENTITY_TABLE.c.entity_id),
+                           func.max(ENTITY_TABLE.c.entity_id)],
+                          self._entity_clause(names))
+        props = select([func.count(ATTR_TABLE.c.attr_id),
+                        func.max(ATTR_TABLE.c.attr_id)],
+                       and_(self._attr_clause(names), *Attribute._version_args()))
+        return tuple(SESSION.execute(managers).fetchone()) + \
+            tuple(SESSION.execute(props).fetchone())
+
+    def _build(self, names):
+        records = entity_records(select(ENTITY_RECORD_COLUMNS,
+                                        self._entity_clause(names))
+                                 .order_by(ENTITY_TABLE.c.entity_id))
+        props = dict(((attr.entity_id, attr.key), attr.value)
+                     for attr in raw_attrs(self._attr_clause(names)))
+
+        networks = {}
+        anywhere = []
+        for record in records:
+            defaults = DRIVERLIST[record.driver]._properties
+            baseip, netmask = [props.get((record.entity_id, key), defaults[key])
+                               for key in self.KEYS]
+            if baseip is None:
+                anywhere.append((record, None))
+                continue
+
+            try:
+                ipy = IPy.IP('%s/%s' % (baseip, netmask), make_net=True)
+            except ValueError:
+                continue
+
+            prefix = (ipy.version(), ipy.prefixlen())
+            network = ipy.int() >> (self._bits(ipy) - ipy.prefixlen())
+            networks.setdefault(prefix, {}).setdefault(network, []).append((record, ipy))
+
+        self._networks = networks
+        self._prefixes = sorted(networks, key=lambda p: p[1], reverse=True)
+        self._anywhere = anywhere
+
+    def _bits(self, ipy):
+        return 32 if ipy.version() == 4 else 128
+
+    def refresh(self):
+        """Rebuild the index if the ipmanagers changed since it was built."""
+
+        clusto.flush()
+        names = self._driver_names()
+        key = (SESSION.bind, SESSION.clusto_version, self._signature(names))
+        with self._lock:
+            if key != self._key:
+                self._build(names)
+                self._key = key
+
+    def lookup(self, ip):
+        """Return (EntityRecord, IPy) pairs of the ipmanagers an IPy ip is in.
+
+        The most specific subnets come first and managers without a baseip
+        last, the IPy is None for those.
+        """
+
+        self.refresh()
+        with self._lock:
+            networks, prefixes, anywhere = (self._networks, self._prefixes,
+                                            self._anywhere)
+
+        bits = self._bits(ip)
+        found = []
+        for version, prefixlen in prefixes:
+            if version != ip.version() or prefixlen > ip.prefixlen():
+                continue
+            network = ip.int() >> (bits - prefixlen)
+            found.extend(networks[(version, prefixlen)].get(network, []))
+        return found + anywhere
+
+    def subnets(self):
+        """Return (EntityRecord, IPy) pairs of every ipmanager with a baseip."""
+
+        self.refresh()
+        with self._lock:
+            networks = self._networks
+
+        found = [pair for managers in networks.itervalues()
+                 for pairs in managers.itervalues() for pair in pairs]
+        return sorted(found, key=lambda pair: pair[0].entity_id)
+
+    def properties(self, key):
+        """Return a dict of entity_id to the key property of the ipmanagers.
+
+        Only the managers that have the property set are in it.
+        """
+
+        return dict((attr.entity_id, attr.value) for attr in
+                    raw_attrs(self._attr_clause(self._driver_names(), (key,))))
+
+
+SUBNETS = SubnetIndex()
+
+
+def free_ranges(first, last, used, reserved=()):
+    """Return the (first, last) ranges between first and last that are free.
+
+    used is a sorted list of the ints in use between first and last, ints in
+    reserved are never free either.  used is walked once.
+    """
+
+    taken = list(used)
+    for ip in reserved:
+        if first <= ip <= last:
+            i = bisect.bisect_left(taken, ip)
+            if i == len(taken) or taken[i] != ip:
+                taken.insert(i, ip)
+
+    ranges = []
+    ip = first
+    for usedip in taken:
+        if usedip > ip:
+            ranges.append((ip, usedip - 1))
+        ip = usedip + 1
+    if ip <= last:
+        ranges.append((ip, last))
+    return ranges
+
 
 class IPManager(ResourceManager):
     """Resource Manager for IP spaces
@@ -38,92 +204,253 @@ class IPManager(ResourceManager):
         net = ip.make_net(netmask)
         return '%s/%i' % (ip.strNormal(), net.prefixlen())
 
+    def __setattr__(self, name, value):
+        if name in SubnetIndex.KEYS:
+            self.__dict__.pop('_ipy', None)
+        ResourceManager.__setattr__(self, name, value)
+
+    def _network(self):
+        """Return the IPy network of this manager, None if it has no baseip."""
+
+        if '_ipy' not in self.__dict__:
+            ipy = None
+            if self.baseip:
+                ipy = IPy.IP(''.join([u'%s' % str(self.baseip), '/',
+                                      u'%s' % self.netmask]), make_net=True)
+            self.__dict__['_ipy'] = ipy
+
+        return self.__dict__['_ipy']
+
     @property
     def ipy(self):
-        if not hasattr(self, '__ipy'):
-
-            self.__ipy = IPy.IP(''.join([u'%s' % str(self.baseip), '/', 
-                                u'%s' % self.netmask]), make_net=True)
+        ipy = self._network()
+        if ipy is None:
+            raise ResourceTypeException("The ipManager %s has no baseip" % self.name)
 
+        return ipy
 
-        return self.__ipy
+    @classmethod
+    def _to_ipy(cls, ip):
+        if isinstance(ip, (int, long)):
+            return cls._int_to_ipy(ip)
+        return IPy.IP(ip)
 
     def ensure_type(self, resource, number=True, thing=None):
         """check that the given ip falls within the range managed by this manager"""
 
         try:
-            if isinstance(resource, int):
-                ip = self._int_to_ipy(resource)
-            else:
-                ip = IPy.IP(resource)
+            ip = self._to_ipy(resource)
         except ValueError:
             raise ResourceTypeException("%s is not a valid ip."
                                         % resource)
 
-        if self.baseip and (ip not in self.ipy):
+        network = self._network()
+        if network is not None and (ip not in network):
             raise ResourceTypeException(u"The ip %s is out of range for this IP manager.  Should be in %s/%s"
-                                        % (str(ip), self.baseip, self.netmask))
+                                        % (str(ip), network.net(), network.netmask()))
 
 
         return (self._ipy_to_int(ip), number)
 
 
-    def additional_attrs(self, thing, resource, number):
+    def additional_attr_rows(self, thing, resource, number):
 
         resource, number = self.ensure_type(resource, number)
 
-        thing.add_attr(self._attr_name, number=number, subkey='ipstring', value=str(self._int_to_ipy(resource)))
-        thing.add_attr(self._attr_name, number=number, subkey='cidr', value=str(self._int_to_cidr(resource, self.netmask)))
+        network = self._network()
+        if network is not None:
+            netmask = network.netmask()
+        else:
+            netmask = self.netmask
+
+        return [(self._attr_name, str(self._int_to_ipy(resource)), u'ipstring', number),
+                (self._attr_name, str(self._int_to_cidr(resource, netmask)), u'cidr', number)]
+
+    def additional_attrs(self, thing, resource, number):
+
+        for key, value, subkey, number in self.additional_attr_rows(thing, resource, number):
+            thing.add_attr(key, number=number, subkey=subkey, value=value)
         
                      
+    def _ip_range(self):
+        """Return the first and last usable ips of this manager as ints."""
+
+        first = self._ipy_to_int(self.ipy.net()) + 1
+        last = self._ipy_to_int(self.ipy.broadcast()) - 1
+        return first, last
+
+    def _used_ips(self, first, last):
+        """Return the sorted ints of the ips between first and last in use.
+
+        They're read with a single range query on int_value instead of
+        checking every address with available().
+        """
+
+        clusto.flush()
+        column = ATTR_TABLE.c.int_value
+        query = select([column],
+                       and_(ATTR_TABLE.c.key == self._attr_name,
+                            column >= first, column <= last,
+                            *Attribute._version_args())).distinct().order_by(column)
+        return [row[0] for row in SESSION.execute(query)]
+
+    def _free_ips(self, count=1):
+        """Return up to count free ips of this manager as ints.
+
+        The search starts after the last ip handed out and wraps around to
+        the beginning of the range once, skipping the gateway.  Only the
+        gaps between the used ips are walked, so a nearly full subnet costs
+        as much as an empty one.
+        """
+
+        first, last = self._ip_range()
+        if first > last:
+            return []
+
+        start = first
+        lastip = self.attr_values('_lastip')
+        if lastip and first <= lastip[0] <= last:
+            start = lastip[0]
+
+        if self.gateway:
+            gateway = self._ipy_to_int(IPy.IP(self.gateway))
+        else:
+            gateway = None
+
+        used = self._used_ips(first, last)
+        free = []
+
+        for lo, hi in ((start, last), (first, start - 1)):
+            ip = lo
+            for usedip in used[bisect.bisect_left(used, lo):] + [hi + 1]:
+                usedip = min(usedip, hi + 1)
+                while ip < usedip:
+                    if ip != gateway:
+                        free.append(ip)
+                        if len(free) == count:
+                            return free
+                    ip += 1
+                ip = usedip + 1
+                if ip > hi:
+                    break
+
+        return free
+
+    @classmethod
+    def _utilization(cls, name, ipy, gateway, used):
+        first = cls._ipy_to_int(ipy.net()) + 1
+        last = cls._ipy_to_int(ipy.broadcast()) - 1
+        size = max(last - first + 1, 0)
+
+        reserved = []
+        if gateway:
+            reserved.append(cls._ipy_to_int(IPy.IP(gateway)))
+
+        lo = bisect.bisect_left(used, first)
+        hi = bisect.bisect_right(used, last)
+        ranges = free_ranges(first, last, used[lo:hi], reserved)
+        lengths = [b - a + 1 for a, b in ranges]
+        free = sum(lengths)
+
+        return {'name': name,
+                'subnet': ipy.strNormal(),
+                'size': size,
+                'used': hi - lo,
+                'free': free,
+                'utilization': float(size - free) / size if size else 1.0,
+                'largest_free': max(lengths) if lengths else 0,
+                'free_ranges': [(str(cls._int_to_ipy(a)), str(cls._int_to_ipy(b)))
+                                for a, b in ranges]}
+
+    def utilization(self):
+        """Return a dict describing how much of this manager's subnet is used.
+
+        The keys are name, subnet, size (the number of usable ips), used,
+        free, utilization (the fraction of ips that aren't free),
+        largest_free (the size of the largest free range) and free_ranges,
+        a list of (first ip, last ip) strings.  The gateway is never free.
+
+        Managers without a baseip have no subnet to report on and raise
+        ResourceTypeException.
+        """
+
+        if self._network() is None:
+            raise ResourceTypeException("The ipManager %s has no baseip, so "
+                                        "it has no utilization" % self.name)
+
+        first, last = self._ip_range()
+        return self._utilization(self.name, self.ipy, self.gateway,
+                                 self._used_ips(first, last))
+
+    @classmethod
+    def utilization_report(cls, over=None):
+        """Return utilization() of every ipmanager with an IPv4 subnet.
+
+        The used ips of all the managers are read with a single query and
+        split up between the subnets, so this costs the same few queries no
+        matter how many managers there are.  If over is given only the
+        managers with at least that utilization are returned.  The report
+        is sorted by name.
+        """
+
+        subnets = [(record, ipy) for record, ipy in SUBNETS.subnets()
+                   if ipy.version() == 4]
+        if not subnets:
+            return []
+
+        gateways = SUBNETS.properties('gateway')
+
+        column = ATTR_TABLE.c.int_value
+        query = select([column],
+                       and_(ATTR_TABLE.c.key == cls._attr_name,
+                            column != None,
+                            *Attribute._version_args())).distinct().order_by(column)
+        used = [row[0] for row in SESSION.execute(query)]
+
+        report = []
+        for record, ipy in subnets:
+            gateway = gateways.get(record.entity_id,
+                                   DRIVERLIST[record.driver]._properties.get('gateway'))
+            result = cls._utilization(record.name, ipy, gateway, used)
+            if over is None or result['utilization'] >= over:
+                report.append(result)
+
+        return sorted(report, key=lambda result: result['name'])
+
     def allocator(self, thing=None):
         """allocate IPs from this manager"""
 
         if self.baseip is None:
             raise ResourceTypeException("Cannot generate an IP for an ipManager with no baseip")
 
-        lastip = self.attr_query('_lastip')
-                
-        if not lastip:
-            # I subtract self._int_ip_const to keep in int range
-            startip=int(self.ipy.net().int() + 1) - self._int_ip_const 
-        else:
-            startip = lastip[0].value
+        free = self._free_ips()
+        if not free:
+            raise ResourceNotAvailableException("out of available ips.")
 
+        self.set_attr('_lastip', free[0])
+        return self.ensure_type(free[0], True)
 
-        
-        ## generate new ips the slow naive way
-        nextip = int(startip)
-        if self.gateway:
-            gateway = IPy.IP(self.gateway).int() - self._int_ip_const
-        else:
-            gateway = None
-        endip = self.ipy.broadcast().int() - self._int_ip_const
-
-        for i in range(2):
-            while nextip < endip:
-
-                if nextip == gateway:
-                    nextip += 1
-                    continue
-
-                if self.available(nextip):
-                    self.set_attr('_lastip', nextip)
-                    return self.ensure_type(nextip, True)
-                else:
-                    nextip += 1
-            
-            # check from the beginning again in case an earlier ip
-            # got freed
-                    
-            nextip = int(self.ipy.net().int() + 1)
-            
-        raise ResourceNotAvailableException("out of available ips.")
+    def allocator_many(self, count, things=()):
+        """allocate count IPs from this manager at once"""
+
+        if self.baseip is None:
+            raise ResourceTypeException("Cannot generate an IP for an ipManager with no baseip")
+
+        free = self._free_ips(count)
+        if len(free) < count:
+            raise ResourceNotAvailableException("out of available ips, %d free and %d requested."
+                                                % (len(free), count))
+
+        self.set_attr('_lastip', free[-1])
+        return [self.ensure_type(ip, True) for ip in free]
 
     @classmethod
     def get_ip_managers(cls, ip):
         """return a list of valid ip managers for the given ip.
 
+        The managers are looked up in the SubnetIndex and the ones with the
+        most specific subnet come first.
+
         @param ip: the ip
         @type ip: integer, string, or IPy object
 
@@ -134,19 +461,31 @@ class IPManager(ResourceManager):
             ipman = ip.entity
             return Driver(ipman)
 
+        try:
+            ip = cls._to_ipy(ip)
+        except ValueError:
+            return []
+
+        found = [(record, ipy) for record, ipy in SUBNETS.lookup(ip)
+                 if record.driver == cls._driver_name]
+        entities = entities_by_id([record.entity_id for record, ipy in found])
+
         ipmanagers = []
-        for ipman in clusto.get_entities(clusto_drivers=[cls]):
-            try:
-                ipman.ensure_type(ip)
-                ipmanagers.append(Driver(ipman))
-            except ResourceTypeException:
+        for record, ipy in found:
+            if record.entity_id not in entities:
                 continue
+            ipman = Driver(entities[record.entity_id])
+            ipman.__dict__['_ipy'] = ipy
+            ipmanagers.append(ipman)
         return ipmanagers
 
     @classmethod
     def get_ip_manager(cls, ip):
         """return a valid ip manager for the given ip.
 
+        When subnets overlap the manager of the most specific one is
+        returned.
+
         @param ip: the ip
         @type ip: integer, string, or IPy object
 
@@ -155,7 +494,10 @@ class IPManager(ResourceManager):
         ipman = cls.get_ip_managers(ip)
         if not ipman:
             raise ResourceException("No resource manager for %s exists." % str(ip))
-        if len(ipman) > 1:
+
+        networks = [m._network() for m in ipman[:2]]
+        prefixes = [n.prefixlen() if n is not None else None for n in networks]
+        if len(prefixes) > 1 and prefixes[0] == prefixes[1]:
             raise ResourceException("More than one resource manager matches %s" % str(ip))
         ipman = ipman[0]
         return ipman
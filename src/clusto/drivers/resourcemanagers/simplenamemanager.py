@@ -25,26 +25,44 @@ class SimpleNameManager(ResourceManager):
     _record_allocations = True
     _attr_name = 'simplename'
     
+    def _name(self, value, digits, leadingZeros):
+        num = str(value)
+
+        if leadingZeros:
+            num = num.rjust(digits, '0')
+
+        if len(num) > digits:
+            raise SimpleNameManagerException("Out of digits for the integer. "
+                                             "Max of %d digits and we're at "
+                                             "number %s." % (digits, num))
+
+        return self.basename + num
+
     def allocator(self, thing=None):
         clusto.flush()
 
         counter = clusto.Counter.get(self.entity, 'next', default=self.next)
 
-        num = str(counter.value)
-
-        if self.leadingZeros:
-            num = num.rjust(self.digits, '0')
-
-        if len(num) > self.digits:
-            raise SimpleNameManagerException("Out of digits for the integer. "
-                                             "Max of %d digits and we're at "
-                                             "number %s." % (self.digits, num))
-        
-        nextname = self.basename + num
+        nextname = self._name(counter.value, self.digits, self.leadingZeros)
 
         counter.next()
 
         return (nextname, True)
+
+    def allocator_many(self, count, things=()):
+        clusto.flush()
+
+        counter = clusto.Counter.get(self.entity, 'next', default=self.next)
+
+        digits = self.digits
+        leadingZeros = self.leadingZeros
+        first = counter.value
+        names = [self._name(value, digits, leadingZeros)
+                 for value in xrange(first, first + count)]
+
+        counter.reserve(count)
+
+        return [(name, True) for name in names]
         
 
 class SimpleEntityNameManager(SimpleNameManager):    
@@ -93,6 +111,37 @@ class SimpleEntityNameManager(SimpleNameManager):
         return newobj
 
 
+    def allocate_many(self, clustotype, count_or_names):
+        """create many entities of the given Driver class.
+
+        count_or_names is either the number of entities to create, which
+        get new names from this manager, or a list of their names.  The
+        entities are created with clusto.bulk_create().
+
+        returns the new entities.
+        """
+
+        if not isinstance(clustotype, type):
+            raise TypeError("thing is not a Driver class")
+
+        try:
+            clusto.begin_transaction()
+
+            if isinstance(count_or_names, (int, long)):
+                names = [name for name, num in self.allocator_many(count_or_names)]
+            else:
+                names = list(count_or_names)
+
+            newobjs = clusto.bulk_create(clustotype, names)
+
+            clusto.commit()
+        except Exception, x:
+            clusto.rollback_transaction()
+            raise
+
+        return newobjs
+
+
     def deallocate(self, thing, resource=None, number=True):
         raise Exception("can't deallocate an entity name, delete the entity instead.")
 
@@ -36,3 +36,18 @@ class SimpleNumManager(ResourceManager):
         counter.next()
         return (num, True)
 
+    def allocator_many(self, count, things=()):
+
+        clusto.flush()
+
+        counter = clusto.Counter.get(self.entity, 'next', default=self.next)
+
+        last = counter.value + count - 1
+
+        if self.maxnum and last > self.maxnum:
+            raise SimpleNumManagerException("Out of numbers. "
+                                            "Max of %d reached."
+                                            % (self.maxnum))
+
+        first = counter.reserve(count) - 1
+        return [(num, True) for num in xrange(first, first + count)]
@@ -32,3 +32,7 @@ class PoolException(ClustoException):
 
 class TransactionException(ClustoException):
     pass
+
+class QueryException(ClustoException):
+    """exception for query expressions that can't be parsed"""
+    pass
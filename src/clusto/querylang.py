@@ -0,0 +1,276 @@
+"""
+Query expressions
+
+A small language to select entities, compiled into a single query over the
+entities and entity_attrs tables:
+
+    pool:web & pool:sjc1 & type:server & system.memory>=65536 & !attr:decommissioned
+
+Terms:
+  pool:NAME           entities in the pool NAME, or in pools inside it
+  type:NAME           entities of the clusto type NAME
+  driver:NAME         entities with the driver NAME
+  name:PATTERN        entities whose name matches PATTERN, * is a wildcard
+  attr:KEY[.SUBKEY]   entities with an attribute with that key (and subkey)
+  KEY[.SUBKEY] OP VALUE
+                      entities with such an attribute whose value compares
+                      to VALUE; OP is one of = != < <= > >=
+
+VALUE is an integer, a date (2012-01-31 or 2012-01-31T12:00:00) or a
+string, compared to int_value, datetime_value or string_value respectively.
+Strings with spaces or operator characters can be quoted, and * is a
+wildcard in strings compared with = or !=.  KEY!=VALUE selects entities
+that don't have a matching attribute, the same as !(KEY=VALUE).
+
+Terms are combined with & (and), | (or), ! (not) and parentheses; ! binds
+tighter than &, which binds tighter than |.
+"""
+
+from sqlalchemy import and_, or_, not_, exists
+
+from clusto.schema import ATTR_TABLE, ENTITY_TABLE, Attribute
+from clusto.exceptions import QueryException
+from clusto.drivers import Pool
+from clusto import containment
+
+import clusto
+import datetime
+import re
+
+
+TOKEN_RE = re.compile(r'''\s*(?:
+    (?P<op>>=|<=|!=|=|<|>)
+  | (?P<punct>[&|!()])
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<word>[^\s&|!()=<>"']+)
+  )''', re.VERBOSE)
+
+INT_RE = re.compile(r'^-?\d+$')
+
+DATETIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S')
+
+FIELDS = ('pool', 'type', 'driver', 'name', 'attr')
+
+OPERATORS = {'=': lambda column, value: column == value,
+             '<': lambda column, value: column < value,
+             '<=': lambda column, value: column <= value,
+             '>': lambda column, value: column > value,
+             '>=': lambda column, value: column >= value}
+
+
+def tokenize(expr):
+    """Return the (kind, text) tokens of expr."""
+
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = TOKEN_RE.match(expr, pos)
+        if match is None or match.end() == pos:
+            raise QueryException("Can't parse %r at position %d"
+                                 % (expr, pos))
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'string':
+            text = re.sub(r'\\(.)', r'\1', text[1:-1])
+        tokens.append((kind, text))
+        pos = match.end()
+    return tokens
+
+
+def parse_value(kind, text):
+    """Return the int, datetime or unicode a value token stands for."""
+
+    if kind == 'string':
+        return unicode(text)
+
+    if INT_RE.match(text):
+        return int(text)
+
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+
+    return unicode(text)
+
+
+class Parser(object):
+    """Turns an expression into a tree of tuples:
+
+    ('and', left, right), ('or', left, right), ('not', node),
+    ('pool'|'type'|'driver'|'name', value), ('attr', key, subkey) and
+    ('cmp', key, subkey, op, value); subkey is None when it isn't given.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = tokenize(expr)
+        self.pos = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise QueryException("Empty query")
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            self.error("Unexpected %r" % self.tokens[self.pos][1])
+        return node
+
+    def error(self, message):
+        raise QueryException("%s in %r" % (message, self.expr))
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            self.error("Unexpected end of query")
+        self.pos += 1
+        return token
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.peek() == ('punct', '|'):
+            self.pos += 1
+            node = ('or', node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.peek() == ('punct', '&'):
+            self.pos += 1
+            node = ('and', node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        kind, text = self.next()
+
+        if (kind, text) == ('punct', '!'):
+            return ('not', self.parse_not())
+
+        if (kind, text) == ('punct', '('):
+            node = self.parse_or()
+            if self.next() != ('punct', ')'):
+                self.error("Missing )")
+            return node
+
+        if kind != 'word':
+            self.error("Unexpected %r" % text)
+
+        return self.parse_term(text)
+
+    def parse_term(self, word):
+        field, sep, value = word.partition(':')
+        if sep:
+            if field not in FIELDS:
+                self.error("Unknown field %r" % field)
+            if not value:
+                kind, value = self.next()
+                if kind not in ('word', 'string'):
+                    self.error("Missing value for %s:" % field)
+            if field == 'attr':
+                return ('attr',) + self.split_key(value)
+            return (field, unicode(value))
+
+        key, subkey = self.split_key(word)
+        if self.peek()[0] != 'op':
+            self.error("Missing operator after %r" % word)
+        op = self.next()[1]
+
+        kind, text = self.next()
+        if kind not in ('word', 'string'):
+            self.error("Missing value after %s%s" % (word, op))
+        return ('cmp', key, subkey, op, parse_value(kind, text))
+
+    def split_key(self, text):
+        key, sep, subkey = text.partition('.')
+        if not key:
+            self.error("Missing attribute key in %r" % text)
+        return (unicode(key), unicode(subkey) if sep else None)
+
+
+def parse(expr):
+    """Return the tree of an expression, see Parser."""
+
+    return Parser(expr).parse()
+
+
+def _attr_exists(key, subkey, *args):
+    args = [ATTR_TABLE.c.entity_id == ENTITY_TABLE.c.entity_id,
+            ATTR_TABLE.c.key == key] + list(args) + Attribute._version_args()
+    if subkey is not None:
+        args.append(ATTR_TABLE.c.subkey == subkey)
+    return exists([ATTR_TABLE.c.attr_id], and_(*args))
+
+
+def _like(column, pattern):
+    """Match column against pattern with * as the only wildcard."""
+
+    for char in ('\\', '%', '_'):
+        pattern = pattern.replace(char, '\\' + char)
+    return column.like(pattern.replace('*', '%'), escape='\\')
+
+
+def _pool_members(name):
+    pool = clusto.get_by_name(name)
+    if not isinstance(pool, Pool):
+        raise QueryException("%s is not a pool" % name)
+    if containment.in_database():
+        return ENTITY_TABLE.c.entity_id.in_(
+            containment.members(pool.entity.entity_id, search_children=True))
+
+    entity_ids = [d.entity.entity_id for d in pool.contents(search_children=True)]
+    return ENTITY_TABLE.c.entity_id.in_(entity_ids or [None])
+
+
+def _compare(key, subkey, op, value):
+    if op == '!=':
+        return not_(_compare(key, subkey, '=', value))
+
+    if isinstance(value, basestring):
+        column = ATTR_TABLE.c.string_value
+        if op == '=' and '*' in value:
+            return _attr_exists(key, subkey, _like(column, value))
+    elif isinstance(value, datetime.datetime):
+        column = ATTR_TABLE.c.datetime_value
+    else:
+        column = ATTR_TABLE.c.int_value
+
+    return _attr_exists(key, subkey, OPERATORS[op](column, value))
+
+
+def compile_tree(node):
+    """Return the where clause over the entities table a tree selects."""
+
+    kind = node[0]
+    if kind == 'and':
+        return and_(compile_tree(node[1]), compile_tree(node[2]))
+    if kind == 'or':
+        return or_(compile_tree(node[1]), compile_tree(node[2]))
+    if kind == 'not':
+        return not_(compile_tree(node[1]))
+    if kind == 'pool':
+        return _pool_members(node[1])
+    if kind == 'type':
+        return ENTITY_TABLE.c.type == node[1]
+    if kind == 'driver':
+        return ENTITY_TABLE.c.driver == node[1]
+    if kind == 'name':
+        if '*' in node[1]:
+            return _like(ENTITY_TABLE.c.name, node[1])
+        return ENTITY_TABLE.c.name == node[1]
+    if kind == 'attr':
+        return _attr_exists(node[1], node[2])
+    if kind == 'cmp':
+        return _compare(*node[1:])
+    raise QueryException("Unknown node %r" % (kind,))
+
+
+def compile(expr):
+    """Return the where clause over the entities table an expression selects."""
+
+    return compile_tree(parse(expr))
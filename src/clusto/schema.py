@@ -10,13 +10,19 @@ from sqlalchemy import and_, or_, not_, select, event
 from sqlalchemy.exc import OperationalError
 
 from sqlalchemy.orm import scoped_session, sessionmaker, mapper, relation
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.attributes import instance_state, set_committed_value
 
 import sqlalchemy.sql
 
+import collections
 import logging
 import sys
+import time
 import datetime
 import clusto
+from clusto.util import batch
 from functools import wraps
 
 try:
@@ -28,7 +34,14 @@ except:
 __all__ = ['ATTR_TABLE', 'Attribute', 'and_', 'ENTITY_TABLE', 'Entity', 'func',
            'METADATA', 'not_', 'or_', 'SESSION', 'select', 'VERSION',
            'latest_version', 'CLUSTO_VERSIONING', 'Counter', 'ClustoVersioning',
-           'working_version', 'OperationalError', 'ClustoEmptyCommit']
+           'working_version', 'OperationalError', 'ClustoEmptyCommit',
+           'working_version_number', 'execute_bulk', 'batching',
+           'maybe_flush', 'pending', 'is_pending_delete', 'CLOSURE_TABLE',
+           'EFFECTIVE_ATTRS_TABLE', 'attr_cache', 'attr_cache_stats',
+           'drop_attr_cache', 'reference_cache', 'entities_by_id',
+           'resolve_relations', 'AttrRecord', 'EntityRecord',
+           'ATTR_RECORD_COLUMNS', 'ENTITY_RECORD_COLUMNS', 'attr_records',
+           'raw_attrs', 'entity_records']
 
 
 METADATA = MetaData()
@@ -52,12 +65,9 @@ class ClustoEmptyCommit(Exception):
 class ClustoSession(sqlalchemy.orm.interfaces.SessionExtension):
 
     def after_begin(self, session, transaction, connection):
-        if SESSION.clusto_versioning_enabled:
-            sql = CLUSTO_VERSIONING.insert().values(user=SESSION.clusto_user,
-                                                    description=SESSION.clusto_description)
-            session.execute(sql)
-
-        SESSION.clusto_description = None
+        # the clustoversioning row is only inserted on the first write, see
+        # working_version_number()
+        session.VERSIONNUMBER = None
         SESSION.flushed = set()
 
     def before_commit(self, session):
@@ -68,26 +78,300 @@ class ClustoSession(sqlalchemy.orm.interfaces.SessionExtension):
             raise ClustoEmptyCommit()
 
     def after_commit(self, session):
+        session.VERSIONNUMBER = None
+        session.ATTRCACHE = None
+        session.REFCACHE = None
+        SESSION.clusto_description = None
         SESSION.flushed = set()
+        clusto.cache.after_commit(session)
+
+        if SESSION.clusto_replica is not None:
+            # read what was just written from the primary until the replica
+            # has had time to catch up, in every thread of the process
+            SESSION.clusto_primary_until = time.time() + SESSION.clusto_replica_delay
+
+    def after_rollback(self, session):
+        session.VERSIONNUMBER = None
+        session.ATTRCACHE = None
+        session.REFCACHE = None
+        SESSION.clusto_description = None
+        clusto.cache.after_rollback(session)
 
     def after_flush(self, session, flush_context):
         SESSION.flushed.update(x for x in session)
 
+        if SESSION.clusto_closure_enabled:
+            clusto.containment.update_closure(session)
+
+        if SESSION.clusto_effective_attrs_enabled:
+            clusto.containment.update_effective_attrs(session)
+
+        if SESSION.cache is not None:
+            clusto.cache.invalidate(obj.entity_id
+                                    for objs in (session.new, session.dirty, session.deleted)
+                                    for obj in objs if isinstance(obj, Attribute))
+
+
+class RoutingSession(Session):
+    """A Session sending reads outside of transactions to the replica.
+
+    Writes, SELECT ... FOR UPDATE and everything inside a transaction use
+    the primary, and so do all reads for clusto_replica_delay seconds after
+    a commit in any thread of the process so they see what was written.
+    """
+
+    def reads_replica(self, clause):
+        return SESSION.clusto_replica is not None \
+            and isinstance(clause, sqlalchemy.sql.expression.Select) \
+            and not clause.for_update \
+            and self.transaction is None \
+            and SESSION.clusto_primary_until <= time.time()
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.reads_replica(clause):
+            return SESSION.clusto_replica
+        return Session.get_bind(self, mapper, clause)
+
 
 SESSION = scoped_session(sessionmaker(autoflush=True, autocommit=True,
+                                      class_=RoutingSession,
                                       extension=ClustoSession()))
 
 
 def latest_version():
     return select([func.coalesce(func.max(CLUSTO_VERSIONING.c.version), 0)])
 
+_working_version = select([func.coalesce(func.max(CLUSTO_VERSIONING.c.version),1)])
+
 def working_version():
-    return select([func.coalesce(func.max(CLUSTO_VERSIONING.c.version),1)])
+    """Return a placeholder for the version of the current transaction.
+
+    Rows assigned this get the actual number from working_version_number()
+    when they are flushed.
+    """
+    return _working_version
+
+def working_version_number(connection=None):
+    """Return the version number rows written now are stamped with.
+
+    With versioning enabled the clustoversioning row for the transaction is
+    inserted the first time this is called and its number is reused until
+    the transaction ends, so transactions that never write don't allocate a
+    version.  This should be called inside a transaction.
+    """
+
+    session = SESSION()
+    number = getattr(session, 'VERSIONNUMBER', None)
+    if number is not None:
+        return number
+
+    if connection is None:
+        connection = session
+
+    if SESSION.clusto_versioning_enabled:
+        sql = CLUSTO_VERSIONING.insert().values(user=SESSION.clusto_user,
+                                                description=SESSION.clusto_description)
+        number = connection.execute(sql).inserted_primary_key[0]
+        SESSION.clusto_description = None
+    else:
+        number = connection.execute(_working_version).scalar()
+
+    session.VERSIONNUMBER = number
+    return number
+
+def _stamp_version(mapper, connection, target):
+    """Replace working_version() placeholders with the transaction's version."""
+
+    for name in ('version', 'deleted_at_version'):
+        if target.__dict__.get(name) is _working_version:
+            object.__setattr__(target, name,
+                               working_version_number(connection))
+
+def execute_bulk(statement, params=None):
+    """Execute a core insert/update/delete statement in the current session.
+
+    Pending objects are flushed first so the statement sees them.  Since
+    these writes bypass the unit of work the affected table is recorded in
+    SESSION.flushed, otherwise the commit would be treated as empty.
+    """
+
+    SESSION.flush()
+    result = SESSION.execute(statement, params)
+    SESSION.flushed.add(statement.table)
+    return result
+
+def batching():
+    """Return True while clusto.batch() is deferring flushes."""
+
+    return getattr(SESSION(), 'BATCHCOUNTER', 0) > 0
+
+def maybe_flush():
+    """Flush the session unless flushes are being deferred by a batch."""
+
+    if not batching():
+        SESSION.flush()
+
+def is_pending_delete(obj):
+    """Return True if obj has been deleted but the delete isn't flushed yet."""
+
+    if obj in SESSION.deleted:
+        return True
+
+    return getattr(obj, 'deleted_at_version', None) is not None \
+        and SESSION.clusto_version is None
+
+# hits and misses of the attribute caches of every session in this process
+ATTR_CACHE_STATS = {'hits': 0, 'misses': 0}
+
+def _session_cache(name, create):
+    if SESSION.clusto_version is not None or batching():
+        return None
+
+    tl = SESSION()
+    if getattr(tl, name, None) is None:
+        if not create:
+            return None
+        setattr(tl, name, {})
+    return getattr(tl, name)
+
+def attr_cache(seeding=False):
+    """Return the attribute cache of the current session or None if it's off.
+
+    The cache maps entity_ids to the current attributes of that entity.  It
+    is only read for the current version and outside clusto.batch(), and is
+    emptied at the end of every transaction since committing expires the
+    cached objects.  Unless the attr_cache option is on it only holds what
+    clusto.prefetch() seeded it with.
+    """
+
+    return _session_cache('ATTRCACHE',
+                          SESSION.clusto_attr_cache_enabled or seeding)
+
+def reference_cache(seeding=False):
+    """Return the cache of the attributes referring to an entity_id or None.
+
+    Works like attr_cache() but is only filled by clusto.prefetch().
+    """
+
+    return _session_cache('REFCACHE', seeding)
+
+def attr_cache_stats():
+    """Return the attribute cache hits, misses and hit_rate of this process."""
+
+    stats = dict(ATTR_CACHE_STATS)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = lookups and float(stats['hits']) / lookups
+    return stats
+
+def drop_attr_cache(entity_id=None):
+    """Forget the cached attributes of entity_id, or of every entity."""
+
+    tl = SESSION()
+    if entity_id is None:
+        tl.ATTRCACHE = None
+        tl.REFCACHE = None
+        return
+
+    for cache in (getattr(tl, 'ATTRCACHE', None), getattr(tl, 'REFCACHE', None)):
+        if cache:
+            cache.pop(entity_id, None)
+
+def _patch_attr_cache(entity_id, added=(), removed=(), removed_ids=(),
+                      name='ATTRCACHE'):
+    """Apply an attribute write to the cached attributes of entity_id.
+
+    added and removed are Attribute objects, removed_ids attr_ids.  With
+    name='REFCACHE' the cached references to entity_id are patched instead.
+    """
+
+    cache = getattr(SESSION(), name, None)
+    if not cache or entity_id not in cache:
+        return
+
+    removed = set(id(a) for a in removed)
+    removed_ids = set(removed_ids)
+    attrs = [a for a in cache[entity_id]
+             if id(a) not in removed and a.attr_id not in removed_ids]
+    attrs.extend(added)
+    cache[entity_id] = attrs
+
+def entities_by_id(entity_ids):
+    """Return a dict of entity_id to Entity for the given entity_ids.
+
+    Entities already loaded in the session are used as they are, the rest
+    are queried 500 at a time.
+    """
+
+    found = {}
+    missing = set(entity_ids)
+    if SESSION.clusto_version is None:
+        tl = SESSION()
+        mapper = class_mapper(Entity)
+        for entity_id in list(missing):
+            entity = tl.identity_map.get(
+                mapper.identity_key_from_primary_key([entity_id]))
+            if entity is None or instance_state(entity).expired_attributes \
+                    or is_pending_delete(entity):
+                continue
+            found[entity_id] = entity
+            missing.discard(entity_id)
+
+    for chunk in batch(list(missing), 500):
+        for entity in Entity.query().filter(Entity.entity_id.in_(list(chunk))):
+            found[entity.entity_id] = entity
+
+    return found
+
+def resolve_relations(attrs, referencing=False):
+    """Load the entities the given attributes refer to all at once.
+
+    Instead of each attribute loading its relation_value with a query of its
+    own when it's read, the ones that aren't loaded yet are looked up with
+    entities_by_id().  With referencing=True the entities owning the
+    attributes are loaded instead.
+
+    Does nothing inside clusto.batch().  Returns attrs.
+    """
+
+    if batching():
+        return attrs
+
+    if referencing:
+        name, column = 'entity', 'entity_id'
+    else:
+        name, column = 'relation_value', 'relation_id'
+
+    unresolved = [attr for attr in attrs
+                  if getattr(attr, column) is not None
+                  and name not in instance_state(attr).dict]
+    if not unresolved:
+        return attrs
+
+    entities = entities_by_id([getattr(attr, column) for attr in unresolved])
+    for attr in unresolved:
+        entity = entities.get(getattr(attr, column))
+        if entity is not None:
+            set_committed_value(attr, name, entity)
+
+    return attrs
+
+def pending(cls):
+    """Return the unflushed new objects of the given class in the session."""
+
+    return [obj for obj in SESSION.new
+            if isinstance(obj, cls) and not is_pending_delete(obj)]
 
 SESSION.clusto_versioning_enabled = True
 SESSION.clusto_version = None
 SESSION.clusto_user = None
 SESSION.clusto_description = None
+SESSION.clusto_closure_enabled = False
+SESSION.clusto_effective_attrs_enabled = False
+SESSION.clusto_attr_cache_enabled = False
+SESSION.clusto_replica = None
+SESSION.clusto_replica_delay = 0
+SESSION.clusto_primary_until = 0
+SESSION.cache = None
 
 ENTITY_TABLE = Table('entities', METADATA,
                      Column('entity_id', Integer, primary_key=True),
@@ -157,6 +441,41 @@ Index('idx_counter_entity_attr',
       COUNTER_TABLE.c.entity_id,
       COUNTER_TABLE.c.attr_key)
 
+# Transitive containment, kept up to date when the 'closure' option is on.
+# There is a row for every depth an ancestor contains a descendant at, paths
+# counts the distinct '_contains' chains of that length between them.
+CLOSURE_TABLE = Table('entity_closure', METADATA,
+                      Column('ancestor_id', Integer, primary_key=True,
+                             autoincrement=False),
+                      Column('descendant_id', Integer, primary_key=True,
+                             autoincrement=False),
+                      Column('depth', Integer, primary_key=True,
+                             autoincrement=False),
+                      Column('paths', Integer, nullable=False, default=1),
+                      mysql_engine='InnoDB'
+                      )
+
+Index('idx_closure_descendant',
+      CLOSURE_TABLE.c.descendant_id,
+      CLOSURE_TABLE.c.depth)
+
+# Attributes every entity inherits from the entities containing it, kept up
+# to date when the 'effective_attrs' option is on.  source_id is the entity
+# the attribute belongs to and depth the closest distance to it.
+EFFECTIVE_ATTRS_TABLE = Table('entity_effective_attrs', METADATA,
+                              Column('entity_id', Integer, primary_key=True,
+                                     autoincrement=False),
+                              Column('attr_id', Integer, primary_key=True,
+                                     autoincrement=False),
+                              Column('source_id', Integer, nullable=False),
+                              Column('depth', Integer, nullable=False),
+                              mysql_engine='InnoDB'
+                              )
+
+Index('idx_effective_attrs_source',
+      EFFECTIVE_ATTRS_TABLE.c.source_id,
+      EFFECTIVE_ATTRS_TABLE.c.attr_id)
+
 class ClustoVersioning(object):
     pass
 
@@ -180,6 +499,17 @@ class Counter(object):
         audit_log.info('increment counter entity=%s attr_key=%s value=%s', self.entity.name, self.attr_key, self.value)
         return self.value
 
+    def reserve(self, count):
+        """Reserve count consecutive values with a single update.
+
+        Returns the first value reserved, the last one is the new value.
+        """
+
+        self.value = Counter.value + count
+        SESSION.flush()
+        audit_log.info('reserve counter entity=%s attr_key=%s value=%s count=%s', self.entity.name, self.attr_key, self.value, count)
+        return self.value - count + 1
+
     def delete(self):
         audit_log.info('delete counter entity=%s attr_key=%s value=%s', self.entity.name, self.attr_key, self.value)
         SESSION.delete(self)
@@ -266,10 +596,15 @@ class Attribute(ProtectedObj):
             self.number = number
 
 
+        _patch_attr_cache(self.entity.entity_id, added=[self])
+        if self.relation_value is not None:
+            _patch_attr_cache(self.relation_value.entity_id, added=[self],
+                              name='REFCACHE')
+
         audit_log.info('create attribute entity=%s key=%s subkey=%s value=%s number=%s datatype=%s',
                 self.entity.name, self.key, self.subkey, self.value, self.number, self.datatype)
         SESSION.add(self)
-        SESSION.flush()
+        maybe_flush()
 
 
 
@@ -313,6 +648,36 @@ class Attribute(ProtectedObj):
     def is_relation(self):
         return self.datatype == 'relation'
 
+    @classmethod
+    def value_columns(cls, value):
+        """Return the entity_attrs column values used to store the given value.
+
+        This mirrors what setting Attribute.value does and is meant for
+        writing attribute rows without going through the ORM.
+        """
+
+        columns = {'datatype': cls.get_type(value),
+                   'int_value': None,
+                   'string_value': None,
+                   'datetime_value': None,
+                   'relation_id': None}
+
+        datatype = columns['datatype']
+        if datatype == 'int':
+            columns['int_value'] = int(value)
+        elif datatype == 'datetime':
+            columns['datetime_value'] = value
+        elif datatype == 'relation':
+            if not isinstance(value, Entity):
+                value = value.entity
+            columns['relation_id'] = value.entity_id
+        elif datatype == 'json':
+            columns['string_value'] = unicode(json.dumps(value))
+        elif value is not None:
+            columns['string_value'] = unicode(value)
+
+        return columns
+
     def get_value_type(self, value=None):
         if value == None:
             if self.datatype == None:
@@ -361,7 +726,14 @@ class Attribute(ProtectedObj):
     def _get_value(self):
 
         if self.get_value_type() == 'relation_value':
-            return clusto.drivers.base.Driver(getattr(self, self.get_value_type()))
+            # drivers are only wrappers, keep the one made for this entity
+            # (in __dict__ since it's not something to protect from writes)
+            entity = self.relation_value
+            driver = self.__dict__.get('_driver')
+            if driver is None or driver.entity is not entity:
+                driver = clusto.drivers.base.Driver(entity)
+                self.__dict__['_driver'] = driver
+            return driver
         else:
             val = getattr(self, self.get_value_type())
             if self.datatype == 'int':
@@ -397,11 +769,59 @@ class Attribute(ProtectedObj):
         ### TODO this seems like a hack
         audit_log.info('delete attribute entity=%s key=%s subkey=%s value=%s number=%s datatype=%s',
                 self.entity.name, self.key, self.subkey, self.value, self.number, self.datatype)
+        _patch_attr_cache(self.entity_id, removed=[self])
+        _patch_attr_cache(self.relation_id, removed=[self], name='REFCACHE')
         if SESSION.clusto_versioning_enabled:
             self.deleted_at_version = working_version()
         else:
             SESSION.delete(self)
-            SESSION.flush()
+            maybe_flush()
+
+    @classmethod
+    def delete_matching(cls, query):
+        """Delete every attribute matched by an Attribute query at once.
+
+        This runs a single UPDATE (or DELETE when versioning is off) instead
+        of deleting attributes one at a time, and should be called inside a
+        transaction.  Returns the number of attributes deleted.
+        """
+
+        if SESSION.clusto_closure_enabled:
+            links = query.filter(Attribute.key==u'_contains').with_entities(
+                Attribute.entity_id, Attribute.relation_id).all()
+        if SESSION.clusto_effective_attrs_enabled or SESSION.cache is not None:
+            sources = [entity_id for entity_id, in
+                       query.with_entities(Attribute.entity_id).distinct()]
+        cached = bool(getattr(SESSION(), 'ATTRCACHE', None)
+                      or getattr(SESSION(), 'REFCACHE', None))
+        if cached:
+            deleted = query.with_entities(Attribute.entity_id,
+                                          Attribute.relation_id,
+                                          Attribute.attr_id).all()
+
+        if SESSION.clusto_versioning_enabled:
+            count = query.update({'deleted_at_version': working_version_number()},
+                                 synchronize_session='fetch')
+        else:
+            count = query.delete(synchronize_session='fetch')
+
+        if SESSION.clusto_closure_enabled:
+            for parent_id, child_id in links:
+                clusto.containment.unlink(parent_id, child_id)
+
+        if SESSION.clusto_effective_attrs_enabled:
+            clusto.containment.attrs_changed(sources)
+        if SESSION.cache is not None:
+            clusto.cache.invalidate(sources)
+
+        if cached:
+            for entity_id, relation_id, attr_id in deleted:
+                _patch_attr_cache(entity_id, removed_ids=[attr_id])
+                _patch_attr_cache(relation_id, removed_ids=[attr_id],
+                                  name='REFCACHE')
+
+        SESSION.flushed.add(ATTR_TABLE)
+        return count
 
     @classmethod
     def _version_args(cls):
@@ -492,7 +912,7 @@ class Entity(ProtectedObj):
         audit_log.info('create entity %s driver=%s type=%s', self.name, self.driver, self.type)
 
         SESSION.add(self)
-        SESSION.flush()
+        maybe_flush()
 
     def __eq__(self, otherentity):
         """Am I the same as the Other Entity.
@@ -536,11 +956,42 @@ class Entity(ProtectedObj):
 
     @property
     def attrs(self):
-        return Attribute.query().filter(Attribute.entity==self).all()
+        if not batching():
+            cache = attr_cache()
+            if cache is None or self.entity_id is None:
+                return Attribute.query().filter(Attribute.entity==self).all()
+
+            if self.entity_id in cache:
+                ATTR_CACHE_STATS['hits'] += 1
+                return list(cache[self.entity_id])
+
+            ATTR_CACHE_STATS['misses'] += 1
+            attrs = Attribute.query().filter(Attribute.entity==self).all()
+            if SESSION.clusto_attr_cache_enabled:
+                cache[self.entity_id] = attrs
+            return list(attrs)
+
+        attrs = []
+        if self.entity_id is not None:
+            attrs = [a for a in Attribute.query().filter(Attribute.entity==self)
+                     if not is_pending_delete(a)]
+        attrs.extend(a for a in pending(Attribute) if a.entity is self)
+        return attrs
 
     @property
     def references(self):
-        return Attribute.query().filter(Attribute.relation_id==self.entity_id).all()
+        if not batching():
+            cache = reference_cache()
+            if cache is not None and self.entity_id in cache:
+                return list(cache[self.entity_id])
+            return Attribute.query().filter(Attribute.relation_id==self.entity_id).all()
+
+        attrs = []
+        if self.entity_id is not None:
+            attrs = [a for a in Attribute.query().filter(Attribute.relation_id==self.entity_id)
+                     if not is_pending_delete(a)]
+        attrs.extend(a for a in pending(Attribute) if a.relation_value is self)
+        return attrs
 
 
     def add_attr(self, *args, **kwargs):
@@ -553,23 +1004,24 @@ class Entity(ProtectedObj):
 
         clusto.begin_transaction()
         try:
-            for i in self.references:
-                i.delete()
-
-            for i in self.attrs:
-                i.delete()
+            SESSION.flush()
+            attrs = Attribute.delete_matching(Attribute.query().filter(
+                or_(Attribute.entity_id==self.entity_id,
+                    Attribute.relation_id==self.entity_id)))
 
-            for i in self.counters:
-                i.delete()
+            counters = Counter.query().filter(
+                Counter.entity_id==self.entity_id).delete(
+                synchronize_session='fetch')
 
             if SESSION.clusto_versioning_enabled:
                 self.deleted_at_version = working_version()
             else:
                 SESSION.delete(self)
-                SESSION.flush()
+                maybe_flush()
 
             clusto.commit()
-            audit_log.info('delete entity %s', self.name)
+            audit_log.info('delete entity %s attrs=%d counters=%d', self.name,
+                           attrs, counters)
         except Exception, x:
             clusto.rollback_transaction()
             raise x
@@ -590,6 +1042,34 @@ class Entity(ProtectedObj):
         return SESSION.query(cls).filter(and_(*cls._version_args()))
 
 
+    @ProtectedObj.writer
+    def _set_name(self, name):
+        """renames the entity in place, keeping its entity_id
+
+        attributes, references and counters are left untouched.  With
+        versioning on the rename is recorded as its own clustoversioning row,
+        but historical views will show the new name.
+
+        params:
+          name: the new name
+        """
+
+        try:
+            clusto.begin_transaction()
+
+            oldname = self.name
+            if SESSION.clusto_description is None:
+                SESSION.clusto_description = u'rename %s to %s' % (oldname, name)
+            working_version_number()
+
+            self.name = unicode(name)
+
+            audit_log.info('rename entity %s to %s', oldname, self.name)
+            clusto.commit()
+        except Exception, x:
+            clusto.rollback_transaction()
+            raise x
+
     @ProtectedObj.writer
     def _set_driver_and_type(self, driver, clusto_type):
         """sets the driver and type for the entity
@@ -634,3 +1114,81 @@ mapper(Attribute, ATTR_TABLE,
 mapper(Entity, ENTITY_TABLE,
 
        )
+
+for cls in (Entity, Attribute):
+    event.listen(cls, 'before_insert', _stamp_version)
+    event.listen(cls, 'before_update', _stamp_version)
+
+
+class AttrRecord(collections.namedtuple('AttrRecord',
+                                        ['key', 'number', 'subkey', 'value',
+                                         'datatype', 'entity_id',
+                                         'relation_id', 'attr_id'])):
+    """A read-only attribute row returned by the raw=True queries.
+
+    value is already decoded; for relation attributes it is the entity_id of
+    the entity referred to, not a Driver.
+    """
+
+    __slots__ = ()
+
+    @property
+    def is_relation(self):
+        return self.datatype == 'relation'
+
+    @property
+    def keytuple(self):
+        return (self.key, self.number, self.subkey)
+
+    @property
+    def to_tuple(self):
+        return (self.key, self.number, self.subkey, self.value)
+
+
+EntityRecord = collections.namedtuple('EntityRecord',
+                                      ['entity_id', 'name', 'type', 'driver'])
+
+ATTR_RECORD_COLUMNS = [ATTR_TABLE.c.key, ATTR_TABLE.c.number,
+                       ATTR_TABLE.c.subkey, ATTR_TABLE.c.datatype,
+                       ATTR_TABLE.c.int_value, ATTR_TABLE.c.string_value,
+                       ATTR_TABLE.c.datetime_value, ATTR_TABLE.c.relation_id,
+                       ATTR_TABLE.c.entity_id, ATTR_TABLE.c.attr_id]
+
+ENTITY_RECORD_COLUMNS = [ENTITY_TABLE.c.entity_id, ENTITY_TABLE.c.name,
+                         ENTITY_TABLE.c.type, ENTITY_TABLE.c.driver]
+
+
+def attr_records(statement):
+    """Run a select of ATTR_RECORD_COLUMNS and return AttrRecords.
+
+    The rows never become Attribute objects, so they skip the session and
+    its identity map altogether.
+    """
+
+    records = []
+    for (key, number, subkey, datatype, int_value, string_value,
+         datetime_value, relation_id, entity_id, attr_id) in SESSION.execute(statement):
+        if datatype == 'int':
+            value = int(int_value)
+        elif datatype == 'json':
+            value = json.loads(string_value)
+        elif datatype == 'datetime':
+            value = datetime_value
+        elif datatype == 'relation':
+            value = relation_id
+        else:
+            value = string_value
+        records.append(AttrRecord(key, number, subkey, value, datatype,
+                                  entity_id, relation_id, attr_id))
+    return records
+
+def raw_attrs(*whereclauses):
+    """Return AttrRecords for the visible attributes matching the whereclauses."""
+
+    args = Attribute._version_args() + list(whereclauses)
+    return attr_records(select(ATTR_RECORD_COLUMNS, and_(*args)))
+
+def entity_records(statement):
+    """Run a select of ENTITY_RECORD_COLUMNS and return EntityRecords."""
+
+    return [EntityRecord(*row) for row in SESSION.execute(statement)]
@@ -37,7 +37,7 @@ def unclusto(obj):
             'number': obj.number,
             'datatype': obj.datatype
         }
-    if issubclass(obj.__class__, Driver):
+    if issubclass(obj.__class__, (Driver, clusto.EntityRecord)):
         return '/%s/%s' % (obj.type, obj.name)
     return str(obj)
 
@@ -57,6 +57,39 @@ def loads(request, obj):
     return json.loads(obj)
 
 
+def paginate(request, iter_page):
+    '''
+    Return up to request.params['limit'] of the entity records yielded by
+    iter_page(after_entity_id) and the entity_id to pass as
+    request.params['after'] to get the next page, or None if there is no
+    next page.
+    '''
+    after = request.params.get('after', None)
+    if after is not None:
+        after = int(after)
+    limit = request.params.get('limit', None)
+    if limit is not None:
+        limit = int(limit)
+
+    things = iter_page(after)
+
+    result = []
+    last = None
+    for thing in things:
+        if limit is not None and len(result) == limit:
+            return result, last
+        result.append(unclusto(thing))
+        last = thing.entity_id
+    return result, None
+
+
+def paged(request, result, after):
+    response = dumps(request, result)
+    if after is not None:
+        response.headers['X-Clusto-After'] = str(after)
+    return response
+
+
 class EntityAPI(object):
     def __init__(self, obj):
         self.obj = obj
@@ -260,10 +293,21 @@ class QueryAPI(object):
         for attr in kwargs['attrs']:
             attrs.append(dict([(str(k), v) for k, v in attr.items()]))
         kwargs['attrs'] = attrs
+        kwargs['raw'] = True
 
         result = [unclusto(x) for x in clusto.get_entities(**kwargs)]
         return dumps(request, result)
 
+    @classmethod
+    def expr(self, request):
+        if not 'q' in request.params:
+            return Response(status=400, body='400 Bad Request\nYou must specify a query expression in "q"\n')
+        try:
+            result = [unclusto(x) for x in clusto.query(request.params['q'], raw=True)]
+        except (clusto.QueryException, LookupError), e:
+            return Response(status=400, body='400 Bad Request\n%s\n' % e)
+        return dumps(request, result)
+
     @classmethod
     def get_by_name(self, request):
         if not 'name' in request.params:
@@ -312,6 +356,33 @@ class QueryAPI(object):
         return dumps(request, unclusto(ipman))
 
 
+    @classmethod
+    def ip_utilization(self, request):
+        over = None
+        if 'over' in request.params:
+            try:
+                over = float(request.params['over'])
+            except ValueError:
+                return Response(status=400, body='400 Bad Request\n"over" must be a fraction, e.g. 0.9\n')
+
+        if 'name' in request.params:
+            try:
+                ipman = clusto.get_by_name(request.params['name'])
+            except LookupError:
+                return Response(status=404, body='404 Not Found\n')
+            if not isinstance(ipman, IPManager):
+                return Response(status=400, body='400 Bad Request\n%s is not an IP manager\n' % ipman.name)
+            try:
+                result = [u for u in [ipman.utilization()]
+                          if over is None or u['utilization'] >= over]
+            except clusto.ResourceTypeException, e:
+                return Response(status=400, body='400 Bad Request\n%s\n' % e)
+        else:
+            result = clusto.ip_utilization(over)
+
+        return dumps(request, result)
+
+
 class ClustoApp(object):
     def __init__(self):
         self.urls = [
@@ -348,10 +419,9 @@ class ClustoApp(object):
 
     def types_delegate(self, request, match):
         objtype = match.groupdict()['objtype']
-        result = []
-        for obj in clusto.get_entities(clusto_types=(objtype,)):
-            result.append(unclusto(obj))
-        return dumps(request, result)
+        result, after = paginate(request, lambda after: clusto.iter_entities(
+            clusto_types=(objtype,), raw=True, after_entity_id=after))
+        return paged(request, result, after)
 
     def action_delegate(self, request, match):
         if request.method == 'GET':
@@ -436,11 +506,13 @@ class ClustoApp(object):
         if not query:
             return Response(status=400, body='400 Bad Request\nNo query specified\n')
 
-        result = []
-        for obj in clusto.get_entities():
-            if obj.name.find(query) != -1:
-                result.append(unclusto(obj))
-        return dumps(request, result)
+        def matches(after):
+            for obj in clusto.iter_entities(raw=True, after_entity_id=after):
+                if obj.name.find(query) != -1:
+                    yield obj
+
+        result, after = paginate(request, matches)
+        return paged(request, result, after)
 
     def notfound(self, request, match):
         return Response(status=404)
@@ -458,6 +530,8 @@ class ClustoApp(object):
                     response = Response(status=500, body=format_exc(),
                                         content_type='text/plain')
                 break
+        # don't let attributes cached during this request outlive it
+        clusto.drop_attr_cache()
         return response(environ, start_response)
 
 
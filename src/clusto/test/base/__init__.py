@@ -5,3 +5,5 @@ from drivertests import *
 from versioningtests import *
 from countertests import *
 
+from cachetests import *
+from querylangtests import *
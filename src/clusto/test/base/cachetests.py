@@ -0,0 +1,198 @@
+import datetime
+import json
+import time
+
+from clusto.test import testbase
+
+import clusto
+from clusto import cache
+from clusto.drivers import Driver, Pool
+
+
+class FakeMemcache(object):
+    """The parts of memcache.Client the cache uses, kept in a dict."""
+
+    def __init__(self):
+        self.data = {}
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append('get')
+        return self.data.get(key)
+
+    def get_multi(self, keys):
+        self.calls.append('get_multi')
+        return dict((k, self.data[k]) for k in keys if k in self.data)
+
+    def set(self, key, value, time=0):
+        self.calls.append('set')
+        self.data[key] = value
+
+    def set_multi(self, mapping, time=0):
+        self.calls.append('set_multi')
+        self.data.update(mapping)
+
+    def add(self, key, value, time=0):
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def incr(self, key):
+        if key not in self.data:
+            return None
+        self.data[key] = str(int(self.data[key]) + 1)
+        return int(self.data[key])
+
+
+class TestCacheBackends(testbase.ClustoTestBase):
+
+    def testLRUBackend(self):
+
+        lru = cache.LRUBackend(size=2, ttl=0)
+        lru.set('a', '1')
+        lru.set('b', '2')
+        lru.get('a')
+        lru.set('c', '3')
+
+        self.assertEqual({'a': '1', 'c': '3'}, lru.get_multi(['a', 'b', 'c']))
+        self.assertEqual(None, lru.incr('gen'))
+        self.assertTrue(lru.add('gen', 1))
+        self.assertFalse(lru.add('gen', 5))
+        self.assertEqual(2, lru.incr('gen'))
+        self.assertEqual(2, len(lru))
+
+    def testLRUBackendTTL(self):
+
+        lru = cache.LRUBackend(size=10, ttl=0.01)
+        lru.set('a', '1')
+        self.assertEqual('1', lru.get('a'))
+        time.sleep(0.02)
+        self.assertEqual(None, lru.get('a'))
+
+    def testMemcacheBackendIncr(self):
+
+        backend = cache.MemcacheBackend(FakeMemcache())
+        self.assertEqual(None, backend.incr('gen'))
+        self.assertTrue(backend.add('gen', '1'))
+        self.assertEqual(2, backend.incr('gen'))
+        self.assertEqual('2', backend.get('gen'))
+
+    def testEvictedGenerationRestartsAhead(self):
+
+        attr_cache = cache.AttrCache(cache.LRUBackend())
+        key = attr_cache._generation_key(1)
+        attr_cache.local.set(key, 5)
+        attr_cache.expire([1])
+        self.assertEqual(6, attr_cache.local.get(key))
+
+        attr_cache.local.delete(key)
+        attr_cache.expire([1])
+        self.assertTrue(attr_cache.local.get(key) > 6)
+
+
+class TestAttrCache(testbase.ClustoTestBase):
+
+    def setUp(self):
+        testbase.ClustoTestBase.setUp(self)
+        self.memcache = FakeMemcache()
+        clusto.SESSION.cache = self.new_cache()
+        # reads the session already cached don't reach the shared cache
+        clusto.SESSION.clusto_attr_cache_enabled = False
+
+    def tearDown(self):
+        clusto.SESSION.cache = None
+        testbase.ClustoTestBase.tearDown(self)
+
+    def new_cache(self):
+        return cache.AttrCache(cache.LRUBackend(),
+                               cache.MemcacheBackend(self.memcache))
+
+    def testSerialization(self):
+
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+        when = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+        d1.add_attr('int', 5)
+        d1.add_attr('str', u'caf\xe9', subkey='sub')
+        d1.add_attr('date', when)
+        d1.add_attr('rel', d2, number=3)
+
+        attrs = d1.entity.attrs
+        expected = sorted((a.key, a.subkey, a.number, a.value) for a in attrs)
+        data = cache.dump_attrs(attrs)
+        self.assertEqual(len(attrs), len(json.loads(data)))
+
+        clusto.clear()
+        loaded = cache.load_attrs(data)
+        self.assertEqual(expected,
+                         sorted((a.key, a.subkey, a.number, a.value) for a in loaded))
+
+    def testRepeatedReadsHitCache(self):
+
+        d1 = Driver('d1')
+        d1.add_attr('foo', 1)
+
+        self.assertEqual([1], d1.attr_values('foo'))
+        self.assertEqual([1], d1.attr_values('foo'))
+        self.assertEqual(1, clusto.SESSION.cache.stats['misses'])
+        self.assertEqual(1, clusto.SESSION.cache.stats['hits'])
+
+        self.assertEqual([1], d1.attr_values('foo', ignore_cache=True))
+        self.assertEqual(1, clusto.SESSION.cache.stats['hits'])
+
+    def testWritesExpireOtherProcesses(self):
+
+        d1 = Driver('d1')
+        d1.add_attr('foo', 1)
+        first = clusto.SESSION.cache
+        self.assertEqual([1], d1.attr_values('foo'))
+
+        # another process sharing memcached
+        clusto.SESSION.cache = self.new_cache()
+        d1.set_attr('foo', 2)
+        d1.add_attrs([('bar', 3)])
+
+        clusto.SESSION.cache = first
+        self.assertEqual([2], d1.attr_values('foo'))
+        self.assertEqual([3], d1.attr_values('bar'))
+
+        d1.del_attrs('bar')
+        self.assertEqual([], d1.attr_values('bar'))
+
+    def testRollbackDoesNotExpire(self):
+
+        d1 = Driver('d1')
+        self.assertEqual([], d1.attr_values('foo'))
+        expires = clusto.SESSION.cache.stats['expires']
+
+        clusto.begin_transaction()
+        d1.add_attr('foo', 1)
+        clusto.rollback_transaction()
+
+        self.assertEqual(expires, clusto.SESSION.cache.stats['expires'])
+        self.assertEqual([], d1.attr_values('foo'))
+
+    def testMergedContainerAttrs(self):
+
+        p1 = Pool('p1')
+        p2 = Pool('p2')
+        d1 = Driver('d1')
+        p1.insert(d1)
+        p2.insert(d1)
+        p1.add_attr('dhcp', 'a')
+        p2.add_attr('dhcp', 'b')
+
+        expected = sorted(d1.attr_values('dhcp', merge_container_attrs=True,
+                                         ignore_cache=True))
+        del self.memcache.calls[:]
+
+        self.assertEqual(expected, sorted(d1.attr_values('dhcp',
+                                                         merge_container_attrs=True)))
+        self.assertEqual(expected, sorted(d1.attr_values('dhcp',
+                                                         merge_container_attrs=True)))
+        self.assertFalse('get' in self.memcache.calls)
+        self.assertEqual(['a', 'b'], expected)
@@ -1,3 +1,7 @@
+import ConfigParser
+import os
+import tempfile
+import threading
 import unittest
 from clusto.test import testbase
 
@@ -5,6 +9,7 @@ import clusto
 from clusto.schema import *
 from clusto.drivers.base import *
 from clusto.drivers import BasicDatacenter, Pool, BasicServer, IPManager, BasicRack
+from sqlalchemy import event
 from sqlalchemy.exc import InvalidRequestError
 from clusto.exceptions import TransactionException
 
@@ -49,6 +54,19 @@ class TestClusto(testbase.ClustoTestBase):
 
         self.assertEqual(cm.schemaversion, VERSION)
 
+    def testClustoMetaCached(self):
+
+        ClustoMeta()
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(clusto.SESSION.bind, 'before_cursor_execute', count)
+
+        cm = ClustoMeta()
+        self.assertEqual([], statements)
+        self.assertEqual(cm, clusto.get_by_name('clustometa'))
+        self.assertTrue(isinstance(cm, ClustoMeta))
+
     def testGetByName(self):
 
         e1 = Entity.query().filter_by(name=u'e1').one()
@@ -245,6 +263,10 @@ class TestClusto(testbase.ClustoTestBase):
         self.assertEqual(sorted([n.name
                                  for n in clusto.get_entities(clusto_types=tl)]),
                          sorted(['l1','dc1']))
+        self.assertEqual(sorted([(n.name, n.type)
+                                 for n in clusto.get_entities(clusto_types=tl,
+                                                              raw=True)]),
+                         [('dc1', 'datacenter'), ('l1', 'location')])
 
         p1 = Pool('p1')
         p2 = Pool('p2')
@@ -284,6 +306,30 @@ class TestClusto(testbase.ClustoTestBase):
                          sorted(clusto.get_from_pools(pools=['p4', 'p1'],
                                                       clusto_types=[BasicServer])))
 
+    def testIterEntities(self):
+
+        for i in range(5):
+            Pool('p%d' % i)
+
+        expected = sorted(e.name for e in clusto.get_entities(clusto_types=[Pool]))
+        drivers = list(clusto.iter_entities(clusto_types=[Pool], page_size=2))
+        self.assertEqual(expected, sorted(d.name for d in drivers))
+        self.assertTrue(all(isinstance(d, Pool) for d in drivers))
+
+        ids = [d.entity.entity_id for d in drivers]
+        self.assertEqual(sorted(ids), ids)
+
+        records = list(clusto.iter_entities(clusto_types=[Pool], raw=True,
+                                            after_entity_id=ids[1], limit=2,
+                                            page_size=1))
+        self.assertEqual(ids[2:4], [r.entity_id for r in records])
+
+        Pool('p5').add_attr('k', 1)
+        clusto.get_by_name('p5').add_attr('k', 2)
+        self.assertEqual(['p5'], [e.name for e in
+                                  clusto.iter_entities(attrs=[{'key': 'k'}],
+                                                       page_size=1)])
+
     def testGetEntitesWithAttrs(self):
 
         d1 = Driver('d1')
@@ -321,6 +367,23 @@ class TestClusto(testbase.ClustoTestBase):
                                                    {'value':'test'}]),
                          [d1])
 
+        d1.add_attr('k1', 'testB')
+        self.assertEqual(sorted(e.name for e in
+                                clusto.get_entities(attrs=[{'key':'k1'}], raw=True)),
+                         ['d1', 'd2'])
+
+        self.assertEqual(sorted(clusto.get_entities(attrs=[{'key':'k1'}])),
+                         sorted([d1, d2]))
+        self.assertEqual(clusto.get_entities(attrs=[{'key':'k1'}, {'key':'k2'}],
+                                             match='all'),
+                         [d1])
+        self.assertEqual(clusto.get_entities(attrs=[{'key':'k1', 'value':'testA'},
+                                                    {'key':'k2'}],
+                                             match='all'),
+                         [])
+        self.assertRaises(ValueError, clusto.get_entities,
+                          attrs=[{'key':'k1'}], match='some')
+
     def testGet(self):
         s1 = BasicServer('s1')
         s2 = BasicServer('s2')
@@ -356,7 +419,40 @@ class TestClusto(testbase.ClustoTestBase):
 
         self.assertEqual([], Driver.do_attr_query(key='deltest*', glob=True))
 
+    def testDeleteEntityReferencesAndCounters(self):
 
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+        d1.add_attr('port', 'a', number=True)
+        d1.add_attr('port', 'b', number=True)
+        d2.add_attr('peer', d1)
+        d2.add_attr('keep', 1)
+
+        curver = clusto.get_latest_version_number()
+        clusto.delete_entity(d1.entity)
+
+        self.assertEqual(curver + 1, clusto.get_latest_version_number())
+        self.assertEqual(d2.attr_items(), [(('keep', None, None), 1)])
+        self.assertEqual([], Driver.do_attr_query(key='port'))
+        self.assertEqual([], Counter.query().filter(
+            Counter.entity_id==d1.entity.entity_id).all())
+
+        d3 = Driver('d1')
+        d3.add_attr('port', 'c', number=True)
+        self.assertEqual(d3.attrs('port')[0].number, 0)
+
+    def testDelAttrsSetBased(self):
+
+        d1 = Driver('d1')
+        d1.add_attrs([('foo', i, None, True) for i in range(5)] +
+                     [('foo', 'x'), ('bar', 1)])
+
+        curver = clusto.get_latest_version_number()
+        d1.del_attrs('foo', number=True)
+
+        self.assertEqual(curver + 1, clusto.get_latest_version_number())
+        self.assertEqual(sorted(d1.attr_items()),
+                         [(('bar', None, None), 1), (('foo', None, None), 'x')])
 
     def testDriverSearches(self):
 
@@ -471,6 +567,288 @@ class TestClusto(testbase.ClustoTestBase):
 
         self.assertEqual(len(d1.attr_query('key_foo')), 1)
 
+    def testBulkCreate(self):
+
+        names = ['bulk%02d' % i for i in range(10)]
+        racks = clusto.bulk_create(BasicRack, names,
+                                   attrs=[dict(key='foo', subkey='bar',
+                                               value=1),
+                                          dict(key='port', value='a',
+                                               number=True),
+                                          dict(key='port', value='b',
+                                               number=True)],
+                                   maxu=52)
+
+        self.assertEqual([r.name for r in racks], names)
+        self.assertTrue(all(isinstance(r, BasicRack) for r in racks))
+
+        rack = clusto.get_by_name('bulk03')
+        self.assertEqual(rack.maxu, 52)
+        self.assertEqual(rack.attr_value('foo', subkey='bar'), 1)
+        self.assertEqual(sorted((a.number, a.value)
+                                for a in rack.attrs('port')),
+                         [(0, 'a'), (1, 'b')])
+
+        rack.add_attr('port', 'c', number=True)
+        self.assertEqual(rack.attrs('port', value='c')[0].number, 2)
+
+    def testBulkCreateSingleVersion(self):
+
+        curver = clusto.get_latest_version_number()
+
+        clusto.bulk_create(Driver, ['b1', 'b2', 'b3'],
+                           attrs=[dict(key='foo', value='bar')])
+
+        self.assertEqual(clusto.get_latest_version_number(), curver + 1)
+        self.assertEqual(len(clusto.get_entities(attrs=[dict(key='foo')])), 3)
+
+    def testBulkCreateDuplicates(self):
+
+        self.assertRaises(NameException, clusto.bulk_create, Driver,
+                          ['b1', 'e2'])
+        self.assertRaises(NameException, clusto.bulk_create, Driver,
+                          ['b1', 'b1'])
+        self.assertEqual(clusto.get_by_names(['b1']), [None])
+
+        self.assertRaises(DriverException, clusto.bulk_create, str, ['b1'])
+
+
+class TestConnect(testbase.ClustoTestBase):
+
+    def setUp(self):
+
+        fd, self.dbfile = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        dsn = 'sqlite:///%s' % self.dbfile
+
+        self.conf = ConfigParser.ConfigParser()
+        self.conf.add_section('clusto')
+        self.conf.set('clusto', 'dsn', dsn)
+        self.conf.set('clusto', 'replica_dsn', dsn)
+        self.conf.set('clusto', 'replica_delay', '0')
+        clusto.connect(self.conf)
+        clusto.clear()
+        clusto.SESSION.close()
+        clusto.init_clusto()
+
+        self.replica_statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            self.replica_statements.append(statement)
+        event.listen(clusto.SESSION.clusto_replica, 'before_cursor_execute', count)
+
+    def tearDown(self):
+        testbase.ClustoTestBase.tearDown(self)
+        clusto.SESSION.clusto_replica = None
+        os.remove(self.dbfile)
+
+    def testReadsGoToReplica(self):
+
+        Driver('d1')
+        del self.replica_statements[:]
+
+        self.assertEqual('d1', clusto.get_by_name('d1').name)
+        self.assertNotEqual([], self.replica_statements)
+
+    def testWritesAndRecentCommitsUsePrimary(self):
+
+        clusto.SESSION.clusto_replica_delay = 60
+        Driver('d1')
+        del self.replica_statements[:]
+
+        clusto.get_by_name('d1')
+        self.assertEqual([], self.replica_statements)
+
+        clusto.SESSION.clusto_primary_until = 0
+        try:
+            clusto.begin_transaction()
+            clusto.get_by_name('d1').add_attr('foo', 1)
+            clusto.commit()
+        except Exception:
+            clusto.rollback_transaction()
+            raise
+        self.assertEqual([], self.replica_statements)
+
+        clusto.SESSION.clusto_primary_until = 0
+        locking = select([ENTITY_TABLE], for_update=True)
+        self.assertTrue(clusto.SESSION().get_bind(clause=locking)
+                        is clusto.SESSION.bind)
+
+    def testRecentCommitsUsePrimaryInOtherThreads(self):
+
+        clusto.SESSION.clusto_replica_delay = 60
+        Driver('d1')
+
+        query = select([ENTITY_TABLE])
+        reads_replica = []
+        def read():
+            reads_replica.append(clusto.SESSION().reads_replica(query))
+            clusto.SESSION.remove()
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+        self.assertEqual([False], reads_replica)
+
+    def testPoolOptions(self):
+
+        self.conf.set('clusto', 'pool', 'queue')
+        self.conf.set('clusto', 'pool_size', '3')
+        self.conf.set('clusto', 'pool_pre_ping', 'true')
+        clusto.connect(self.conf)
+        self.assertEqual(3, clusto.SESSION.bind.pool.size())
+        self.assertEqual([], clusto.get_entities(names=['nothing']))
+
+        self.conf.set('clusto', 'pool', 'unknown')
+        self.assertRaises(ValueError, clusto.connect, self.conf)
+
+
+class TestPrefetch(testbase.ClustoTestBase):
+
+    def data(self):
+
+        p1 = Pool('p1')
+        other = Driver('other')
+        for i in range(3):
+            s = BasicServer('s%d' % i)
+            s.add_attr('rel', other)
+            s.add_attr('system', 'value%d' % i, subkey='os')
+            p1.insert(s)
+
+    def count_statements(self):
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(clusto.SESSION.bind, 'before_cursor_execute', count)
+        return statements
+
+    def testPrefetchedReadsUseNoQueries(self):
+
+        p1 = clusto.get_by_name('p1')
+        servers = p1.contents()
+        clusto.prefetch(servers + [p1])
+
+        statements = self.count_statements()
+        for s in servers:
+            self.assertEqual([p1], s.parents())
+            self.assertEqual('other', s.attr_value('rel').name)
+            self.assertEqual(1, len(s.attrs(key='system')))
+        self.assertEqual(sorted(servers), sorted(p1.contents()))
+        self.assertEqual([], statements)
+
+    def testPrefetchSeesWrites(self):
+
+        p1 = clusto.get_by_name('p1')
+        s0 = clusto.get_by_name('s0')
+
+        try:
+            clusto.begin_transaction()
+            clusto.prefetch([p1, s0])
+            p1.remove(s0)
+            s0.add_attr('extra', 1)
+
+            self.assertEqual([], s0.parents())
+            self.assertEqual(2, len(p1.contents()))
+            self.assertEqual([1], s0.attr_values('extra'))
+            clusto.commit()
+        except Exception:
+            clusto.rollback_transaction()
+            raise
+
+        self.assertEqual(None, SESSION().ATTRCACHE)
+        self.assertEqual([], s0.parents())
+        self.assertEqual([1], s0.attr_values('extra'))
+
+    def testPrefetchOnlySeedsGivenEntities(self):
+
+        SESSION.clusto_attr_cache_enabled = False
+        s0 = clusto.get_by_name('s0')
+        s1 = clusto.get_by_name('s1')
+        clusto.prefetch([s0], parents=False)
+
+        self.assertEqual([s0.entity.entity_id], attr_cache().keys())
+        s1.attrs()
+        self.assertEqual([s0.entity.entity_id], attr_cache().keys())
+        self.assertEqual(None, reference_cache())
+
+
+class TestBatch(testbase.ClustoTestBase):
+
+    def data(self):
+
+        Driver('d1').add_attr('foo', 'bar')
+        clusto.flush()
+
+    def testBatchDefersWrites(self):
+
+        curver = clusto.get_latest_version_number()
+
+        with clusto.batch():
+            d2 = Driver('d2')
+            d2.add_attr('foo', 'baz')
+
+            self.assertEqual(SESSION.execute(
+                select([ENTITY_TABLE.c.entity_id]).where(
+                    ENTITY_TABLE.c.name == u'd2')).fetchall(), [])
+
+            # counters still flush to get their numbers
+            d2.add_attr('port', 1, number=True)
+
+            self.assertEqual(clusto.get_by_name('d2'), d2)
+            self.assertEqual(d2.attr_value('foo'), 'baz')
+            self.assertEqual(len(d2.attr_query('foo')), 1)
+            self.assertEqual(len(Driver.do_attr_query(key='foo')), 2)
+            self.assertRaises(NameException, Driver, 'd2')
+
+        self.assertEqual(clusto.get_latest_version_number(), curver + 1)
+        self.assertEqual(clusto.get_by_name('d2').attr_value('foo'), 'baz')
+        self.assertEqual(clusto.get_by_name('d2').attr_value('port'), 1)
+
+    def testBatchPendingDeletes(self):
+
+        d1 = clusto.get_by_name('d1')
+
+        with clusto.batch():
+            d1.del_attrs('foo')
+            d1.add_attr('foo', 'new')
+
+            self.assertEqual(d1.attr_values('foo'), ['new'])
+            self.assertEqual([a.value for a in d1.attr_query('foo')], ['new'])
+
+            clusto.delete_entity(d1.entity)
+            self.assertRaises(LookupError, clusto.get_by_name, 'd1')
+
+        self.assertRaises(LookupError, clusto.get_by_name, 'd1')
+
+    def testBatchContents(self):
+
+        d1 = clusto.get_by_name('d1')
+        p1 = Pool('p1')
+        clusto.flush()
+
+        with clusto.batch():
+            p1.insert(d1)
+            s1 = BasicServer('s1')
+            p1.insert(s1)
+
+            self.assertEqual([d1, s1], p1.contents())
+            self.assertEqual([s1], p1.contents(clusto_types=[BasicServer]))
+            self.assertEqual(set([d1, s1]), clusto.get_from_pools([p1]))
+            self.assertEqual(set([s1]), clusto.get_from_pools(
+                    [p1], clusto_types=[BasicServer]))
+
+        self.assertEqual([d1, s1], p1.contents())
+        self.assertEqual(set([d1, s1]), clusto.get_from_pools([p1]))
+
+    def testBatchRollback(self):
+
+        def fail():
+            with clusto.batch():
+                Driver('d2').add_attr('foo', 'baz')
+                raise ValueError('boom')
+
+        self.assertRaises(ValueError, fail)
+        self.assertRaises(LookupError, clusto.get_by_name, 'd2')
+        self.assertEqual(len(Driver.do_attr_query(key='foo')), 1)
+
 
 class TestAdjacencyMap(testbase.ClustoTestBase):
     def data(self):
@@ -498,6 +876,10 @@ class TestAdjacencyMap(testbase.ClustoTestBase):
             child_id=ANY, child_name='e2', child_type='entity'
         ), adj_map)
 
+    def testIterAdjacency(self):
+        self.assertEqual(sorted(clusto.adjacency_map()),
+                         sorted(clusto.iter_adjacency(page_size=2)))
+
     def testDeletedNotIncluded(self):
         self.e2.delete()
         adj_map = clusto.adjacency_map()
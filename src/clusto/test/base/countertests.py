@@ -31,6 +31,15 @@ class TestClustoCounter(testbase.ClustoTestBase):
         c.next()
         self.assertEqual(c.value,2)
 
+    def testCounterReserve(self):
+
+        e = Entity('e1')
+        c = Counter(e, 'key1')
+
+        self.assertEqual(c.reserve(5), 1)
+        self.assertEqual(c.value, 5)
+        self.assertEqual(c.next(), 6)
+
     def testGetCounter(self):
 
         e = Entity('e1')
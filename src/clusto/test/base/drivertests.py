@@ -2,9 +2,14 @@
 Test the basic Driver object
 """
 
+import datetime
+
 from clusto.test import testbase
 
 import clusto
+from clusto import containment
+from sqlalchemy import event
+from clusto.schema import CLOSURE_TABLE, EFFECTIVE_ATTRS_TABLE
 from clusto.drivers.base import Driver
 from clusto.drivers import Pool
 from clusto.exceptions import DriverException, NameException
@@ -89,6 +94,43 @@ class TestDriverAttributes(testbase.ClustoTestBase):
         self.assertEqual(len(d.references()), 1)
         self.assertEqual(len(d.attrs()), 2)
 
+    def testRelationValuesLoadedAtOnce(self):
+
+        d1 = Driver('d1')
+        for i in range(5):
+            d1.add_attr('rel', Driver('target%d' % i), number=i)
+
+        clusto.clear()
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(clusto.SESSION.bind, 'before_cursor_execute', count)
+
+        d = clusto.get_by_name('d1')
+        del statements[:]
+        values = d.attr_values('rel')
+
+        self.assertEqual(['target%d' % i for i in range(5)],
+                         sorted(v.name for v in values))
+        # the attribute list and one query for all the targets
+        self.assertEqual(2, len(statements))
+
+        attr = d.attrs('rel', number=0)[0]
+        self.assertTrue(attr.value is attr.value)
+
+    def testReferencersSortedByAttribute(self):
+
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+        d3 = Driver('d3')
+        d3.add_attr('ref', d1)
+        d2.add_attr('ref', d1)
+        d3.add_attr('other', d1)
+
+        clusto.clear()
+        d1 = clusto.get_by_name('d1')
+        self.assertEqual(['d3', 'd2'], [d.name for d in d1.referencers()])
+
     def testNumberedAttrs(self):
 
         d1 = Driver('d1')
@@ -292,6 +334,52 @@ class TestDriverAttributes(testbase.ClustoTestBase):
 
         self.assertEqual(version+1, clusto.get_latest_version_number())
 
+    def testAddAttrs(self):
+
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+        d1.add_attr('foo', 'bar', number=True)
+
+        version = clusto.get_latest_version_number()
+
+        d1.add_attrs([('foo', 'bar1', None, True),
+                      ('foo', 'bar2', 'sub', True),
+                      ('baz', 3),
+                      ('rel', d2, 'peer')])
+
+        self.assertEqual(version+1, clusto.get_latest_version_number())
+
+        self.assertEqual(sorted(d1.attr_items()),
+                         sorted([(('baz', None, None), 3),
+                                 (('foo', 0, None), 'bar'),
+                                 (('foo', 1, None), 'bar1'),
+                                 (('foo', 2, 'sub'), 'bar2'),
+                                 (('rel', None, 'peer'), d2)]))
+
+        d1.add_attr('foo', 'bar3', number=True)
+        self.assertEqual(d1.attrs('foo', value='bar3')[0].number, 3)
+
+        self.assertRaises(NameException, d1.add_attrs, [('bad.key', 1)])
+
+    def testSetManyAttrs(self):
+
+        d1 = Driver('d1')
+        d1.set_attr('foo', 'bar')
+        d1.set_attr('baz', 1, subkey='sub')
+
+        version = clusto.get_latest_version_number()
+
+        d1.set_attrs({'foo': 'bar', ('baz', 'sub'): 2, 'new': 'val'})
+
+        self.assertEqual(version+1, clusto.get_latest_version_number())
+        self.assertEqual(sorted(d1.attr_items()),
+                         sorted([(('baz', None, 'sub'), 2),
+                                 (('foo', None, None), 'bar'),
+                                 (('new', None, None), 'val')]))
+
+        d1.set_attrs({'foo': 'bar'})
+        self.assertEqual(version+1, clusto.get_latest_version_number())
+
 
 class TestDriverContainerFunctions(testbase.ClustoTestBase):
 
@@ -335,6 +423,20 @@ class TestDriverContainerFunctions(testbase.ClustoTestBase):
 
         self.assertEqual(d1.contents(), [d2])
 
+    def testContentsInInsertOrder(self):
+
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+        d3 = Driver('d3')
+
+        d1.insert(d3)
+        d1.insert(d2)
+
+        self.assertEqual(d1.contents(), [d3, d2])
+        clusto.clear()
+        self.assertEqual([d.name for d in clusto.get_by_name('d1').contents()],
+                         ['d3', 'd2'])
+
     def testChildrenContents(self):
 
         p1 = Pool('p1')
@@ -367,6 +469,43 @@ class TestDriverContainerFunctions(testbase.ClustoTestBase):
         self.assertEqual(sorted([p2, d1, d2, d3]),
                          sorted(p1.contents(search_children=True)))
 
+    def testRecursiveContents(self):
+
+        self.assertTrue(containment.use_cte())
+
+        p1 = Pool('p1')
+        p2 = Pool('p2')
+        p3 = Pool('p3')
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+
+        p1.insert(p2)
+        p2.insert(p3)
+        p2.insert(d1)
+        p3.insert(d2)
+        p3.insert(d1)
+
+        self.assertEqual(sorted([p2, p3, d1, d2]),
+                         sorted(p1.contents(search_children=True)))
+        self.assertEqual(sorted([p2, p3]),
+                         sorted(p1.contents(search_children=True,
+                                            clusto_types=[Pool])))
+        self.assertEqual(sorted([d1, d2]),
+                         sorted(p1.contents(search_children=True,
+                                            clusto_drivers=[Driver])))
+
+        version = clusto.get_latest_version_number()
+        p3.remove(d2)
+        self.assertEqual(sorted([p2, p3, d1]),
+                         sorted(p1.contents(search_children=True)))
+
+        clusto.SESSION.clusto_version = version
+        try:
+            self.assertEqual(sorted([p2, p3, d1, d2]),
+                             sorted(p1.contents(search_children=True)))
+        finally:
+            clusto.SESSION.clusto_version = None
+
     def testMultipleInserts(self):
 
         d1 = Driver('d1')
@@ -419,6 +558,183 @@ class TestDriverContainerFunctions(testbase.ClustoTestBase):
         self.assertEqual(['someval'],
                          d3.attr_values('foo', merge_container_attrs=True))
 
+    def testAncestors(self):
+
+        p1 = Pool('p1')
+        p2 = Pool('p2')
+        p3 = Pool('p3')
+        d1 = Driver('d1')
+        d3 = Driver('d3')
+
+        p1.insert(p2)
+        p2.insert(d1)
+        d1.insert(d3)
+        p3.insert(d3)
+        p3.insert(d1)
+
+        expected = [(d1, 1), (p3, 1), (p2, 2), (p1, 3)]
+        self.assertEqual(d3.ancestors(), expected)
+        self.assertEqual(d3.ancestors(clusto_types=[Pool]),
+                         [(p3, 1), (p2, 2), (p1, 3)])
+        self.assertEqual(d3.parents(search_parents=True),
+                         [d for d, depth in expected])
+
+        in_database = containment.in_database
+        containment.in_database = lambda: False
+        try:
+            self.assertEqual(d3.ancestors(), expected)
+        finally:
+            containment.in_database = in_database
+
+
+class TestContainmentClosure(testbase.ClustoTestBase):
+
+    def setUp(self):
+        testbase.ClustoTestBase.setUp(self)
+        clusto.SESSION.clusto_closure_enabled = True
+
+    def tearDown(self):
+        testbase.ClustoTestBase.tearDown(self)
+        clusto.SESSION.clusto_closure_enabled = False
+
+    def closure_rows(self):
+        return sorted(tuple(row) for row in clusto.SESSION.execute(
+            CLOSURE_TABLE.select()))
+
+    def assertClosureConsistent(self):
+        rows = self.closure_rows()
+        containment.rebuild_closure()
+        self.assertEqual(rows, self.closure_rows())
+
+    def testClosureMaintained(self):
+
+        p1 = Pool('p1')
+        p2 = Pool('p2')
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+
+        p1.insert(p2)
+        p2.insert(d1)
+        d1.insert(d2)
+        p1.insert(d1)
+        self.assertClosureConsistent()
+
+        self.assertEqual(sorted([p2, d1, d2]),
+                         sorted(p1.contents(search_children=True)))
+        self.assertEqual([(d1, 1), (p1, 2), (p2, 2)],
+                         d2.ancestors())
+
+        p1.remove(d1)
+        self.assertClosureConsistent()
+        self.assertEqual([(d1, 1), (p2, 2), (p1, 3)],
+                         d2.ancestors())
+
+        d1.add_attrs([('_contains', Driver('d3'), None, True)])
+        self.assertClosureConsistent()
+
+        clusto.delete_entity(d1.entity)
+        self.assertClosureConsistent()
+        self.assertEqual([p2], p1.contents(search_children=True))
+        self.assertEqual([], d2.ancestors())
+
+    def testRebuildClosure(self):
+
+        p1 = Pool('p1')
+        p2 = Pool('p2')
+        p1.insert(p2)
+        p2.insert(Driver('d1'))
+
+        clusto.SESSION.execute(CLOSURE_TABLE.delete())
+        self.assertEqual(3, containment.rebuild_closure())
+        self.assertEqual(2, len(p1.contents(search_children=True)))
+
+
+class TestEffectiveAttrs(testbase.ClustoTestBase):
+
+    def setUp(self):
+        testbase.ClustoTestBase.setUp(self)
+        clusto.SESSION.clusto_closure_enabled = True
+        clusto.SESSION.clusto_effective_attrs_enabled = True
+
+    def tearDown(self):
+        testbase.ClustoTestBase.tearDown(self)
+        clusto.SESSION.clusto_closure_enabled = False
+        clusto.SESSION.clusto_effective_attrs_enabled = False
+
+    def effective_rows(self):
+        return sorted(tuple(row) for row in clusto.SESSION.execute(
+            EFFECTIVE_ATTRS_TABLE.select()))
+
+    def merged(self, entity, **kwargs):
+        values = sorted(entity.attr_values(merge_container_attrs=True, **kwargs))
+
+        use_effective_attrs = containment.use_effective_attrs
+        containment.use_effective_attrs = lambda: False
+        try:
+            self.assertEqual(values,
+                             sorted(entity.attr_values(merge_container_attrs=True,
+                                                       **kwargs)))
+        finally:
+            containment.use_effective_attrs = use_effective_attrs
+
+        return values
+
+    def testEffectiveAttrsMaintained(self):
+
+        p1 = Pool('p1')
+        p2 = Pool('p2')
+        d1 = Driver('d1')
+        p1.add_attr('dhcp', 'a', subkey='enabled')
+        p2.add_attr('dhcp', 'b')
+        d1.add_attr('dhcp', 'c')
+
+        p1.insert(p2)
+        p2.insert(d1)
+
+        self.assertEqual(['a', 'b', 'c'], self.merged(d1, key='dhcp'))
+        self.assertEqual(['a'], self.merged(d1, key='dhcp', subkey='enabled'))
+
+        p1.add_attr('dhcp', 'd')
+        p2.add_attrs([('dhcp', 'e'), ('other', 'f')])
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'], self.merged(d1, key='dhcp'))
+        self.assertEqual(['a', 'b', 'd', 'e', 'f'], self.merged(p2, regex=True,
+                                                             key='.*'))
+
+        p1.del_attrs('dhcp', 'd')
+        p2.del_attrs('other')
+        self.assertEqual(['a', 'b', 'c', 'e'], self.merged(d1, key='dhcp'))
+
+        p1.remove(p2)
+        self.assertEqual(['b', 'c', 'e'], self.merged(d1, key='dhcp'))
+
+        rows = self.effective_rows()
+        containment.rebuild_closure()
+        self.assertEqual(rows, self.effective_rows())
+
+        p2.entity.delete()
+        self.assertEqual(['c'], self.merged(d1, key='dhcp'))
+        self.assertEqual([], self.effective_rows())
+
+    def testEffectiveAttrsMergedOnce(self):
+
+        p1 = Pool('p1')
+        p2 = Pool('p2')
+        d1 = Driver('d1')
+        p1.insert(p2)
+        p2.insert(d1)
+        p1.insert(d1)
+        p1.add_attr('snmp', 'outer')
+        p2.add_attr('snmp', 'inner')
+
+        # p1 is both a parent and a grandparent of d1
+        self.assertEqual(['inner', 'outer'],
+                         sorted(d1.attr_values(key='snmp',
+                                               merge_container_attrs=True)))
+        self.assertEqual(set([(p1.entity.entity_id, 1), (p2.entity.entity_id, 1)]),
+                         set((source_id, depth) for entity_id, attr_id, source_id, depth
+                             in self.effective_rows()
+                             if entity_id == d1.entity.entity_id))
+
 
 class TestDriver(testbase.ClustoTestBase):
 
@@ -552,3 +868,118 @@ class TestDriverQueries(testbase.ClustoTestBase):
         d2 = clusto.get_by_name('d2')
         self.assertEqual(set(Driver.get_by_attr(key='a*', glob=True)),
                          set([d1, d2]))
+
+    def testRawAttrsMatchAttrs(self):
+
+        d1 = clusto.get_by_name('d1')
+        d2 = clusto.get_by_name('d2')
+
+        def rows(attrs):
+            return sorted(a.to_tuple for a in attrs)
+
+        for args, kwargs in [(('a',), {}), (('a', 1), {'number': True}),
+                             ((), {'subkey': 'z'}), ((), {'key': '_foo'})]:
+            expected = rows(d1.attrs(*args, **kwargs))
+            self.assertEqual(expected, rows(d1.attrs(raw=True, *args, **kwargs)))
+            self.assertEqual(expected, rows(d1.attr_query(raw=True, *args, **kwargs)))
+
+        record = d1.attrs(value=d2, raw=True)[0]
+        self.assertEqual(('d2', d2.entity.entity_id), (record.key, record.value))
+        self.assertTrue(record.is_relation)
+        self.assertEqual([record], d1.attr_query(value=d2, raw=True))
+
+    def testIterAttrs(self):
+
+        d1 = clusto.get_by_name('d1')
+
+        attrs = list(d1.iter_attrs('a', page_size=2))
+        self.assertEqual(sorted(a.to_tuple for a in d1.attrs('a')),
+                         sorted(a.to_tuple for a in attrs))
+        self.assertEqual(sorted(a.attr_id for a in attrs),
+                         [a.attr_id for a in attrs])
+
+        self.assertEqual([a.to_tuple for a in attrs],
+                         [a.to_tuple for a in d1.iter_attrs('a', page_size=4,
+                                                            raw=True)])
+
+    def testRawAttrsDecodeValues(self):
+
+        when = datetime.datetime(2010, 1, 2, 3, 4, 5)
+        d3 = clusto.get_by_name('d3')
+        d3.add_attr('when', when)
+        d3.add_attr('json', {'a': [1, 2]})
+        p1 = Pool('p1')
+        p1.insert(d3)
+        p1.add_attr('inherited', 7)
+
+        values = dict((a.key, a.value) for a in d3.attrs(raw=True))
+        self.assertEqual({'when': when, 'json': {'a': [1, 2]}}, values)
+        self.assertEqual([7], [a.value for a in d3.attrs('inherited', raw=True,
+                                                         merge_container_attrs=True)])
+
+
+class TestAttrCache(testbase.ClustoTestBase):
+
+    def setUp(self):
+        testbase.ClustoTestBase.setUp(self)
+        clusto.SESSION.clusto_attr_cache_enabled = True
+
+    def tearDown(self):
+        testbase.ClustoTestBase.tearDown(self)
+        clusto.SESSION.clusto_attr_cache_enabled = False
+
+    def testRepeatedReadsHitCache(self):
+
+        d = ATestDriver('d')
+        d.propB = 'bar'
+        d.add_attr('foo', 1)
+
+        before = clusto.attr_cache_stats()
+        self.assertEqual('bar', d.propB)
+        self.assertEqual('bar', d.propB)
+        self.assertEqual([1], d.attr_values('foo'))
+        after = clusto.attr_cache_stats()
+
+        self.assertEqual(1, after['misses'] - before['misses'])
+        self.assertEqual(2, after['hits'] - before['hits'])
+
+    def testWritesPatchCache(self):
+
+        d = Driver('d')
+        d.add_attr('foo', 1)
+
+        try:
+            clusto.begin_transaction()
+            self.assertEqual([1], d.attr_values('foo'))
+
+            d.add_attr('foo', 2, number=True)
+            d.add_attr('bar', 3)
+            self.assertEqual([1, 2], sorted(d.attr_values('foo')))
+
+            d.del_attrs('foo', number=0)
+            d.set_attr('bar', 4)
+            self.assertEqual([1], d.attr_values('foo'))
+            self.assertEqual([4], d.attr_values('bar'))
+
+            hits = clusto.attr_cache_stats()['hits']
+            d.attrs()
+            self.assertEqual(hits + 1, clusto.attr_cache_stats()['hits'])
+            clusto.commit()
+        except Exception:
+            clusto.rollback_transaction()
+            raise
+
+        self.assertEqual([1], d.attr_values('foo'))
+        self.assertEqual([4], d.attr_values('bar'))
+
+    def testRollbackDropsCache(self):
+
+        d = Driver('d')
+
+        clusto.begin_transaction()
+        d.add_attr('foo', 1)
+        self.assertEqual([1], d.attr_values('foo'))
+        clusto.rollback_transaction()
+
+        self.assertEqual(None, clusto.SESSION().ATTRCACHE)
+        self.assertEqual([], d.attr_values('foo'))
@@ -0,0 +1,93 @@
+import datetime
+
+from clusto.test import testbase
+
+import clusto
+from clusto import querylang
+from clusto.drivers import Driver, Pool, BasicServer
+from clusto.exceptions import QueryException
+
+
+class TestQueryParser(testbase.ClustoTestBase):
+
+    def testParse(self):
+
+        self.assertEqual(
+            ('or',
+             ('and', ('pool', u'web'), ('not', ('attr', u'decommissioned', None))),
+             ('cmp', u'system', u'memory', '>=', 65536)),
+            querylang.parse('pool:web & !attr:decommissioned | system.memory>=65536'))
+
+        self.assertEqual(('and', ('pool', u'sjc 1'),
+                          ('cmp', u'added', None, '<', datetime.datetime(2012, 1, 31))),
+                         querylang.parse('pool:"sjc 1" & (added < 2012-01-31)'))
+
+        self.assertEqual(('cmp', u'owner', None, '=', u'12'),
+                         querylang.parse('owner = "12"'))
+
+    def testSyntaxErrors(self):
+
+        for expr in ('', 'pool:', 'foo', 'foo >=', 'a=1 &', '(a=1', 'a=1)',
+                     'bogus:1', 'a=1 b=2'):
+            self.assertRaises(QueryException, querylang.parse, expr)
+
+
+class TestQuery(testbase.ClustoTestBase):
+
+    def data(self):
+
+        web = Pool('web')
+        sjc1 = Pool('sjc1')
+        sjc1_web = Pool('sjc1-web')
+        sjc1.insert(sjc1_web)
+
+        for i, memory in enumerate((32768, 65536, 131072)):
+            s = BasicServer('web%d' % i)
+            s.set_attr('system', memory, subkey='memory')
+            s.set_attr('added', datetime.datetime(2012, 1, i + 1))
+            web.insert(s)
+        sjc1.insert(clusto.get_by_name('web1'))
+        sjc1_web.insert(clusto.get_by_name('web2'))
+        clusto.get_by_name('web2').add_attr('decommissioned', 1)
+        Driver('other').set_attr('owner', 'ops team')
+
+    def names(self, expr):
+        return [d.name for d in clusto.query(expr)]
+
+    def testPoolsAndTypes(self):
+
+        self.assertEqual(['web1', 'web2'], self.names('pool:web & pool:sjc1'))
+        self.assertEqual(['web0', 'web1', 'web2'],
+                         self.names('pool:web & type:server'))
+        self.assertEqual(['sjc1-web'], self.names('type:pool & !pool:web & name:sjc1-*'))
+        self.assertRaises(LookupError, clusto.query, 'pool:nothing')
+        self.assertRaises(QueryException, clusto.query, 'pool:web0')
+
+    def testAttributeComparisons(self):
+
+        self.assertEqual(['web1'], self.names(
+            'pool:web & pool:sjc1 & type:server & system.memory>=65536 '
+            '& !attr:decommissioned'))
+        self.assertEqual(['web0', 'web1'], self.names('system.memory < 131072'))
+        self.assertEqual(['web0', 'web2'],
+                         self.names('type:server & system.memory != 65536'))
+        self.assertEqual(['web1', 'web2'], self.names('added >= 2012-01-02'))
+        self.assertEqual(['other'], self.names('owner = "ops team"'))
+        self.assertEqual(['other'], self.names('owner = ops*'))
+
+    def testWildcardsAreLiteral(self):
+
+        Driver('web_1')
+        Driver('webx1')
+        Driver('web%1')
+
+        self.assertEqual(['web_1'], self.names('name:web_*'))
+        self.assertEqual(['web%1'], self.names('name:"web%*"'))
+        clusto.get_by_name('web_1').set_attr('owner', 'ops_team')
+        self.assertEqual(['web_1'], self.names('owner = ops_*'))
+
+    def testRaw(self):
+
+        records = clusto.query('system.memory > 32768 | owner = "ops team"', raw=True)
+        self.assertEqual([('web1', 'server'), ('web2', 'server'), ('other', 'generic')],
+                         [(r.name, r.type) for r in records])
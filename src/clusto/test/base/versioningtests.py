@@ -258,3 +258,67 @@ class TestClustoVersioning(testbase.ClustoTestBase):
         self.assertEqual(curver, clusto.get_latest_version_number())
 
         self.assertEqual([], server.attr_values('foo'))
+
+    def testVersionAllocatedOnFirstWrite(self):
+
+        curver = clusto.get_latest_version_number()
+
+        clusto.begin_transaction()
+        Entity.query().all()
+        self.assertEqual(SESSION.execute(
+            select([func.count()]).select_from(CLUSTO_VERSIONING)).scalar(),
+                         curver)
+
+        SESSION.clusto_description = "two entities"
+        e1 = Entity('e1')
+        e2 = Entity('e2')
+        e1.add_attr('foo', 1)
+        clusto.commit()
+
+        self.assertEqual(curver + 1, clusto.get_latest_version_number())
+        self.assertEqual([curver + 1] * 3,
+                         [e1.version, e2.version, e1.attrs[0].version])
+
+        desc = SESSION.execute(select([CLUSTO_VERSIONING.c.description]).where(
+            CLUSTO_VERSIONING.c.version == curver + 1)).scalar()
+        self.assertEqual(desc, "two entities")
+
+    def testDescriptionDroppedOnRollback(self):
+
+        curver = clusto.get_latest_version_number()
+
+        clusto.begin_transaction()
+        SESSION.clusto_description = "dropped"
+        Entity('e1')
+        clusto.rollback_transaction()
+
+        Entity('e2')
+
+        desc = SESSION.execute(select([CLUSTO_VERSIONING.c.description]).where(
+            CLUSTO_VERSIONING.c.version == curver + 1)).scalar()
+        self.assertEqual(desc, None)
+
+    def testEntityRenameInPlace(self):
+
+        e1 = Entity('e1')
+        e2 = Entity('e2')
+        e1.add_attr('foo', 1)
+        e2.add_attr('bar', e1)
+        Counter.get(e1, 'port').next()
+
+        entity_id = e1.entity_id
+        prever = clusto.get_latest_version_number()
+
+        clusto.rename('e1', 't1', in_place=True)
+
+        self.assertEqual(prever + 1, clusto.get_latest_version_number())
+        self.assertRaises(LookupError, clusto.get_by_name, 'e1')
+
+        t1 = clusto.get_by_name('t1')
+        self.assertEqual(t1.entity.entity_id, entity_id)
+        self.assertEqual(t1.attr_values('foo'), [1])
+        self.assertEqual(clusto.get_by_name('e2').attr_value('bar'), t1)
+        self.assertEqual(Counter.get(t1.entity, 'port').value, 1)
+
+        self.assertRaises(NameException, clusto.rename, 't1', 'e2',
+                          in_place=True)
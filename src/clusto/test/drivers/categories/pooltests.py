@@ -1,5 +1,6 @@
 
 import clusto
+from clusto import containment
 from clusto.test import testbase 
 
 from clusto.drivers import *
@@ -123,6 +124,31 @@ class PoolTests(testbase.ClustoTestBase):
         self.assertEqual([x.name for x in Pool.get_pools(d1, allPools=False)],
                          [u'A', u'B', u'C'])
 
+    def testGetPoolsStopsAtOtherParents(self):
+
+        p1 = clusto.get_by_name('p1')
+        p2 = Pool('p2')
+        p3 = ExclusivePool('p3')
+        rack = BasicRack('r1')
+        s1 = BasicServer('s1')
+
+        p2.insert(p1)
+        p3.insert(p2)
+        p1.insert(rack)
+        rack.insert(s1, 1)
+        p2.insert(s1)
+
+        self.assertEqual(Pool.get_pools(s1), [p2, p3])
+        # get_pools lists a pool again for every path that reaches it
+        self.assertEqual(Pool.get_pools(rack), [p1, p2, p3, p3])
+
+        use_cte = containment.use_cte
+        containment.use_cte = lambda: False
+        try:
+            self.assertEqual(Pool.get_pools(rack), [p1, p2, p3, p3])
+        finally:
+            containment.use_cte = use_cte
+
 
     def testPoolAttrs(self):
 
@@ -258,3 +284,46 @@ class PoolTests(testbase.ClustoTestBase):
         clusto.flush()
 
         self.assertRaises(LookupError, clusto.get_by_name, 'p5')
+
+    def testGetFromPoolsSearchChildren(self):
+
+        p1 = clusto.get_or_create('p1', Pool)
+        p2 = clusto.get_or_create('p2', Pool)
+        sub = Pool('sub')
+
+        s1 = BasicServer('s1')
+        s2 = BasicServer('s2')
+        s3 = BasicServer('s3')
+
+        p1.insert(sub)
+        sub.insert(s1)
+        sub.insert(s2)
+        p2.insert(s2)
+        p2.insert(s3)
+
+        self.assertEqual([s2],
+                         sorted(clusto.get_from_pools([p1, p2],
+                                                      clusto_types=[BasicServer],
+                                                      search_children=True)))
+        self.assertEqual([],
+                         sorted(clusto.get_from_pools([p1, p2],
+                                                      clusto_types=[BasicServer],
+                                                      search_children=False)))
+        self.assertEqual(sorted([sub, s1, s2]),
+                         sorted(clusto.get_from_entities([p1],
+                                                         search_children=True)))
+        self.assertEqual([sub],
+                         sorted(clusto.get_from_entities([p1],
+                                                         clusto_drivers=[Pool],
+                                                         search_children=True)))
+
+        # the in-memory fallback agrees with the single query
+        in_database = containment.in_database
+        containment.in_database = lambda: False
+        try:
+            self.assertEqual([s2],
+                             sorted(clusto.get_from_pools([p1, p2],
+                                                          clusto_types=[BasicServer],
+                                                          search_children=True)))
+        finally:
+            containment.in_database = in_database
@@ -3,6 +3,10 @@ import clusto
 from clusto.test import testbase
 
 from clusto.drivers import IPManager, BasicServer, ResourceTypeException, ResourceException
+from clusto.drivers.resourcemanagers.ipmanager import SUBNETS
+from clusto.exceptions import ResourceNotAvailableException
+
+from sqlalchemy import event
 
 import IPy
 
@@ -44,6 +48,49 @@ class IPManagerTest(testbase.ClustoTestBase):
         
         self.assertEqual(ip1.owners('192.168.1.' + str(num+1)), [s1])
 
+    def testAllocatorSkipsUsedAndWraps(self):
+
+        s1 = clusto.get_by_name('s1')
+        ipman = IPManager('small', gateway='10.1.0.1', netmask='255.255.255.248',
+                          baseip='10.1.0.0')
+
+        ipman.allocate(s1, '10.1.0.3')
+        for i in range(4):
+            ipman.allocate(s1)
+
+        self.assertEqual(sorted(IPManager.get_ips(s1)),
+                         ['10.1.0.%d' % i for i in (2, 3, 4, 5, 6)])
+        self.assertRaises(ResourceNotAvailableException, ipman.allocate, s1)
+
+        s1.del_attrs('ip', number=ipman.get_resource_number(s1, '10.1.0.4'))
+        ipman.allocate(s1)
+        self.assertEqual(ipman.owners('10.1.0.4'), [s1])
+
+    def testAllocateMany(self):
+
+        ip1, s1 = map(clusto.get_by_name, ['a1', 's1'])
+        servers = [BasicServer('server%d' % i) for i in range(3)]
+
+        ip1.allocate(s1, '192.168.1.3')
+        attrs = ip1.allocate_many(servers + [s1])
+        ip1.allocate(s1)
+
+        self.assertEqual(['192.168.1.2', '192.168.1.4', '192.168.1.5', '192.168.1.6'],
+                         [str(IPManager._int_to_ipy(a.value)) for a in attrs])
+        self.assertEqual(IPManager.get_ips(servers[1]), ['192.168.1.4'])
+        self.assertEqual(str(servers[1].attr_value(key='ip', subkey='cidr')), '192.168.1.4/24')
+        self.assertEqual(sorted(IPManager.get_ips(s1)),
+                         ['192.168.1.3', '192.168.1.6', '192.168.1.7'])
+        self.assertEqual(ip1.count, 6)
+
+        attrs = ip1.allocate_many(servers[:2], ['192.168.1.100', '192.168.1.101'])
+        self.assertEqual(ip1.owners('192.168.1.101'), [servers[1]])
+        self.assertRaises(ResourceTypeException, ip1.allocate_many, servers[:1], ['10.0.0.1'])
+
+        small = IPManager('small', netmask='255.255.255.252', baseip='10.1.0.0')
+        self.assertRaises(ResourceNotAvailableException, small.allocate_many, servers)
+        self.assertEqual(small.count, 0)
+
     def testGetIPManager(self):
 
         ip1, ip2 = map(clusto.get_by_name, ['a1', 'b1'])
@@ -58,6 +105,100 @@ class IPManagerTest(testbase.ClustoTestBase):
         self.assertEqual([ip4], IPManager.get_ip_managers('172.16.0.2'))
         self.assertEqual([], IPManager.get_ip_managers('192.168.40.1'))
 
+    def testGetIPManagerMostSpecific(self):
+        ip3, ip4 = map(clusto.get_by_name, ['c1', 'c2'])
+
+        self.assertEqual(ip3, IPManager.get_ip_manager('172.16.40.2'))
+        self.assertEqual(ip4, IPManager.get_ip_manager('172.16.41.2'))
+
+        IPManager('c3', netmask='255.255.255.0', baseip='172.16.40.0')
+        self.assertRaises(ResourceException, IPManager.get_ip_manager, '172.16.40.2')
+
+    def testSubnetIndexFollowsChanges(self):
+        ip3, ip4 = map(clusto.get_by_name, ['c1', 'c2'])
+
+        IPManager.get_ip_managers('172.16.40.2')
+        networks = SUBNETS._networks
+        self.assertEqual([ip4], IPManager.get_ip_managers('172.16.50.2'))
+        self.assertTrue(networks is SUBNETS._networks)
+
+        ip3.baseip = '172.16.50.0'
+        self.assertEqual([ip3, ip4], IPManager.get_ip_managers('172.16.50.2'))
+        self.assertEqual([ip4], IPManager.get_ip_managers('172.16.40.2'))
+
+        ip5 = IPManager('d1', netmask='255.255.255.128', baseip='172.16.50.0')
+        self.assertEqual([ip5, ip3, ip4], IPManager.get_ip_managers('172.16.50.2'))
+
+        clusto.delete_entity(ip3.entity)
+        self.assertEqual([ip5, ip4], IPManager.get_ip_managers('172.16.50.2'))
+        self.assertEqual([ip4], IPManager.get_ip_managers(IPManager._ipy_to_int(IPy.IP('172.16.50.200'))))
+        self.assertEqual([], IPManager.get_ip_managers('not an ip'))
+
+    def testIndexedManagerChecksWithoutQueries(self):
+        ip1, s1 = map(clusto.get_by_name, ['a1', 's1'])
+        ip1.allocate(s1, '192.168.1.20')
+
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(clusto.SESSION.bind, 'before_cursor_execute', count)
+
+        ipman = IPManager.get_ip_manager('192.168.1.20')
+        del statements[:]
+        self.assertEqual(ipman.ensure_type('192.168.1.20')[0],
+                         IPManager._ipy_to_int(IPy.IP('192.168.1.20')))
+        self.assertRaises(ResourceTypeException, ipman.ensure_type, '10.0.0.1')
+        self.assertEqual([], statements)
+
+        self.assertEqual([s1], IPManager.get_devices('192.168.1.20'))
+
+    def testUtilization(self):
+
+        s1 = clusto.get_by_name('s1')
+        ipman = IPManager('small', gateway='10.1.0.1', netmask='255.255.255.240',
+                          baseip='10.1.0.0')
+        for ip in ('10.1.0.2', '10.1.0.3', '10.1.0.7', '10.1.0.14'):
+            ipman.allocate(s1, ip)
+
+        result = ipman.utilization()
+        self.assertEqual('10.1.0.0/28', result['subnet'])
+        self.assertEqual(14, result['size'])
+        self.assertEqual(4, result['used'])
+        self.assertEqual(4, ipman.count)
+        self.assertEqual(9, result['free'])
+        self.assertEqual(6, result['largest_free'])
+        self.assertEqual([('10.1.0.4', '10.1.0.6'), ('10.1.0.8', '10.1.0.13')],
+                         result['free_ranges'])
+        self.assertAlmostEqual(5 / 14.0, result['utilization'])
+
+    def testUtilizationReport(self):
+
+        ip3, s1 = map(clusto.get_by_name, ['c1', 's1'])
+        full = IPManager('full', netmask='255.255.255.252', baseip='10.2.0.0')
+        full.allocate(s1)
+        full.allocate(s1)
+        ip3.allocate(s1, '172.16.40.10')
+
+        report = clusto.ip_utilization()
+        self.assertEqual(['a1', 'b1', 'c1', 'c2', 'full'],
+                         [result['name'] for result in report])
+        for result in report:
+            ipman = clusto.get_by_name(result['name'])
+            self.assertEqual(ipman.utilization(), result)
+
+        # ips used in a nested subnet aren't free in the outer one either
+        c2 = dict((result['name'], result) for result in report)['c2']
+        self.assertEqual(1, c2['used'])
+        self.assertEqual(65534 - 1, c2['free'])
+
+        self.assertEqual(['full'], [result['name'] for result in
+                                    clusto.ip_utilization(over=0.9)])
+
+        anywhere = IPManager('anywhere')
+        self.assertRaises(ResourceTypeException, anywhere.utilization)
+        self.assertEqual(['a1', 'b1', 'c1', 'c2', 'full'],
+                         [result['name'] for result in clusto.ip_utilization()])
+
     def testGetIP(self):
 
         ip1, ip2, s1 = map(clusto.get_by_name, ['a1', 'b1', 's1'])
@@ -95,6 +95,26 @@ class SimpleEntityNameManagerTests(testbase.ClustoTestBase):
         self.assertEqual(clusto.get_by_name('foo0050').name, 'foo0050')
 
 
+    def testAllocateManyEntities(self):
+
+        ngen = clusto.get_by_name('foonamegen')
+
+        ngen.allocate(Driver)
+        drivers = ngen.allocate_many(Driver, 3)
+        s5 = ngen.allocate(Driver)
+
+        self.assertEqual(['foo0002', 'foo0003', 'foo0004'], [d.name for d in drivers])
+        self.assertEqual(clusto.get_by_name('foo0003'), drivers[1])
+        self.assertEqual(s5.name, 'foo0005')
+
+        drivers = ngen.allocate_many(Driver, ['given1', 'given2'])
+        self.assertEqual(['given1', 'given2'], [d.name for d in drivers])
+
+        ngen = clusto.get_by_name('barnamegen')
+        self.assertRaises(SimpleNameManagerException, ngen.allocate_many, Driver, 6)
+        self.assertRaises(LookupError, clusto.get_by_name, 'bar95')
+        self.assertEqual(len(ngen.allocate_many(Driver, 5)), 5)
+
     def testAllocateGivenName(self):
 
         ngen = clusto.get_by_name('foonamegen')
@@ -125,3 +145,17 @@ class SimpleNameManagerTests(testbase.ClustoTestBase):
             
         
         self.assertEqual(len(SimpleNameManager.resources(d)), 50)
+
+    def testAllocateManyNamesAtOnce(self):
+
+        ngen = clusto.get_by_name('foonamegen')
+
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+
+        attrs = ngen.allocate_many([d1, d2] * 25)
+
+        self.assertEqual(len(set(a.value for a in attrs)), 50)
+        self.assertEqual(len(SimpleNameManager.resources(d1)), 25)
+        self.assertEqual(ngen.owners(attrs[1].value), [d2])
+
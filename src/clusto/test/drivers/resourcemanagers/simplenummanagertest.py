@@ -34,6 +34,25 @@ class SimpleNumManagerTests(testbase.ClustoTestBase):
         self.assertEqual(ngen.owners(4), [d])
 
 
+    def testAllocateManyNums(self):
+
+        ngen = clusto.get_by_name('numgen1')
+        d1 = Driver('foo')
+        d2 = Driver('bar')
+
+        attrs = ngen.allocate_many([d1, d2, d1])
+        ngen.allocate(d2)
+
+        self.assertEqual([1, 2, 3], [a.value for a in attrs])
+        self.assertEqual(ngen.owners(2), [d2])
+        self.assertEqual(ngen.owners(4), [d2])
+        self.assertEqual(sorted(x.value for x in SimpleNumManager.resources(d1)), [1, 3])
+
+        ngen = clusto.get_by_name('numgen2')
+        self.assertRaises(SimpleNumManagerException, ngen.allocate_many, [d1] * 6)
+        self.assertEqual(len(ngen.allocate_many([d1] * 5)), 5)
+        self.assertRaises(SimpleNumManagerException, ngen.allocate, d1)
+
     def testAllocateMaxNum(self):
         
         d = Driver('foo')
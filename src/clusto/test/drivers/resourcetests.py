@@ -86,6 +86,59 @@ class ResourceManagerTests(testbase.ClustoTestBase):
         rm.set_resource_attr(d,'bar', 'attr2', 2)
         self.assertEqual(rm.get_resource_attr_values(d, 'bar', 'attr2'), [2])
 
+    def testAllocateMany(self):
+
+        rm = ResourceManager('test')
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+
+        attrs = rm.allocate_many([d1, d2, d1], ['foo', 'bar', 'baz'])
+        rm.allocate(d2, 'qux')
+
+        self.assertEqual(['foo', 'bar', 'baz'], [a.value for a in attrs])
+        self.assertEqual(rm.owners('bar'), [d2])
+        self.assertEqual(sorted(x.value for x in rm.resources(d1)), ['baz', 'foo'])
+        self.assertEqual(rm.count, 4)
+        self.assertEqual([0, 0, 1], [a.number for a in attrs])
+
+        self.assertRaises(ResourceException, rm.allocate_many, [d1, d2], ['a', 'a'])
+        self.assertRaises(ResourceException, rm.allocate_many, [d1, d2], ['a', 'foo'])
+        self.assertRaises(ResourceException, rm.allocate_many, [d1, d2], ['a'])
+        self.assertEqual(rm.owners('a'), [])
+        self.assertEqual(rm.count, 4)
+
+    def testNumbersPerThing(self):
+
+        rm = ResourceManager('test')
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+        d1.add_attr('resource', 'old', number=5)
+
+        self.assertEqual(rm.allocate(d1, 'foo').number, 6)
+        self.assertEqual(rm.allocate(d2, 'bar').number, 0)
+        self.assertEqual([7, 8], [a.number for a in rm.allocate_many([d1, d1], ['a', 'b'])])
+        self.assertEqual(d1.add_attr('resource', 'new', number=True).number, 9)
+
+        # no allocation touches a counter shared by everything
+        self.assertEqual(0, clusto.Counter.query().filter(
+                clusto.Counter.entity == ClustoMeta().entity).count())
+
+    def testNumbersSkipAheadOfExistingCounter(self):
+
+        rm = ResourceManager('test')
+        d1 = Driver('d1')
+        # the counter is at 0, below a resource numbered by the old
+        # global counter
+        d1.add_attr('resource', 'counted', number=True)
+        d1.add_attr('resource', 'old', number=1)
+        d1.add_attr('resource', rm, number=1, subkey='manager')
+
+        attr = rm.allocate(d1, 'foo')
+        self.assertEqual(attr.number, 2)
+        self.assertEqual(rm.get_resource_number(d1, 'old'), 1)
+        self.assertEqual(d1.attr_values('resource', number=1), ['old', rm])
+        self.assertEqual([3, 4], [a.number for a in rm.allocate_many([d1, d1], ['a', 'b'])])
+
     def testReserveResource(self):
 
         rm = ResourceManager('test')